@@ -0,0 +1,107 @@
+import base64
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from Cryptodome.Cipher import AES, PKCS1_OAEP
+from Cryptodome.PublicKey import RSA
+from Cryptodome.Random import get_random_bytes
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from common.variables import ENCODING, SESSION_KEY_SIZE, SESSION_KEY_MESSAGES, SESSION_KEY_LIFETIME, \
+    SESSION_KEYS_CACHE_SIZE
+
+# -- Parts of a hybrid message text are joined with a character which base64 never contains,
+# -- so old messages encrypted with RSA only are recognized by its absence
+PAYLOAD_SEPARATOR = '.'
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+class SessionKey:
+    """Symmetric key of a conversation and the same key encrypted with the contact's public key"""
+    __slots__ = ('key', 'wrapped', 'pubkey', 'created', 'messages')
+
+    def __init__(self, pubkey, encrypter):
+        self.key = get_random_bytes(SESSION_KEY_SIZE)
+        self.wrapped = b64encode(encrypter.encrypt(self.key))
+        self.pubkey = pubkey
+        self.created = time.monotonic()
+        self.messages = 0
+
+    def expired(self, pubkey):
+        """Check if the key must be replaced: contact's public key is changed or the key is used too long"""
+        return pubkey != self.pubkey or self.messages >= SESSION_KEY_MESSAGES or \
+            time.monotonic() - self.created >= SESSION_KEY_LIFETIME
+
+
+class HybridCipher:
+    """Chat messages encryption. Every conversation has its own AES-GCM key.
+    The key is encrypted with the contact's RSA public key once and is sent with the messages,
+    so the contact decrypts it with the private key only for the first message.
+    Message text is [encrypted key].[nonce].[encrypted text][tag] in base64.
+    Messages encrypted with RSA only are still decrypted
+    """
+    def __init__(self, private_key, account_name):
+        self.account_name = account_name
+        self.decrypter = PKCS1_OAEP.new(private_key)
+        self.session_keys = dict()  # Keys of messages sent by the user {contact: SessionKey}
+        self.encrypters = dict()  # Ciphers of the contacts public keys {contact: (pubkey, cipher)}
+        self.received_keys = OrderedDict()  # Decrypted keys of the contacts {encrypted_key: key}
+        self.lock = threading.Lock()
+
+    def encrypt(self, contact, pubkey, text):
+        """Encrypt message for the contact with a given public key. Returns message text"""
+        with self.lock:
+            session = self.session_keys.get(contact)
+            if session is None or session.expired(pubkey):
+                session = self.session_keys[contact] = SessionKey(pubkey, self.encrypter(contact, pubkey))
+            session.messages += 1
+
+        cipher = AES.new(session.key, AES.MODE_GCM)
+        cipher.update(self.associated_data(self.account_name, contact))
+        ciphertext, tag = cipher.encrypt_and_digest(text.encode(ENCODING))
+        return PAYLOAD_SEPARATOR.join((session.wrapped, b64encode(cipher.nonce), b64encode(ciphertext + tag)))
+
+    def encrypter(self, contact, pubkey):
+        """RSA cipher of the contact's public key. Key is imported again only if it's changed"""
+        cached = self.encrypters.get(contact)
+        if cached is None or cached[0] != pubkey:
+            cached = self.encrypters[contact] = (pubkey, PKCS1_OAEP.new(RSA.import_key(pubkey)))
+        return cached[1]
+
+    def decrypt(self, sender, payload):
+        """Decrypt message text received from the sender. Raises ValueError if it can't be decrypted"""
+        if PAYLOAD_SEPARATOR not in payload:
+            return self.decrypter.decrypt(base64.b64decode(payload)).decode(ENCODING)
+
+        wrapped, nonce, ciphertext = payload.split(PAYLOAD_SEPARATOR)
+        ciphertext = base64.b64decode(ciphertext)
+        cipher = AES.new(self.received_key(wrapped), AES.MODE_GCM, nonce=base64.b64decode(nonce))
+        cipher.update(self.associated_data(sender, self.account_name))
+        return cipher.decrypt_and_verify(ciphertext[:-16], ciphertext[-16:]).decode(ENCODING)
+
+    def received_key(self, wrapped):
+        """Conversation key sent by a contact. Private key is used only for the keys which aren't cached"""
+        with self.lock:
+            key = self.received_keys.get(wrapped)
+            if key is not None:
+                self.received_keys.move_to_end(wrapped)
+                return key
+
+        key = self.decrypter.decrypt(base64.b64decode(wrapped))
+        with self.lock:
+            self.received_keys[wrapped] = key
+            if len(self.received_keys) > SESSION_KEYS_CACHE_SIZE:
+                self.received_keys.popitem(last=False)
+        return key
+
+    @staticmethod
+    def associated_data(sender, recipient):
+        """Message is bound to its sender and recipient, so it can't be passed as another user's message"""
+        return f'{sender}\n{recipient}'.encode(ENCODING)
@@ -1,9 +1,36 @@
-from sqlalchemy import Column, Integer, String, DateTime, func, create_engine, Text
+import functools
+import threading
+
+from sqlalchemy import Column, Integer, String, DateTime, func, create_engine, Text, Index, tuple_
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.sql import default_comparator
 
+from common.variables import MESSAGE_PENDING, MESSAGES_PAGE_SIZE
+from common.migrations import add_column, migrate
+
 Base = declarative_base()
 
+# -- Client database schema changes, see common.migrations.migrate
+MIGRATIONS = [
+    [
+        add_column('messages', 'status VARCHAR(10)'),
+        add_column('messages', 'payload TEXT'),
+        'CREATE INDEX IF NOT EXISTS ix_messages_status ON messages (status)',
+    ],
+    [
+        'CREATE INDEX IF NOT EXISTS ix_messages_from_user_date ON messages (from_user, date)',
+    ],
+]
+
+
+def locked(method):
+    """Run a database method holding the database lock"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class ClientDatabase:
     """Class to work with client side database"""
@@ -22,16 +49,21 @@ class ClientDatabase:
     class Messages(Base):
         """User Messages table"""
         __tablename__ = 'messages'
+        __table_args__ = (Index('ix_messages_from_user_date', 'from_user', 'date'), )
         id = Column(Integer, primary_key=True)
         from_user = Column(String)
         to_user = Column(String)
         message = Column(Text)
         date = Column(DateTime(timezone=True), server_default=func.now())
+        status = Column(String(10), index=True)  # Outgoing message status, None for old messages
+        payload = Column(Text)  # Encrypted message kept until the server accepts it
 
-        def __init__(self, from_user, to_user, message):
+        def __init__(self, from_user, to_user, message, status=None, payload=None):
             self.from_user = from_user
             self.to_user = to_user
             self.message = message
+            self.status = status
+            self.payload = payload
 
         def __repr__(self):
             return "<Message('%s', '%s', '%s')>" % (self.from_user, self.to_user, self.message)
@@ -48,12 +80,46 @@ class ClientDatabase:
         def __repr__(self):
             return "<Contact('%s')>" % self.user
 
+    class Settings(Base):
+        """Client settings table"""
+        __tablename__ = 'settings'
+        id = Column(Integer, primary_key=True)
+        name = Column(String(50), unique=True)
+        value = Column(String)
+
+        def __init__(self, name, value):
+            self.name = name
+            self.value = value
+
+        def __repr__(self):
+            return "<Setting('%s', '%s')>" % (self.name, self.value)
+
+    class PublicKeys(Base):
+        """Public keys of the contacts received from the server"""
+        __tablename__ = 'pubkeys'
+        id = Column(Integer, primary_key=True)
+        user = Column(String, unique=True)
+        pubkey = Column(Text)
+        fingerprint = Column(String(64))
+
+        def __init__(self, user, pubkey, fingerprint):
+            self.user = user
+            self.pubkey = pubkey
+            self.fingerprint = fingerprint
+
+        def __repr__(self):
+            return "<PublicKey('%s', '%s')>" % (self.user, self.fingerprint)
+
     def __init__(self, name):
+        # -- One session is used by the window, the transport reader and the lists update threads
+        self.lock = threading.RLock()
+
         # -- Creating db connection ----------------
         self.engine = create_engine(f'sqlite:///client_{name}_db.sqlite',
                                     echo=False, pool_recycle=7200, connect_args={'check_same_thread': False})
-        # -- Creating all tables -------------------
+        # -- Creating all tables and upgrading existing database ---
         Base.metadata.create_all(self.engine)
+        migrate(self.engine, MIGRATIONS)
         session = sessionmaker(bind=self.engine)
 
         self.session = session()
@@ -62,6 +128,7 @@ class ClientDatabase:
         self.session.query(self.Contacts).delete()
         self.session.commit()
 
+    @locked
     def add_contact(self, contact):
         """Add new user contact"""
         if not self.session.query(self.Contacts).filter_by(user=contact).count():
@@ -69,35 +136,122 @@ class ClientDatabase:
             self.session.add(new_contact)
             self.session.commit()
 
+    @locked
     def del_contact(self, contact):
-        """Delete user contact"""
+        """Delete user contact and its saved public key, its changes aren't reported any more"""
         record = self.session.query(self.Contacts).filter_by(user=contact)
         if record.count():
             record.delete()
+            self.session.query(self.PublicKeys).filter_by(user=contact).delete()
             self.session.commit()
 
-    def add_users(self, users_list):
-        """Add users from server to client users table. Remove old users before insert"""
-        self.session.query(self.Users).delete()
-        for user_item in users_list:
-            new_user = self.Users(user_item)
-            self.session.add(new_user)
+    @locked
+    def update_users(self, added, removed, version=None):
+        """Apply known users list changes received from the server.
+        If removed list is None the added list is the full users list. Saved version isn't changed
+        if version is None
+        """
+        if removed is None:
+            self.session.query(self.Users).delete()
+            known = set()
+        else:
+            self.session.query(self.Users).filter(self.Users.username.in_(removed)).delete()
+            known = set(user[0] for user in
+                        self.session.query(self.Users.username).filter(self.Users.username.in_(added)).all())
+
+        self.session.add_all([self.Users(user_item) for user_item in set(added) - known])
+        if version is not None:
+            self.set_setting('users_version', version)
+        self.session.commit()
+
+    @locked
+    def get_users_version(self):
+        """Get known users list version, 0 if the list wasn't received yet"""
+        return int(self.get_setting('users_version', 0))
+
+    @locked
+    def get_setting(self, name, default=None):
+        """Get setting value"""
+        setting = self.session.query(self.Settings.value).filter_by(name=name).first()
+        return setting[0] if setting else default
+
+    @locked
+    def set_setting(self, name, value):
+        """Set setting value. Changes are saved with the next commit"""
+        setting = self.session.query(self.Settings).filter_by(name=name).first()
+        if setting:
+            setting.value = str(value)
+        else:
+            self.session.add(self.Settings(name, str(value)))
+
+    @locked
+    def get_pubkey(self, user):
+        """Get saved public key of the user, None if it wasn't received yet"""
+        record = self.session.query(self.PublicKeys.pubkey).filter_by(user=user).first()
+        return record[0] if record else None
+
+    @locked
+    def get_fingerprints(self):
+        """Get fingerprints of the saved public keys {user: fingerprint}"""
+        return dict(self.session.query(self.PublicKeys.user, self.PublicKeys.fingerprint).all())
+
+    @locked
+    def save_pubkey(self, user, pubkey, fingerprint):
+        """Save public key of the user received from the server"""
+        self.save_pubkeys({user: (pubkey, fingerprint)})
+
+    @locked
+    def save_pubkeys(self, keys):
+        """Save public keys of the users received from the server {user: (pubkey, fingerprint)}"""
+        records = self.session.query(self.PublicKeys).filter(self.PublicKeys.user.in_(keys)).all()
+        for record in records:
+            record.pubkey, record.fingerprint = keys[record.user]
+        saved = set(record.user for record in records)
+        self.session.add_all([self.PublicKeys(user, *key) for user, key in keys.items() if user not in saved])
+        self.session.commit()
+
+    @locked
+    def remove_pubkeys(self, users):
+        """Remove saved public keys, they will be requested from the server again"""
+        self.session.query(self.PublicKeys).filter(self.PublicKeys.user.in_(users)).delete()
         self.session.commit()
 
-    def save_message(self, from_user, to_user, message):
-        """Save user message"""
-        new_message = self.Messages(from_user, to_user, message)
+    @locked
+    def save_message(self, from_user, to_user, message, status=None, payload=None):
+        """Save user message. Returns message id"""
+        new_message = self.Messages(from_user, to_user, message, status, payload)
         self.session.add(new_message)
         self.session.commit()
+        return new_message.id
+
+    @locked
+    def set_message_status(self, message_id, status):
+        """Change outgoing message status. Message is removed from the outbox if it isn't pending"""
+        message = self.session.get(self.Messages, message_id)
+        if message:
+            message.status = status
+            if status != MESSAGE_PENDING:
+                message.payload = None
+            self.session.commit()
+
+    @locked
+    def get_outbox(self):
+        """Get messages waiting to be sent [(message_id, contact, payload), ...]"""
+        query = self.session.query(self.Messages.id, self.Messages.from_user, self.Messages.payload). \
+            filter_by(status=MESSAGE_PENDING).order_by(self.Messages.id)
+        return [tuple(message) for message in query.all()]
 
+    @locked
     def get_contacts(self):
         """Get contacts list"""
         return [contact[0] for contact in self.session.query(self.Contacts.user).all()]
 
+    @locked
     def get_users(self):
         """Get users list"""
         return [user_item[0] for user_item in self.session.query(self.Users.username).all()]
 
+    @locked
     def check_user(self, username):
         """Check if user exists in a Users table"""
         if self.session.query(self.Users).filter_by(username=username).count():
@@ -105,6 +259,7 @@ class ClientDatabase:
 
         return False
 
+    @locked
     def check_contact(self, contact):
         """Check if user exists in a Contacts table"""
         if self.session.query(self.Contacts).filter_by(user=contact).count():
@@ -112,17 +267,36 @@ class ClientDatabase:
 
         return False
 
+    @locked
     def get_history(self, from_who=None, to_who=None):
         """Getting messages list"""
         query = self.session.query(self.Messages)
         if from_who:
             query = query.filter_by(from_user=from_who)
         if to_who:
-            query - query.filter_by(to_user=to_who)
+            query = query.filter_by(to_user=to_who)
 
-        return [(message.from_user, message.to_user, message.message, message.date)
+        return [(message.from_user, message.to_user, message.message, message.date, message.status)
                 for message in query.all()]
 
+    @locked
+    def get_history_page(self, contact, before=None, limit=MESSAGES_PAGE_SIZE):
+        """Getting a page of messages with the contact, sorted by date.
+        Before is a key of the first message of the previous page, the page has older messages.
+        Returns messages and a key of the next page or None if there are no older messages
+        """
+        query = self.session.query(self.Messages).filter_by(from_user=contact)
+        if before is not None:
+            # -- Dates are compared in the database format, so the key is a message id
+            date = self.session.query(self.Messages.date).filter_by(id=before).scalar_subquery()
+            query = query.filter(tuple_(self.Messages.date, self.Messages.id) < tuple_(date, before))
+
+        messages = query.order_by(self.Messages.date.desc(), self.Messages.id.desc()).limit(limit).all()
+        next_key = messages[-1].id if len(messages) == limit else None
+        return [(message.from_user, message.to_user, message.message, message.date, message.status)
+                for message in reversed(messages)], next_key
+
+    @locked
     def contacts_clear(self):
         """Clear user contacts table"""
         self.session.query(self.Contacts).delete()
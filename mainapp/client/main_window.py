@@ -1,26 +1,26 @@
-import base64
 import json
 import os
 
-from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox
+from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QAbstractItemView
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
 from PyQt5.QtCore import pyqtSlot, Qt
 import sys
 import logging
 
-from Cryptodome.Cipher import PKCS1_OAEP
-from Cryptodome.PublicKey import RSA
-
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
 from client.main_window_conv import Ui_MainClientWindow
 from client.add_contact import AddContactDialog
 from client.del_contact import DelContactDialog
+from client.crypto import HybridCipher
 from common.errors import ServerError
 from common.variables import *
 
 client_logger = logging.getLogger('client')
 
+# -- Outgoing messages statuses shown in the history
+MESSAGE_STATUS_TEXT = {MESSAGE_PENDING: 'отправляется', MESSAGE_FAILED: 'не доставлено'}
+
 
 class ClientMainWindow(QMainWindow):
     """Main client window class"""
@@ -30,8 +30,8 @@ class ClientMainWindow(QMainWindow):
         self.database = database
         self.transport = transport
 
-        # -- Message Decoder object with preloaded keys
-        self.decrypter = PKCS1_OAEP.new(keys)
+        # -- Messages encryption with preloaded keys
+        self.cipher = HybridCipher(keys, transport.account_name)
 
         self.ui = Ui_MainClientWindow()
         self.ui.setupUi(self)
@@ -50,12 +50,13 @@ class ClientMainWindow(QMainWindow):
 
         self.contacts_model = None
         self.history_model = None
+        self.history_key = None  # Key of the older messages page, None if all messages are loaded
         self.messages = QMessageBox()
         self.current_chat = None
         self.current_chat_key = None
-        self.encryptor = None
         self.ui.list_messages.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
+        self.ui.list_messages.verticalScrollBar().valueChanged.connect(self.history_scrolled)
 
         # -- Send double click event on a client list objects to an event handler
         self.ui.list_contacts.doubleClicked.connect(self.select_active_user)
@@ -68,6 +69,7 @@ class ClientMainWindow(QMainWindow):
         """Disable input fields and buttons"""
         self.ui.label_new_message.setText('Для выбора получателя дважды кликните на нем в окне контактов.')
         self.ui.text_message.clear()
+        self.history_key = None
         if self.history_model:
             self.history_model.clear()
 
@@ -77,41 +79,54 @@ class ClientMainWindow(QMainWindow):
         self.ui.text_message.setDisabled(True)
 
     def history_list_update(self):
-        """Fill in a messages history"""
-        # -- Get messages sorted by date
-        messages_list = sorted(self.database.get_history(self.current_chat), key=lambda item: item[3])
-
+        """Fill in a messages history with the latest messages.
+        Older messages are loaded by pages when the list is scrolled to the top
+        """
         # -- Create model if not exists
         if not self.history_model:
             self.history_model = QStandardItemModel()
             self.ui.list_messages.setModel(self.history_model)
 
         # -- Clear messages textarea
+        self.history_key = None
         self.history_model.clear()
 
-        # -- Get only 20 messages from a messages history
-        length = len(messages_list)
-        start_index = 0
-        if length > 20:
-            start_index = length - 20
-
-        # -- Fill in messages. Add different color and align for users message
-        for i in range(start_index, length):
-            item = messages_list[i]
-            if item[1] == 'in':
-                mess = QStandardItem(f'Входящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setBackground(QBrush(QColor(255, 213, 213)))
-                mess.setTextAlignment(Qt.AlignLeft)
-                self.history_model.appendRow(mess)
-            else:
-                mess = QStandardItem(f'Исходящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setTextAlignment(Qt.AlignRight)
-                mess.setBackground(QBrush(QColor(204, 255, 204)))
-                self.history_model.appendRow(mess)
+        messages_list, history_key = self.database.get_history_page(self.current_chat)
+        for item in messages_list:
+            self.history_model.appendRow(self.history_item(item))
+        self.history_key = history_key
         self.ui.list_messages.scrollToBottom()
 
+    @pyqtSlot(int)
+    def history_scrolled(self, value):
+        """Load a page of older messages when the messages history is scrolled to the top"""
+        if value != self.ui.list_messages.verticalScrollBar().minimum() or self.history_key is None:
+            return
+
+        messages_list, self.history_key = self.database.get_history_page(self.current_chat, self.history_key)
+        for row, item in enumerate(messages_list):
+            self.history_model.insertRow(row, self.history_item(item))
+
+        # -- Message which was at the top stays in place
+        self.ui.list_messages.scrollTo(self.history_model.index(len(messages_list), 0),
+                                       QAbstractItemView.PositionAtTop)
+
+    @staticmethod
+    def history_item(item):
+        """Messages history item. Add different color and align for users message"""
+        if item[1] == 'in':
+            mess = QStandardItem(f'Входящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
+            mess.setEditable(False)
+            mess.setBackground(QBrush(QColor(255, 213, 213)))
+            mess.setTextAlignment(Qt.AlignLeft)
+        else:
+            status = f' ({MESSAGE_STATUS_TEXT[item[4]]})' if item[4] in MESSAGE_STATUS_TEXT else ''
+            mess = QStandardItem(f'Исходящее от {item[3].replace(microsecond=0)}{status}:\n {item[2]}')
+            mess.setEditable(False)
+            mess.setTextAlignment(Qt.AlignRight)
+            mess.setBackground(QBrush(QColor(204, 255, 204)))
+        return mess
+
     def select_active_user(self):
         """Method handler of double-clicked contact event"""
         self.current_chat = self.ui.list_contacts.currentIndex().data()
@@ -120,15 +135,10 @@ class ClientMainWindow(QMainWindow):
     def set_active_user(self):
         """Set active chat user method"""
         try:
-            self.current_chat_key = self.transport.key_request(
-                self.current_chat)
+            self.current_chat_key = self.transport.get_pubkey(self.current_chat)
             client_logger.debug(f'Public key loaded for "{self.current_chat}"')
-            if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(
-                    RSA.import_key(self.current_chat_key))
         except (OSError, json.JSONDecodeError):
             self.current_chat_key = None
-            self.encryptor = None
             client_logger.debug(f'Can\'t get public key for user "{self.current_chat}"')
 
         # -- Show error message if public key for this user is unavailable -----
@@ -229,28 +239,38 @@ class ClientMainWindow(QMainWindow):
         if not message_text:
             return
 
-        # -- Encrypt message with receiver public key -------------------
-        message_text_encrypted = self.encryptor.encrypt(
-            message_text.encode('utf8'))
-        message_text_encrypted_base64 = base64.b64encode(
-            message_text_encrypted)
+        # -- Encrypt message with the conversation key ------------------
+        payload = self.cipher.encrypt(self.current_chat, self.current_chat_key, message_text)
+
+        # -- Message is saved to the outbox and sent without waiting for the server answer
+        message_id = self.database.save_message(self.current_chat, 'out', message_text, MESSAGE_PENDING, payload)
+        self.history_list_update()
+        self.send_outbox_message(message_id, self.current_chat, payload)
 
+    def send_outbox_message(self, message_id, contact, payload):
+        """Pass a message from the outbox to the transport"""
         try:
-            self.transport.send_message(self.current_chat, message_text_encrypted_base64.decode('ascii'))
-            pass
-        except ServerError as err:
-            self.messages.critical(self, 'Ошибка', err.text)
+            self.transport.send_message(contact, payload, message_id)
         except OSError as err:
-            if err.errno:
-                self.messages.critical(self, 'Ошибка', 'Потеряно соединение с сервером!')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения!')
-        except (ConnectionResetError, ConnectionAbortedError):
-            self.messages.critical(self, 'Ошибка', 'Потеряно соединение с сервером!')
-            self.close()
+            client_logger.error(f'Message for {contact} stays in the outbox: {err}')
+        else:
+            client_logger.debug(f'Message {message_id} queued for {contact}')
+
+    def send_outbox(self):
+        """Send messages which weren't accepted by the server before"""
+        for message_id, contact, payload in self.database.get_outbox():
+            self.send_outbox_message(message_id, contact, payload)
+
+    @pyqtSlot(int, dict)
+    def message_sent(self, message_id, answer):
+        """Server answer to an outgoing message slot"""
+        if answer.get(RESPONSE) == 200:
+            self.database.set_message_status(message_id, MESSAGE_SENT)
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
-            client_logger.debug(f'Message been sent for {self.current_chat}: {message_text}')
+            self.database.set_message_status(message_id, MESSAGE_FAILED)
+            self.messages.warning(self, 'Ошибка', f'Сообщение не доставлено: {answer.get(ERROR)}')
+
+        if self.current_chat:
             self.history_list_update()
 
     @pyqtSlot(dict)
@@ -258,12 +278,9 @@ class ClientMainWindow(QMainWindow):
         """New message receiver slot. Decrypting incoming message.
         Change current chat if message from other client received
         """
-        # -- Getting bytes string --------------
-        encrypted_message = base64.b64decode(message[MESSAGE_TEXT])
-
         # -- Try to decrypt a message ----------
         try:
-            decrypted_message = self.decrypter.decrypt(encrypted_message)
+            decrypted_message = self.cipher.decrypt(message[SENDER], message[MESSAGE_TEXT])
         except (ValueError, TypeError):
             self.messages.warning(
                 self, 'Ошибка', 'Не удалось декодировать сообщение.')
@@ -271,7 +288,7 @@ class ClientMainWindow(QMainWindow):
 
         # -- Save message in db and update messages history or opening a new chat
         self.database.save_message(
-            self.current_chat, 'in', decrypted_message.decode('utf8'))
+            self.current_chat, 'in', decrypted_message)
 
         sender = message[SENDER]
         if sender == self.current_chat:
@@ -299,7 +316,7 @@ class ClientMainWindow(QMainWindow):
                     self.current_chat = sender
                     # -- Need to save message, or it'll be lost. Because in a previous call this client doesn't exist
                     self.database.save_message(
-                        self.current_chat, 'in', decrypted_message.decode('utf8'))
+                        self.current_chat, 'in', decrypted_message)
 
                     self.set_active_user()
 
@@ -320,6 +337,11 @@ class ClientMainWindow(QMainWindow):
                 'К сожалению собеседник был удалён с сервера.')
             self.set_disabled_input()
             self.current_chat = None
+        elif self.current_chat and self.database.check_contact(self.current_chat) and \
+                self.database.get_pubkey(self.current_chat) != self.current_chat_key:
+            # -- Contact's public key is changed, get the new one. Only contacts keys are saved,
+            # -- and the server reports key changes only to the users who have the user in contacts
+            self.set_active_user()
         self.clients_list_update()
 
     def make_connection(self, trans_obj):
@@ -327,3 +349,7 @@ class ClientMainWindow(QMainWindow):
         trans_obj.new_message.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
         trans_obj.message_205.connect(self.sig_205)
+        trans_obj.message_sent.connect(self.message_sent)
+
+        # -- Messages left in the outbox after the last session
+        self.send_outbox()
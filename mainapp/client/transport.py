@@ -1,4 +1,5 @@
 import os
+import queue
 import socket
 import sys
 import time
@@ -8,18 +9,21 @@ import threading
 import hashlib
 import hmac
 import binascii
+import errno
+import itertools
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 from PyQt5.QtCore import pyqtSignal, QObject
 
 sys.path.insert(0, os.path.join(os.getcwd(), '..'))
 
-from common.utils import send_message, get_message
+from common.utils import send_message, get_message, MessageDecoder, key_fingerprint
 from common.variables import *
 from common.errors import ServerError, ReqFieldMissingError
 from common.decorators import Log
 
 client_log = logging.getLogger('client')
-socket_lock = threading.Lock()
 
 
 class ClientTransport(threading.Thread, QObject):
@@ -29,6 +33,7 @@ class ClientTransport(threading.Thread, QObject):
     new_message = pyqtSignal(dict)
     message_205 = pyqtSignal()
     connection_lost = pyqtSignal()
+    message_sent = pyqtSignal(int, dict)  # Outgoing message id and the server answer
 
     def __init__(self, port, ip_address, database, username, passwd, keys):
         # -- Parents constructors call--------------------------
@@ -39,16 +44,28 @@ class ClientTransport(threading.Thread, QObject):
         self.account_name = username
         self.password = passwd
         self.transport = None
+        self.decoder = MessageDecoder()  # Incoming data decoder, switches to framed format after presence
         self.keys = keys
         self.server_address = ip_address
         self.server_port = port
 
+        self.requests = OrderedDict()  # Requests waiting for answers {request_id: Future}
+        self.requests_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.lists_outdated = False  # Server reported changes before the reader thread was started
+
+        # -- Messages are written to the socket by a writer thread in the order they're queued
+        self.outbox = queue.Queue()
+        self.writer = threading.Thread(target=self.write_messages, daemon=True)
+
         self.connection_init()
+        self.writer.start()
 
-        # -- Update tables known users and contacts -------------
+        # -- Update tables known users, contacts and their keys -
         try:
             self.user_list_update()
             self.contacts_list_request()
+            self.keys_request(self.database.get_contacts())
         except OSError as err:
             if err.errno:
                 client_log.critical(f'Server connection lost on update users list stage.')
@@ -67,7 +84,7 @@ class ClientTransport(threading.Thread, QObject):
         client_log.info(f'Starting client transport socket')
 
         # -- Timeout is required to release a socket --------
-        self.transport.settimeout(5)
+        self.transport.settimeout(REQUEST_TIMEOUT)
 
         # -- Try to create connection for 5 tries max -------
         connected = False
@@ -103,33 +120,34 @@ class ClientTransport(threading.Thread, QObject):
         pubkey = self.keys.publickey().export_key().decode('ascii')
 
         # -- Authorizing on the server ---------------------
-        with socket_lock:
-            # -- Try to send a presence message to a server
-            try:
-                client_log.info(f'Starting to send presence message')
-                send_message(self.transport, self.create_presence(pubkey))
-                client_log.info(f'Presence message sent!')
-                answer = get_message(self.transport)
-                client_log.info(f'Getting answer from a server: {answer}')
-
-                # -- If server response an error throw an exceptions ------
-                if RESPONSE in answer:
-                    if answer[RESPONSE] == 400:
-                        raise ServerError(answer[ERROR])
-                    elif answer[RESPONSE] == 511:
-                        # -- If it's ok continue authorization process ----
-                        ans_data = answer[DATA]
-                        hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'), 'MD5')
-                        digest = hash.digest()
-
-                        my_ans = RESPONSE_511
-                        my_ans[DATA] = binascii.b2a_base64(
-                            digest).decode('ascii')
-                        send_message(self.transport, my_ans)
-                        self.process_server_answer(self, get_message(self.transport))
-            except (OSError, json.JSONDecodeError) as err:
-                client_log.debug(f'Connection error.', exc_info=err)
-                raise ServerError('Connection error while client authorization')
+        # -- Try to send a presence message to a server
+        try:
+            client_log.info(f'Starting to send presence message')
+            send_message(self.transport, self.create_presence(pubkey), self.decoder.framed)
+            client_log.info(f'Presence message sent!')
+            answer = get_message(self.transport, self.decoder)
+            client_log.info(f'Getting answer from a server: {answer}')
+
+            # -- If server response an error throw an exceptions ------
+            if RESPONSE in answer:
+                if answer[RESPONSE] == 400:
+                    raise ServerError(answer[ERROR])
+                elif answer[RESPONSE] == 511:
+                    # -- If it's ok continue authorization process ----
+                    # -- Server confirmed length-prefixed messages format
+                    self.decoder.framed = answer.get(FRAMING) == FRAMING_LENGTH
+                    ans_data = answer[DATA]
+                    hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'), 'MD5')
+                    digest = hash.digest()
+
+                    my_ans = dict(RESPONSE_511)
+                    my_ans[DATA] = binascii.b2a_base64(
+                        digest).decode('ascii')
+                    send_message(self.transport, my_ans, self.decoder.framed)
+                    self.process_server_answer(self, get_message(self.transport, self.decoder))
+        except (OSError, json.JSONDecodeError) as err:
+            client_log.debug(f'Connection error.', exc_info=err)
+            raise ServerError('Connection error while client authorization')
 
     def create_presence(self, pubkey):
         """Method to generate a presence dict"""
@@ -140,7 +158,8 @@ class ClientTransport(threading.Thread, QObject):
             USER: {
                 ACCOUNT_NAME: self.account_name,
                 PUBLIC_KEY: pubkey
-            }
+            },
+            FRAMING: FRAMING_LENGTH
         }
 
         client_log.debug(f'Presence message from a user {self.account_name}: {out}')
@@ -165,9 +184,15 @@ class ClientTransport(threading.Thread, QObject):
             elif int(message[RESPONSE]) == 400:
                 raise ServerError(f'400 : {message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_request()
-                self.message_205.emit()
+                if EVENTS in message:
+                    self.apply_events(message[EVENTS])
+                    self.message_205.emit()
+                elif self.is_alive():
+                    # -- Lists are requested by another thread, the reader must go on to receive the answers
+                    threading.Thread(target=self.update_lists, daemon=True).start()
+                else:
+                    # -- Answers are read by the waiting thread until the reader is started
+                    self.lists_outdated = True
             else:
                 client_log.debug(f'Unknown server response code: {message[RESPONSE]}')
         # -- If this message from another user, add it to db
@@ -178,9 +203,101 @@ class ClientTransport(threading.Thread, QObject):
             # -- Send a signal about a new message -------------
             self.new_message.emit(message)
 
+    def request(self, message):
+        """Send a request to the server without waiting for the answer.
+        Returns a future which gets the answer, so many requests can be sent at once
+        """
+        future = Future()
+        # -- Requests are queued in the order they're registered, so answers without ids can be matched
+        with self.requests_lock:
+            request_id = next(self.request_ids)
+            message[REQUEST_ID] = request_id
+            self.requests[request_id] = future
+            self.outbox.put((message, request_id))
+        return future
+
+    def write_messages(self):
+        """Writer thread. Sends queued messages until None is queued"""
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                return
+            message, request_id = item
+            try:
+                send_message(self.transport, message, self.decoder.framed)
+            except OSError as err:
+                client_log.error(f'Message send error: {err}')
+                future = self.pop_request(request_id) if request_id is not None else None
+                if future:
+                    future.set_exception(err)
+
+    def wait_answer(self, future):
+        """Wait for the answer to a request.
+        Until the reader thread is started answers are read by the calling thread.
+        Request is forgotten if there's no answer in time, socket.timeout is raised
+        as if the answer was read from the socket
+        """
+        try:
+            while not self.is_alive() and not future.done():
+                self.dispatch(get_message(self.transport, self.decoder))
+            try:
+                return future.result(REQUEST_TIMEOUT)
+            except FutureTimeoutError:
+                raise socket.timeout('Server answer timeout')
+        finally:
+            if not future.done():
+                self.forget_request(future)
+
+    def dispatch(self, message):
+        """Pass an answer to the request waiting for it, process other server messages"""
+        if RESPONSE in message and message[RESPONSE] != 205:
+            future = self.pop_request(message.get(REQUEST_ID))
+            if future:
+                future.set_result(message)
+            else:
+                client_log.error(f'Answer to an unknown request: {message}')
+        else:
+            self.process_server_answer(self, message)
+
+    def pop_request(self, request_id):
+        """Request waiting for the answer with a given id.
+        Server which doesn't return request ids answers in the order requests were sent
+        """
+        with self.requests_lock:
+            if request_id is not None:
+                return self.requests.pop(request_id, None)
+            if self.requests:
+                return self.requests.popitem(last=False)[1]
+        return None
+
+    def forget_request(self, future):
+        """Stop waiting for the answer to a request"""
+        with self.requests_lock:
+            for request_id, request in self.requests.items():
+                if request is future:
+                    del self.requests[request_id]
+                    break
+
+    def fail_requests(self, error):
+        """Stop waiting for answers after the connection is lost"""
+        with self.requests_lock:
+            futures = list(self.requests.values())
+            self.requests.clear()
+        for future in futures:
+            future.set_exception(error)
+
+    def update_lists(self):
+        """Request known users and contacts lists after the server reported changes"""
+        try:
+            self.user_list_update()
+            self.contacts_list_request()
+        except OSError as err:
+            client_log.error(f'Users lists update error: {err}')
+            return
+        self.message_205.emit()
+
     def contacts_list_request(self):
         """Users list request from server"""
-        self.database.contacts_clear()
         client_log.info(f'Contacts list request for user {self.account_name}')
         request = {
             ACTION: GET_CONTACTS,
@@ -188,17 +305,19 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.account_name
         }
         client_log.debug(f'Request created: {request}')
-        with socket_lock:
-            send_message(self.transport, request)
-            answer = get_message(self.transport)
+        answer = self.wait_answer(self.request(request))
         client_log.debug(f'Answer received: {answer}')
 
-        # -- Add contacts to a contacts table ---------------
-        if RESPONSE in answer and answer[RESPONSE] == 202:
-            for contact in answer[LIST_INFO]:
-                self.database.add_contact(contact)
-        else:
-            client_log.error('Contacts list request failed!')
+        # -- Other threads don't see the contacts table while it's refilled
+        with self.database.lock:
+            self.database.contacts_clear()
+
+            # -- Add contacts to a contacts table ---------------
+            if RESPONSE in answer and answer[RESPONSE] == 202:
+                for contact in answer[LIST_INFO]:
+                    self.database.add_contact(contact)
+            else:
+                client_log.error('Contacts list request failed!')
 
     def user_list_update(self):
         """Update table with known users"""
@@ -206,19 +325,49 @@ class ClientTransport(threading.Thread, QObject):
         request = {
             ACTION: USERS_REQUEST,
             TIME: time.time(),
-            ACCOUNT_NAME: self.account_name
+            ACCOUNT_NAME: self.account_name,
+            VERSION: self.database.get_users_version()
         }
         client_log.debug(f'Known users list request dict: {request}')
-        with socket_lock:
-            client_log.debug(f'Users list params: {self.transport}, {request}')
-            send_message(self.transport, request)
-            answer = get_message(self.transport)
+        answer = self.wait_answer(self.request(request))
 
+        # -- Server sends only changes made after the saved version. Full list is sent without
+        # -- removed users list and by the servers which don't support versions
         if RESPONSE in answer and answer[RESPONSE] == 202:
-            self.database.add_users(answer[LIST_INFO])
+            self.database.update_users(answer[LIST_INFO], answer.get(REMOVED), answer.get(VERSION, 0))
         else:
             client_log.error('Known users list update has failed.')
 
+    def apply_events(self, events):
+        """Apply users list and public keys changes sent by the server without requesting the lists.
+        Saved users list version isn't changed, so the changes are received again with the next update.
+        Saved public key is removed if the user has got another one
+        """
+        added = [event[ACCOUNT_NAME] for event in events if event.get(EVENT) == EVENT_USER_ADDED]
+        removed = [event[ACCOUNT_NAME] for event in events if event.get(EVENT) == EVENT_USER_REMOVED]
+        client_log.debug(f'Users list changes: added {added}, removed {removed}')
+
+        self.database.update_users(added, removed)
+        for contact in removed:
+            self.database.del_contact(contact)
+
+        fingerprints = self.database.get_fingerprints()
+        changed = [event[ACCOUNT_NAME] for event in events if event.get(EVENT) == EVENT_KEY_CHANGED
+                   and fingerprints.get(event[ACCOUNT_NAME], event[FINGERPRINT]) != event[FINGERPRINT]]
+        if removed or changed:
+            client_log.debug(f'Public keys changed: {changed}')
+            self.database.remove_pubkeys(removed + changed)
+
+    def get_pubkey(self, user):
+        """User public key. Key is requested from the server only if it isn't saved
+        or the server has reported that it's changed. Only contacts keys are saved:
+        the server reports key changes to the users who have the user in contacts
+        """
+        pubkey = self.database.get_pubkey(user)
+        if pubkey is None:
+            pubkey = self.key_request(user)
+        return pubkey
+
     def key_request(self, user):
         """Users public key requests form a server method"""
         client_log.debug(f'Public key request for "{user}"')
@@ -227,15 +376,40 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             ACCOUNT_NAME: user
         }
-        with socket_lock:
-            send_message(self.transport, request)
-            answer = get_message(self.transport)
+        answer = self.wait_answer(self.request(request))
 
         if RESPONSE in answer and answer[RESPONSE] == 511:
+            # -- Old servers don't send key fingerprint
+            if self.database.check_contact(user):
+                self.database.save_pubkey(user, answer[DATA],
+                                          answer.get(FINGERPRINT) or key_fingerprint(answer[DATA]))
             return answer[DATA]
         else:
             client_log.error(f'Can\'t get public key for user "{user}"')
 
+    def keys_request(self, users):
+        """Public keys of the users list by one request. Saved keys are replaced with the server ones,
+        keys of the users which have no key anymore are removed
+        """
+        if not users:
+            return
+        client_log.debug(f'Public keys request for {len(users)} users')
+        request = {
+            ACTION: PUBLIC_KEYS_REQUEST,
+            TIME: time.time(),
+            LIST_INFO: list(users)
+        }
+        answer = self.wait_answer(self.request(request))
+
+        # -- Old servers don't support the request, keys are requested by one when chats are opened
+        if RESPONSE in answer and answer[RESPONSE] == 202:
+            keys = {user[ACCOUNT_NAME]: (user[PUBLIC_KEY], user[FINGERPRINT]) for user in answer[LIST_INFO]}
+            self.database.save_pubkeys(keys)
+            self.database.remove_pubkeys([user for user in users if user not in keys])
+            client_log.debug(f'Contacts online: {[user[ACCOUNT_NAME] for user in answer[LIST_INFO] if user[ONLINE]]}')
+        else:
+            client_log.error('Public keys request failed!')
+
     def add_contact(self, contact):
         """Adding user contact to a server"""
         client_log.info(f'Contact adding: {contact}')
@@ -260,25 +434,29 @@ class ClientTransport(threading.Thread, QObject):
             ACCOUNT_NAME: contact
         }
 
-        with socket_lock:
-            send_message(self.transport, request)
-            self.process_server_answer(self, get_message(self.transport))
+        self.process_server_answer(self, self.wait_answer(self.request(request)))
 
     def transport_shutdown(self):
         """Method to close a connection and send an exit message"""
         self.running = False
 
-        with socket_lock:
-            try:
-                send_message(self.transport, self.create_exit_message())
-            except OSError:
-                pass
+        # -- Exit message is sent after all the queued messages
+        self.outbox.put((self.create_exit_message(), None))
+        self.outbox.put(None)
+        self.writer.join(REQUEST_TIMEOUT)
+
         client_log.debug('End of transport job')
+        # -- Wake up the reader thread blocked on the socket
+        try:
+            self.transport.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.transport.close()
-        time.sleep(0.5)
 
-    def send_message(self, to, message):
-        """Method to send a user message to a server"""
+    def send_message(self, to, message, message_id=None):
+        """Method to send a user message to a server. Doesn't wait for the server answer:
+        it's passed to message_sent signal with the message id. Returns the request future
+        """
         client_log.info(f'Sending a message: {message}')
         message_dict = {
             ACTION: MESSAGE,
@@ -289,38 +467,45 @@ class ClientTransport(threading.Thread, QObject):
         }
         client_log.info(f'Sending a dict: {message_dict}')
 
-        # -- Wait for socket release before message been sent ----
-        with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_answer(self, get_message(self.transport))
-            client_log.info(f'Message for user "{to}" has been sent')
+        future = self.request(message_dict)
+        if message_id is not None:
+            future.add_done_callback(lambda done: self.message_answer(message_id, done))
+        return future
+
+    def message_answer(self, message_id, future):
+        """Pass the server answer to the sent message to the window.
+        Message stays in the outbox if there was no answer
+        """
+        if future.exception():
+            client_log.error(f'Message {message_id} isn\'t sent: {future.exception()}')
+            return
+        client_log.info(f'Message {message_id} answer: {future.result()}')
+        self.message_sent.emit(message_id, future.result())
 
     def run(self):
-        """Main thread method. Starts automatically"""
+        """Main thread method. Starts automatically.
+        The only reader of the socket: answers are passed to the waiting requests,
+        messages from other users and server notifications to the signals
+        """
         client_log.debug('Starting messages receiver process')
+        # -- Reader waits for data without a timeout and wakes up as soon as a message arrives.
+        # -- transport_shutdown closes the socket to stop it
+        self.transport.settimeout(None)
+        if self.lists_outdated:
+            self.lists_outdated = False
+            threading.Thread(target=self.update_lists, daemon=True).start()
         while self.running:
-            # -- Wait for 1 second and try to capture a socket ---
-            time.sleep(1)
-            message = None
-            with socket_lock:
-                try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        client_log.critical(f'Server connection lost')
-                        self.running = False
-                        self.connection_lost.emit()
-                # -- Process connection problems -----------------
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError, TypeError):
-                    client_log.debug(f'Server connection lost')
+            try:
+                message = get_message(self.transport, self.decoder)
+            # -- Process connection problems -----------------
+            except (OSError, ValueError, TypeError) as err:
+                if self.running:
+                    client_log.critical(f'Server connection lost: {err}')
                     self.running = False
                     self.connection_lost.emit()
-                finally:
-                    if type(self.transport) == "<class 'socket.socket'>":
-                        self.transport.settimeout(5)
+                self.fail_requests(ConnectionResetError(errno.ECONNRESET, 'Server connection lost'))
+                break
 
             # -- Call handler function if message is received ----
-            if message:
-                client_log.debug(f'Server message received : {message}')
-                self.process_server_answer(self, message)
+            client_log.debug(f'Server message received : {message}')
+            self.dispatch(message)
@@ -3,7 +3,6 @@ import logging
 import os
 import sys
 import re
-import traceback
 import socket
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
@@ -11,28 +10,67 @@ sys.path.append(os.path.join(os.getcwd(), '..'))
 import logs.server_log_config
 import logs.client_log_config
 
+from common.variables import TRACE_LEVEL
+
 
 class Log:
-    """Class - logger decorator. Add information about called method to a log"""
+    """Class - logger decorator. Add information about called method to a log.
+    Nothing is done unless the logger accepts TRACE_LEVEL records, arguments
+    are formatted by the logger only when a record is written.
+    Tracing can be switched off or sampled for every decorated function at runtime
+    """
+    # -- Global tracing switch and decorated functions {function qualified name: Log object}
+    tracing = True
+    registry = {}
+    logger = None
+
     def __init__(self, func):
         functools.update_wrapper(self, func)
         self.func = func
+        self.enabled = True  # Function tracing switch
+        self.sample_rate = 1  # Only every N-th call is logged
+        self.calls = 0
+        Log.registry[func.__qualname__] = self
+
+    @classmethod
+    def get_logger(cls):
+        """Getting logger by the started script name. Name is found once per process"""
+        if cls.logger is None:
+            if not sys.argv or not sys.argv[0]:
+                logger_name = 'app'
+            else:
+                res = re.findall(r'([A-z0-9_-]+)\.py$', sys.argv[0])
+                logger_name = 'app' if not res else res[0]
+            cls.logger = logging.getLogger(logger_name)
+        return cls.logger
+
+    @classmethod
+    def set_tracing(cls, func_name, enabled=True, sample_rate=1):
+        """Switch tracing of the decorated function by its qualified name,
+        e.g. 'MessageProcessor.process_message'
+        """
+        if func_name not in cls.registry:
+            return False
+        cls.registry[func_name].enabled = enabled
+        cls.registry[func_name].sample_rate = max(int(sample_rate), 1)
+        return True
 
     def __call__(self, *args, **kwargs):
         """Adding information about called method to a log file"""
-        pattern = re.compile('([A-z0-9_-]+).py$')
-        if not sys.argv or not sys.argv[0]:
-            logger_name = 'app'
-        else:
-            res = re.findall(pattern, sys.argv[0])
-            logger_name = 'app' if not res else res[0]
-        parent_func_name = traceback.format_stack()[0].strip().split()[-1]
+        log = self.get_logger()
+        if not (Log.tracing and self.enabled and log.isEnabledFor(TRACE_LEVEL)):
+            return self.func(*args, **kwargs)
+
+        self.calls += 1
+        if self.calls % self.sample_rate:
+            return self.func(*args, **kwargs)
+
+        parent_func_name = sys._getframe(1).f_code.co_name
 
         res = self.func(*args, **kwargs)
 
-        log = logging.getLogger(logger_name)
-        log.info(f'"{self.func.__name__}({args}, {kwargs})" function called. Result: {res}')
-        log.info(f'Function {self.func.__name__}() called from function {parent_func_name}')
+        log.log(TRACE_LEVEL, '"%s(%s, %s)" function called. Result: %s', self.func.__name__, args, kwargs, res)
+        log.log(TRACE_LEVEL, 'Function %s() called from function %s', self.func.__name__, parent_func_name)
 
         return res
 
@@ -50,10 +88,9 @@ def login_required(func):
             found = False
             for arg in args:
                 if isinstance(arg, socket.socket):
-                    # -- Checking if a client in a MessageProcessor clients_names list
-                    for client in args[0].clients_names:
-                        if args[0].clients_names[client] == arg:
-                            found = True
+                    # -- Checking if a client socket belongs to an authorized user
+                    if args[0].connections.is_authorized(arg):
+                        found = True
 
             # -- Checking that a message not a presence --------
             for arg in args:
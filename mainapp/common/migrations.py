@@ -0,0 +1,58 @@
+import logging
+import os
+import sys
+
+from sqlalchemy import event, text
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+app_log = logging.getLogger('app')
+
+
+def set_pragmas(engine, pragmas):
+    """Execute SQLite pragmas for every new database connection"""
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def get_version(connection):
+    """Getting database schema version"""
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+def add_column(table, column):
+    """Migration step adding a column if the table doesn't have it yet.
+    Column is a column definition: 'name TYPE'
+    """
+    def step(connection):
+        columns = [row[1] for row in connection.execute(text(f'PRAGMA table_info({table})'))]
+        if column.split()[0] not in columns:
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column}'))
+    return step
+
+
+def migrate(engine, migrations):
+    """Upgrade database schema in place.
+    Migrations is a list of SQL statements lists, schema version is a number of applied migrations.
+    sqlite3 module doesn't run DDL statements in a transaction, so they must be safe
+    to repeat (CREATE ... IF NOT EXISTS). A statement can be a function called with the connection,
+    for the changes SQLite can't repeat safely (see add_column)
+    """
+    with engine.connect() as connection:
+        version = get_version(connection)
+
+    for number, statements in enumerate(migrations[version:], version + 1):
+        with engine.begin() as connection:
+            for statement in statements:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.execute(text(statement))
+            connection.execute(text(f'PRAGMA user_version={number}'))
+        app_log.info(f'Database {engine.url.database} upgraded to version {number}')
+        version = number
+    return version
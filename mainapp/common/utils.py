@@ -1,24 +1,28 @@
+import errno
+import hashlib
 import json
 import os
+import struct
 import sys
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
-from common.variables import MAX_PACKAGE_LENGTH, ENCODING, MESSAGE, TIME, ACTION, ACCOUNT_NAME, MESSAGE_TEXT, USER
+from common.variables import MAX_PACKAGE_LENGTH, ENCODING, MESSAGE, TIME, ACTION, ACCOUNT_NAME, MESSAGE_TEXT, USER, \
+    RECEIVE_CHUNK_SIZE, MAX_FRAME_LENGTH
 from common.decorators import Log
 
 from common.errors import NonDictInputError
 
+# -- Frame header: message body length as 4 bytes unsigned int in network byte order
+FRAME_HEADER = struct.Struct('!I')
 
-@Log
-def get_message(client):
-    """ Function receives and decodes incoming message.
-    Receives bytes, returns a dict. Return an ValueError
-    exception in other cases
+
+def decode_message(encoded_response):
+    """Decodes bytes received from a socket to a message dict.
+    Raises ValueError if it's not a JSON dict
     """
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
     if isinstance(encoded_response, bytes):
         json_response = encoded_response.decode(ENCODING)
         if isinstance(json_response, str):
@@ -30,17 +34,112 @@ def get_message(client):
     raise ValueError
 
 
-@Log
-def send_message(sock, message):
-    """Function to encode and send message to a recipient.
-    Converts a dict to a string, then make from it bytes and send it to recipient
+def encode_message(message, framed=False):
+    """Encodes message dict to bytes ready to be sent.
+    Adds a length header if framed format is used
     """
     if not isinstance(message, dict):
         raise NonDictInputError
 
     js_message = json.dumps(message)
     encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    if framed:
+        return FRAME_HEADER.pack(len(encoded_message)) + encoded_message
+    return encoded_message
+
+
+class MessageDecoder:
+    """Incremental per-connection messages decoder.
+    Collects received bytes and returns complete messages. Works with length-prefixed
+    frames or, for old clients, with JSON dicts written one after another
+    """
+    def __init__(self, framed=False):
+        self.framed = framed
+        self.buffer = bytearray()
+        self.pending = deque()  # Decoded messages which were not requested yet by get_message
+
+    def feed(self, data):
+        """Adds received bytes to a buffer and returns a list of complete messages"""
+        self.buffer += data
+        if self.framed:
+            return self.decode_frames()
+        return self.decode_stream()
+
+    def decode_frames(self):
+        """Splits buffer into length-prefixed messages"""
+        messages = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.buffer)
+            if length > MAX_FRAME_LENGTH:
+                raise ValueError(f'Message length {length} exceeds maximum {MAX_FRAME_LENGTH}')
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            messages.append(decode_message(bytes(self.buffer[FRAME_HEADER.size:end])))
+            del self.buffer[:end]
+        return messages
+
+    def decode_stream(self):
+        """Splits buffer into JSON dicts sent without any header"""
+        messages = []
+        try:
+            text = self.buffer.decode(ENCODING)
+        except UnicodeDecodeError as err:
+            # -- Last character could be received partially -----
+            if err.end != len(self.buffer):
+                raise ValueError(err)
+            text = self.buffer[:err.start].decode(ENCODING)
+
+        json_decoder = json.JSONDecoder()
+        position = 0
+        while position < len(text):
+            if text[position].isspace():
+                position += 1
+                continue
+            try:
+                message, position = json_decoder.raw_decode(text, position)
+            except json.JSONDecodeError:
+                # -- Message can be incomplete only if it looks like a dict beginning
+                if text[position] != '{' or len(self.buffer) > MAX_FRAME_LENGTH:
+                    raise
+                break
+            if not isinstance(message, dict):
+                raise ValueError
+            messages.append(message)
+
+        del self.buffer[:len(text[:position].encode(ENCODING))]
+        return messages
+
+
+@Log
+def get_message(client, decoder=None):
+    """ Function receives and decodes incoming message.
+    Receives bytes, returns a dict. Return an ValueError
+    exception in other cases. With a decoder reads socket
+    until a complete message is received
+    """
+    if decoder is None:
+        return decode_message(client.recv(MAX_PACKAGE_LENGTH))
+
+    while not decoder.pending:
+        data = client.recv(RECEIVE_CHUNK_SIZE)
+        if not data:
+            raise ConnectionResetError(errno.ECONNRESET, 'Connection closed by remote host')
+        decoder.pending.extend(decoder.feed(data))
+    return decoder.pending.popleft()
+
+
+@Log
+def send_message(sock, message, framed=False):
+    """Function to encode and send message to a recipient.
+    Converts a dict to a string, then make from it bytes and send it to recipient
+    """
+    sock.sendall(encode_message(message, framed))
+
+
+def key_fingerprint(pubkey):
+    """Public key fingerprint: SHA-256 hex digest of the key in PEM format"""
+    return hashlib.sha256(pubkey.encode(ENCODING)).hexdigest()
 
 
 @Log
@@ -1,5 +1,6 @@
 """Константы"""
 import logging
+import os
 
 # Порт по умолчанию для сетевого взаимодействия
 DEFAULT_PORT = 7777
@@ -9,13 +10,62 @@ DEFAULT_IP_ADDRESS = '127.0.0.1'
 MAX_CONNECTIONS = 5
 # Максимальная длинна сообщения в байтах
 MAX_PACKAGE_LENGTH = 1024
+# Размер блока данных, читаемого из сокета за один раз потоковым декодером
+RECEIVE_CHUNK_SIZE = 65536
+# Максимальная длина сообщения в формате с заголовком длины
+MAX_FRAME_LENGTH = 1024 * 1024
 # Кодировка проекта
 ENCODING = 'utf-8'
+# Профили настроек логирования. Записи пишутся в файлы отдельным потоком через очередь:
+# level - уровень логирования, queue_size - размер очереди записей (лишние записи отбрасываются),
+# batch_size - сколько записей пишется в файл перед сбросом буфера на диск
+LOG_PROFILES = {
+    'development': {'level': logging.DEBUG, 'queue_size': 10000, 'batch_size': 100},
+    'production': {'level': logging.INFO, 'queue_size': 100000, 'batch_size': 1000},
+}
+# Текущий профиль логирования, задаётся переменной окружения MESSENGER_LOG_PROFILE
+LOG_PROFILE = os.environ.get('MESSENGER_LOG_PROFILE', 'development')
+if LOG_PROFILE not in LOG_PROFILES:
+    LOG_PROFILE = 'development'
 # Текущий уровень логирования
-LOGGING_LEVEL = logging.DEBUG
+LOGGING_LEVEL = LOG_PROFILES[LOG_PROFILE]['level']
+# Уровень записей о вызовах функций, отмеченных декоратором Log
+TRACE_LEVEL = logging.DEBUG
 
 SERVER_CONFIG = 'server.ini'
 
+# Движки ожидания событий сервера:
+# select - опрос всех сокетов в цикле, selectors - epoll/kqueue через модуль selectors
+SERVER_ENGINES = ('select', 'selectors')
+DEFAULT_SERVER_ENGINE = 'select'
+# Таймаут ожидания событий селектора (сек.), нужен для проверки флага остановки сервера
+SELECTOR_TIMEOUT = 0.5
+# Асинхронный сервер на asyncio
+ASYNC_SERVER_ENGINE = 'asyncio'
+# Очередь входящих подключений асинхронного сервера
+ASYNC_BACKLOG = 1024
+# Время ожидания ответа клиента при авторизации (сек.)
+AUTH_TIMEOUT = 5
+# Размер исходящего буфера соединения (байт), после которого сервер перестаёт читать запросы клиента
+OUTBOUND_HIGH_WATER = 256 * 1024
+# Размер исходящего буфера соединения (байт), после которого медленный клиент отключается
+OUTBOUND_BUFFER_LIMIT = 4 * 1024 * 1024
+# Время ожидания клиентом ответа сервера на запрос (сек.)
+REQUEST_TIMEOUT = 5
+# Статусы исходящих сообщений клиента: ожидает отправки, принято сервером, отклонено сервером
+MESSAGE_PENDING = 'pending'
+MESSAGE_SENT = 'sent'
+MESSAGE_FAILED = 'failed'
+# Количество сообщений истории переписки, загружаемых клиентом за один раз
+MESSAGES_PAGE_SIZE = 50
+# Шифрование сообщений: у каждой переписки свой ключ AES-GCM (байт), передаваемый зашифрованным RSA.
+# Ключ заменяется после указанного количества сообщений или по истечении времени (сек.)
+SESSION_KEY_SIZE = 32
+SESSION_KEY_MESSAGES = 1000
+SESSION_KEY_LIFETIME = 24 * 60 * 60
+# Количество расшифрованных ключей собеседников, хранимых клиентом в памяти
+SESSION_KEYS_CACHE_SIZE = 1000
+
 # Протокол JIM основные ключи:
 ACTION = 'action'
 TIME = 'time'
@@ -29,12 +79,35 @@ REMOVE_CONTACT = 'remove_contact'
 LIST_INFO = 'list'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+# Идентификатор запроса клиента, сервер возвращает его в ответе на запрос
+REQUEST_ID = 'id'
+# Версия списка известных пользователей, клиент получает только изменения после неё
+VERSION = 'version'
+# Пользователи, удалённые после указанной версии списка
+REMOVED = 'removed'
+# Список событий в ответе 205: изменения списка пользователей, которые клиент применяет без запросов к серверу
+EVENTS = 'events'
+EVENT = 'event'
+EVENT_USER_ADDED = 'user_added'
+EVENT_USER_REMOVED = 'user_removed'
+# Пользователь сменил публичный ключ, клиенты удаляют сохранённый ключ с другим отпечатком
+EVENT_KEY_CHANGED = 'key_changed'
+# Отпечаток публичного ключа: SHA-256 ключа в формате PEM
+FINGERPRINT = 'fingerprint'
+# Пользователь подключен к серверу
+ONLINE = 'online'
+# Формат передачи сообщений, согласуется при отправке presence
+FRAMING = 'framing'
+# Сообщение передаётся с 4-х байтовым заголовком длины
+FRAMING_LENGTH = 'length'
 
 # Прочие ключи, используемые в протоколе
 PRESENCE = 'presence'
 RESPONSE = 'response'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+# Публичные ключи и состояние списка пользователей одним запросом
+PUBLIC_KEYS_REQUEST = 'pubkeys_need'
 ERROR = 'error'
 MESSAGE = 'message'
 MESSAGE_TEXT = 'text'
@@ -43,6 +116,36 @@ EXIT = 'exit'
 
 # БД
 SERVER_DATABASE = 'db.sqlite'
+# Максимальное количество сообщений в очереди пользователя, не подключенного к серверу
+OFFLINE_QUEUE_LIMIT = 1000
+# Время хранения сообщения в очереди (сек.)
+OFFLINE_MESSAGE_TTL = 7 * 24 * 60 * 60
+# Количество сообщений из очереди, отправляемых пользователю за один раз
+OFFLINE_BATCH_SIZE = 100
+# Количество пользователей в кэше сервера (id, хэш пароля, публичный ключ)
+IDENTITY_CACHE_SIZE = 10000
+# Статистика сообщений пользователей сохраняется в базу не реже, чем раз в указанное время (сек.)
+STATS_FLUSH_INTERVAL = 5
+# или после указанного количества сообщений
+STATS_FLUSH_SIZE = 1000
+# Максимальное количество изменений базы данных сервера, сохраняемых одной транзакцией
+DB_WRITER_BATCH_SIZE = 500
+# Интервал сохранения списка активных пользователей в базу данных (сек.), 0 - не сохранять.
+# Список хранится сервером в памяти, сохранённая копия показывает, кто был в сети при сбое сервера
+ACTIVE_USERS_SAVE_INTERVAL = 0
+# Количество строк таблиц статистики и истории входов, читаемых из базы за один запрос
+HISTORY_PAGE_SIZE = 100
+# Изменения списка пользователей, сделанные за указанное время (сек.), отправляются клиентам одним уведомлением
+NOTIFY_DELAY = 0.5
+# Настройки SQLite для базы данных сервера: журнал WAL не блокирует чтение во время записи,
+# synchronous=NORMAL в режиме WAL не теряет целостность при сбое
+SERVER_DATABASE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
+}
 
 RESPONSE_200 = {RESPONSE: 200}
 
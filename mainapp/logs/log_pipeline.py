@@ -0,0 +1,148 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+from logging import handlers
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from common.variables import LOG_PROFILES, LOG_PROFILE
+
+
+class DroppingQueueHandler(handlers.QueueHandler):
+    """Handler which puts log records to the writer queue without waiting.
+    Records are dropped and counted if the queue is full
+    """
+    def __init__(self, log_queue, targets):
+        super().__init__(log_queue)
+        self.targets = targets  # Handlers which write records of the logger
+        self.dropped = 0
+
+    def format(self, record):
+        """Only message text is made in the caller thread, because arguments objects
+        can be changed later. All the other formatting work is done by the writer thread
+        """
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        message = record.getMessage()
+        if record.exc_text:
+            message = f'{message}\n{record.exc_text}'
+        return message
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait((self.targets, record))
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(threading.Thread):
+    """Background thread which takes records from the queue and writes them by batches.
+    Every handler stream is flushed once per batch
+    """
+    def __init__(self, log_queue, batch_size):
+        super().__init__(name='log_writer', daemon=True)
+        self.queue = log_queue
+        self.batch_size = batch_size
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            self.write([item for item in batch if item is not None])
+            if stop:
+                return
+
+    @staticmethod
+    def write(batch):
+        """Write records of a batch by the target handlers"""
+        streams = dict()  # Handlers with the records texts {handler: [text, ...]}
+        for targets, record in batch:
+            for handler in targets:
+                if record.levelno < handler.level or not handler.filter(record):
+                    continue
+                if not isinstance(handler, logging.StreamHandler):
+                    handler.handle(record)
+                    continue
+                if isinstance(handler, handlers.BaseRotatingHandler) and handler.shouldRollover(record):
+                    LogWriter.flush(handler, streams.pop(handler, []))
+                    handler.acquire()
+                    try:
+                        handler.doRollover()
+                    finally:
+                        handler.release()
+                try:
+                    streams.setdefault(handler, []).append(handler.format(record) + handler.terminator)
+                except Exception:
+                    handler.handleError(record)
+
+        for handler, lines in streams.items():
+            LogWriter.flush(handler, lines)
+
+    @staticmethod
+    def flush(handler, lines):
+        """Write texts to the handler stream and flush it"""
+        if not lines:
+            return
+        handler.acquire()
+        try:
+            if handler.stream is None:
+                handler.stream = handler._open()
+            handler.stream.write(''.join(lines))
+            handler.flush()
+        except Exception:
+            handler.handleError(None)
+        finally:
+            handler.release()
+
+
+class LogPipeline:
+    """Queue shared by all the loggers of a process and the writer thread"""
+    def __init__(self, profile=LOG_PROFILE):
+        self.profile = LOG_PROFILES[profile]
+        self.queue = queue.Queue(self.profile['queue_size'])
+        self.queue_handlers = dict()  # Loggers queue handlers {logger_name: DroppingQueueHandler}
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def attach(self, logger, *targets):
+        """Make a logger put its records to the queue. Records are written by target handlers"""
+        queue_handler = DroppingQueueHandler(self.queue, targets)
+        logger.addHandler(queue_handler)
+        self.queue_handlers[logger.name] = queue_handler
+        with self.lock:
+            if self.writer is None:
+                self.writer = LogWriter(self.queue, self.profile['batch_size'])
+                self.writer.start()
+                atexit.register(self.stop)
+        return queue_handler
+
+    def dropped(self):
+        """Number of dropped records {logger_name: records}"""
+        return {name: queue_handler.dropped for name, queue_handler in self.queue_handlers.items()}
+
+    def stop(self, timeout=5):
+        """Write all the queued records and stop the writer thread"""
+        with self.lock:
+            writer, self.writer = self.writer, None
+        if writer is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        writer.join(timeout)
+        for name, dropped in self.dropped().items():
+            if dropped:
+                sys.stderr.write(f'Logger "{name}" dropped {dropped} records: log queue was full\n')
+
+
+pipeline = LogPipeline()
@@ -2,6 +2,7 @@ import configparser
 import logging
 import os
 import sys
+import threading
 
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QApplication
@@ -10,9 +11,13 @@ sys.path.append(os.path.join(os.getcwd(), '..'))
 
 from server.db import Storage
 from server.core import MessageProcessor
+from server.async_core import AsyncMessageProcessor
+from server.cluster import ClusterServer, cluster_supported
+from server.active_users import ActiveUsersSaver
 from server.main_window import MainWindow
 
-from common.variables import DEFAULT_IP_ADDRESS, DEFAULT_PORT
+from common.variables import DEFAULT_IP_ADDRESS, DEFAULT_PORT, DEFAULT_SERVER_ENGINE, ASYNC_SERVER_ENGINE, \
+    SELECTOR_TIMEOUT, ACTIVE_USERS_SAVE_INTERVAL
 from common.utils import get_params
 
 from common.decorators import Log
@@ -34,6 +39,8 @@ def config_load():
             'Database_file': '',
             'Default_port': '',
             'Listen_Address': '',
+            'Engine': '',
+            'Workers': '',
         }
 
     return config
@@ -63,6 +70,22 @@ def main():
         except KeyError:
             listen_address = DEFAULT_IP_ADDRESS
 
+    # -- Server events engine: "select", "selectors" or "asyncio" -
+    try:
+        engine = params['engine']
+    except KeyError:
+        engine = config['SETTINGS'].get('Engine') or DEFAULT_SERVER_ENGINE
+
+    # -- Worker processes count. More than one starts the cluster mode
+    try:
+        workers = params['workers']
+    except KeyError:
+        workers = config['SETTINGS'].get('Workers') or '1'
+    workers = int(workers) if str(workers).isdigit() else 1
+    if workers > 1 and not cluster_supported():
+        server_log.warning('Cluster mode requires SO_REUSEPORT and Unix sockets, starting one worker')
+        workers = 1
+
     # -- Create database object ----------------------------------
     try:
         db_path = config['SETTINGS']['Database_path']
@@ -79,10 +102,22 @@ def main():
     ))
 
     # -- Start server background process ------------------------
-    server = MessageProcessor(db, listen_address, listen_port)
-    server.daemon = True
+    if workers > 1:
+        server = ClusterServer(os.path.join(db_path, db_file), listen_address, listen_port, workers)
+    elif engine == ASYNC_SERVER_ENGINE:
+        server = AsyncMessageProcessor(db, listen_address, listen_port)
+        server.daemon = True
+    else:
+        server = MessageProcessor(db, listen_address, listen_port, engine)
+        server.daemon = True
     server.start()
 
+    # -- Active users are kept in memory, saving them to db is optional
+    saver = None
+    if ACTIVE_USERS_SAVE_INTERVAL:
+        saver = ActiveUsersSaver(server, db, ACTIVE_USERS_SAVE_INTERVAL)
+        saver.start()
+
     # -- Creating server user interface ---------------------
     server_app = QApplication(sys.argv)
     server_app.setAttribute(Qt.AA_DisableWindowContextHelpButton)
@@ -93,6 +128,13 @@ def main():
 
     # -- Stop event handler when all windows are closed -----
     server.running = False
+    if saver:
+        saver.stop()
+    if isinstance(server, threading.Thread):
+        server.join(SELECTOR_TIMEOUT * 4)
+
+    # -- Save data which isn't written yet ------------------
+    db.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+import datetime
+import logging
+import os
+import sys
+import threading
+from collections import namedtuple
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+server_log = logging.getLogger('server')
+
+ActiveUser = namedtuple('ActiveUser', ('name', 'ipaddress', 'port', 'login_time'))
+
+# -- Active users list events
+USER_ADDED = 'added'
+USER_REMOVED = 'removed'
+
+
+class ActiveUsers:
+    """Registry of the logged in users owned by the server.
+    Changed by the server thread, snapshots can be taken from any thread.
+    Subscribers are called on every change, so nobody has to poll the list
+    """
+    def __init__(self):
+        self.users = dict()  # Logged in users {client_name: ActiveUser}
+        self.lock = threading.Lock()
+        self.subscribers = []  # Callbacks called as callback(event, ActiveUser)
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, name):
+        return name in self.users
+
+    def add(self, name, ipaddress, port):
+        """Save user login information"""
+        user = ActiveUser(name, ipaddress, port, datetime.datetime.now())
+        with self.lock:
+            self.users[name] = user
+        self.notify(USER_ADDED, user)
+        return user
+
+    def get(self, name):
+        """Getting login information of the user or None"""
+        return self.users.get(name)
+
+    def remove(self, name):
+        """Remove user who logged out"""
+        with self.lock:
+            user = self.users.pop(name, None)
+        if user:
+            self.notify(USER_REMOVED, user)
+
+    def snapshot(self):
+        """Copy of the logged in users list ordered by login time"""
+        with self.lock:
+            users = list(self.users.values())
+        return sorted(users, key=lambda user: user.login_time)
+
+    def subscribe(self, callback):
+        """Call callback(event, user) on every change. Callback is called by the server thread"""
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def notify(self, event, user):
+        """Pass a change to all the subscribers"""
+        for callback in list(self.subscribers):
+            try:
+                callback(event, user)
+            except Exception as error:
+                server_log.error(f'Active users subscriber error: {error}')
+
+
+class ActiveUsersSaver(threading.Thread):
+    """Thread which saves active users list of the server to the database from time to time.
+    Saved list shows who was online if the server process crashed
+    """
+    def __init__(self, server, db, interval):
+        super().__init__(name='active_users_saver', daemon=True)
+        self.server = server
+        self.db = db
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.db.save_active_users(self.server.active_users_list())
+            except Exception as error:
+                server_log.error(f'Active users saving error: {error}')
+
+    def stop(self):
+        self.stopped.set()
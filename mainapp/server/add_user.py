@@ -85,12 +85,12 @@ class RegisterUser(QDialog):
                 'sha512', passwd_bytes, salt, 10000)
             self.db.add_user(
                 self.client_name.text(),
-                binascii.hexlify(passwd_hash))
+                binascii.hexlify(passwd_hash)).result()
             self.messages.information(
                 self, 'Успех', 'Пользователь успешно зарегистрирован.')
 
             # -- Send a signal to a clients to update users list -----
-            self.server.service_update_lists()
+            self.server.notify_users_changed(added=[self.client_name.text()])
             self.close()
 
 
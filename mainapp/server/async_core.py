@@ -0,0 +1,405 @@
+import sys
+import threading
+import logging
+import asyncio
+import socket
+import hmac
+import binascii
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from common.variables import *
+
+from common.metaclass import ServerVerifier
+from common.descriptors import CheckPort
+from common.utils import encode_message, MessageDecoder, key_fingerprint
+from server.active_users import ActiveUsers
+from server.notifications import Notifier, client_events
+
+server_log = logging.getLogger('server')
+
+
+class AsyncMessageProcessor(threading.Thread, metaclass=ServerVerifier):
+    listen_port = CheckPort()
+
+    """Asyncio version of the client-server interface.
+    Every client connection is served by a coroutine, so one thread can hold thousands
+    of long-lived connections. Storage calls run in a separate thread to keep the event loop free
+    """
+    def __init__(self, db, address, port):
+        self.listen_address = address
+        self.listen_port = port
+
+        self.clients_names = dict()  # Client names with stream writers {client_name: writer}
+        self.writers_names = dict()  # Names of the authorized clients by their stream writers {writer: client_name}
+        self.decoders = dict()  # Incoming data decoders {writer: MessageDecoder}
+        # -- Clients getting messages stored while they were offline {writer: new messages stored meanwhile}.
+        # -- New messages to them are stored too, so they keep the order
+        self.offline_delivery = dict()
+        self.active_users = ActiveUsers()  # Logged in users information for the server window
+        self.notifier = Notifier()  # Users list changes waiting to be sent to the clients
+
+        self.db = db
+        # -- Storage uses one session, so all db calls are made in one thread
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+
+        self.loop = None
+
+        self.running = True
+
+        super().__init__()
+
+    async def db_call(self, func, *args):
+        """Run Storage method in the db thread and wait for its result"""
+        return await self.loop.run_in_executor(self.db_executor, func, *args)
+
+    async def db_write(self, func, *args):
+        """Run Storage change method in the db thread and wait until the change is committed"""
+        return await asyncio.wrap_future(await self.db_call(func, *args))
+
+    def send(self, writer, message):
+        """Put a message to the client's stream buffer without waiting.
+        Slow client is disconnected if its buffer is overflowed
+        """
+        if writer.is_closing():
+            raise ConnectionResetError('Client stream is closed')
+        writer.write(encode_message(message, self.decoders[writer].framed))
+        if writer.transport.get_write_buffer_size() > OUTBOUND_BUFFER_LIMIT:
+            raise ConnectionAbortedError('Outbound buffer overflow, client is too slow')
+
+    async def reply(self, writer, message, request=None):
+        """Send a response to a client and wait until it's written.
+        Id of the request is returned to the client with the response
+        """
+        if request and REQUEST_ID in request:
+            message = dict(message)
+            message[REQUEST_ID] = request[REQUEST_ID]
+        self.send(writer, message)
+        await writer.drain()
+
+    async def read_message(self, reader, decoder):
+        """Read a complete message from a client stream"""
+        while not decoder.pending:
+            data = await reader.read(RECEIVE_CHUNK_SIZE)
+            if not data:
+                raise ConnectionResetError('Client closed the connection')
+            decoder.pending.extend(decoder.feed(data))
+        return decoder.pending.popleft()
+
+    async def handle_client(self, reader, writer):
+        """Client connection handler coroutine. Authorize a client and process its messages"""
+        client_address = writer.get_extra_info('peername')
+        server_log.info(f'New client connected from \'{client_address}\'')
+        decoder = self.decoders[writer] = MessageDecoder()
+        # -- drain() waits while client doesn't read its answers, so its requests aren't read either
+        writer.transport.set_write_buffer_limits(high=OUTBOUND_HIGH_WATER)
+        try:
+            name = await self.authorize_user(await self.read_message(reader, decoder), reader, writer)
+
+            while name and self.running:
+                message = await self.read_message(reader, decoder)
+                server_log.debug(f'Client message processing : {message}')
+                if not await self.process_client_message(message, name, writer):
+                    break
+        except (ValueError, OSError, asyncio.TimeoutError) as error:
+            server_log.error(f'Client "{client_address}" message error: {error}.')
+        finally:
+            self.drop_client(writer)
+
+    async def authorize_user(self, message, reader, writer):
+        """Authorize user coroutine. Returns username if authorization was successful"""
+        if not (ACTION in message and message[ACTION] == PRESENCE and TIME in message
+                and USER in message and ACCOUNT_NAME in message[USER]):
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Bad Request'
+            await self.reply(writer, response)
+            return None
+
+        name = message[USER][ACCOUNT_NAME]
+        server_log.debug(f'Start auth process for {name}')
+        if name in self.clients_names:
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Имя пользователя уже занято.'
+            await self.reply(writer, response)
+            return None
+
+        # -- Check if client already registered at server ---------------
+        if not await self.db_call(self.db.check_user, name):
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Пользователь не зарегистрирован.'
+            await self.reply(writer, response)
+            return None
+
+        # -- Starting authentication process -------------------------
+        message_auth = dict(RESPONSE_511)
+        random_str = binascii.hexlify(os.urandom(64))
+        message_auth[DATA] = random_str.decode('ascii')
+        digest = hmac.new(await self.db_call(self.db.get_hash, name), random_str, 'MD5').digest()
+
+        # -- Confirm length-prefixed format if client supports it. The challenge itself
+        # -- is sent in an old format, all the next messages are framed
+        framed = message.get(FRAMING) == FRAMING_LENGTH
+        if framed:
+            message_auth[FRAMING] = FRAMING_LENGTH
+
+        await self.reply(writer, message_auth)
+        self.decoders[writer].framed = framed
+        answer = await asyncio.wait_for(self.read_message(reader, self.decoders[writer]), AUTH_TIMEOUT)
+
+        if not (RESPONSE in answer and answer[RESPONSE] == 511 and DATA in answer
+                and hmac.compare_digest(digest, binascii.a2b_base64(answer[DATA]))):
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Неверный пароль.'
+            await self.reply(writer, response)
+            return None
+
+        # -- Name could be taken while waiting for the client answer
+        if name in self.clients_names:
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Имя пользователя уже занято.'
+            await self.reply(writer, response)
+            return None
+
+        self.clients_names[name] = writer
+        self.writers_names[writer] = name
+        self.offline_delivery[writer] = 0
+        client_ip, client_port = writer.get_extra_info('peername')[:2]
+        await self.reply(writer, RESPONSE_200)
+        self.active_users.add(name, client_ip, client_port)
+
+        # -- Save login history and public key if it's new
+        pubkey = message[USER].get(PUBLIC_KEY)
+        old_key = await self.db_call(self.db.get_pubkey, name)
+        await self.db_call(self.db.user_login, name, client_ip, client_port, pubkey)
+        if old_key and pubkey and old_key != pubkey:
+            # -- Users who have the user in contacts are told about the new key when it's saved
+            fingerprint = key_fingerprint(pubkey)
+            owners = await self.db_call(self.db.get_contact_owners, name, False)
+            owners.add_done_callback(lambda done: self.notify_key_changed(name, fingerprint, done.result()))
+
+        # -- Send messages received while user was offline
+        await self.send_offline_messages(name, writer)
+        return name
+
+    async def send_offline_messages(self, name, writer):
+        """Send messages stored for the user while he was offline.
+        Messages are taken from db by batches in the order they were received
+        and removed when they are written to the socket
+        """
+        last_id = 0
+        # -- drain() waits until the whole buffer is written
+        writer.transport.set_write_buffer_limits(high=0)
+        try:
+            while writer in self.offline_delivery:
+                requested = self.offline_delivery[writer]
+                messages = await self.db_write(self.db.get_offline_messages, name, last_id, OFFLINE_BATCH_SIZE)
+                for message_id, message in messages:
+                    self.send(writer, message)
+                    last_id = message_id
+                await writer.drain()
+                if messages:
+                    await self.db_call(self.db.remove_offline_messages, name, last_id)
+                server_log.info(f'{len(messages)} offline messages sent to a user "{name}"')
+
+                # -- Messages stored after the batch was requested could be missed by it
+                if len(messages) < OFFLINE_BATCH_SIZE and self.offline_delivery.get(writer) == requested:
+                    break
+        finally:
+            self.offline_delivery.pop(writer, None)
+            if not writer.is_closing():
+                writer.transport.set_write_buffer_limits(high=OUTBOUND_HIGH_WATER)
+
+    async def process_client_message(self, message, name, writer):
+        """Client message processor coroutine. Same actions as MessageProcessor has.
+        Returns False if client connection must be closed
+        """
+        if not (ACTION in message and TIME in message):
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Bad Request'
+            await self.reply(writer, response, message)
+            return True
+
+        action = message[ACTION]
+        if action == MESSAGE and DESTINATION in message and SENDER in message and MESSAGE_TEXT in message \
+                and message[SENDER] == name:
+            # -- Try to send message to a destination user ------------
+            writer_to = self.clients_names.get(message[DESTINATION])
+            if writer_to is not None and writer_to not in self.offline_delivery:
+                self.process_message(message)
+                await self.db_call(self.db.process_message, message[SENDER], message[DESTINATION])
+                await self.reply(writer, RESPONSE_200, message)
+            # -- Save message for the registered user who is offline or is getting stored messages
+            elif await self.store_message(message):
+                await self.db_call(self.db.process_message, message[SENDER], message[DESTINATION])
+                await self.reply(writer, RESPONSE_200, message)
+            else:
+                response = dict(RESPONSE_400)
+                if await self.db_call(self.db.check_user, message[DESTINATION]):
+                    response[ERROR] = 'Очередь сообщений пользователя переполнена.'
+                else:
+                    response[ERROR] = 'User not registered!'
+                await self.reply(writer, response, message)
+
+        elif action == EXIT and message.get(ACCOUNT_NAME) == name:
+            # -- Client exit the chat ---------------------------------
+            return False
+
+        # -- Contacts list request ----------------------------
+        elif action == GET_CONTACTS and message.get(USER) == name:
+            response = dict(RESPONSE_202)
+            response[LIST_INFO] = await self.db_call(self.db.get_contacts, name)
+            await self.reply(writer, response, message)
+
+        # -- New contact adding ------------------------------
+        elif action == ADD_CONTACT and ACCOUNT_NAME in message and message.get(USER) == name:
+            await self.db_call(self.db.add_contact, name, message[ACCOUNT_NAME])
+            await self.reply(writer, RESPONSE_200, message)
+
+        # -- Deleting contact -------------------------------
+        elif action == REMOVE_CONTACT and ACCOUNT_NAME in message and message.get(USER) == name:
+            await self.db_call(self.db.remove_contact, name, message[ACCOUNT_NAME])
+            await self.reply(writer, RESPONSE_200, message)
+
+        # -- Known users request ---------------------------
+        elif action == USERS_REQUEST and message.get(ACCOUNT_NAME) == name:
+            version, added, removed = await self.db_call(self.db.users_changes, message.get(VERSION))
+            response = dict(RESPONSE_202)
+            response[LIST_INFO] = added
+            response[VERSION] = version
+            # -- Clients without version get the full list
+            if removed is not None:
+                response[REMOVED] = removed
+            await self.reply(writer, response, message)
+
+        # -- Public key request -----------------------------------------
+        elif action == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
+            pubkey = await self.db_call(self.db.get_pubkey, message[ACCOUNT_NAME])
+            if pubkey:
+                response = dict(RESPONSE_511)
+                response[DATA] = pubkey
+                response[FINGERPRINT] = key_fingerprint(pubkey)
+            else:
+                response = dict(RESPONSE_400)
+                response[ERROR] = 'Нет публичного ключа для данного пользователя'
+            await self.reply(writer, response, message)
+
+        # -- Public keys and presence of the users list -----------------
+        elif action == PUBLIC_KEYS_REQUEST and isinstance(message.get(LIST_INFO), list):
+            keys = await self.db_call(self.db.get_pubkeys, message[LIST_INFO])
+            response = dict(RESPONSE_202)
+            response[LIST_INFO] = [
+                {ACCOUNT_NAME: name, PUBLIC_KEY: pubkey, FINGERPRINT: key_fingerprint(pubkey),
+                 ONLINE: name in self.clients_names}
+                for name, pubkey in keys.items()
+            ]
+            await self.reply(writer, response, message)
+
+        # -- Else sending Bad request message -----------------------
+        else:
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Bad Request'
+            await self.reply(writer, response, message)
+
+        return True
+
+    async def store_message(self, message):
+        """Save a message for the user who is offline. Returns False if it isn't saved"""
+        writer = self.clients_names.get(message[DESTINATION])
+        if writer in self.offline_delivery:
+            self.offline_delivery[writer] += 1
+        return await self.db_write(self.db.store_message, message[DESTINATION], message)
+
+    def process_message(self, message):
+        """Send a message to the destination user"""
+        writer = self.clients_names[message[DESTINATION]]
+        try:
+            self.send(writer, message)
+        except OSError:
+            server_log.error(f'Connection with client "{message[DESTINATION]}" is lost!')
+            self.drop_client(writer)
+        else:
+            server_log.info(f'Message sent to a user "{message[DESTINATION]}" from user "{message[SENDER]}"')
+
+    def drop_client(self, writer):
+        """Remove client from the clients list and close its stream. Works in the loop thread"""
+        name = self.writers_names.pop(writer, None)
+        if name is not None:
+            del self.clients_names[name]
+            self.active_users.remove(name)
+            server_log.info(f'Client "{name}" is disconnected')
+        self.decoders.pop(writer, None)
+        self.offline_delivery.pop(writer, None)
+        if not writer.is_closing():
+            writer.close()
+
+    def active_users_list(self):
+        """Logged in users list [(name, ipaddress, port, login_time), ...]. Can be called from any thread"""
+        return self.active_users.snapshot()
+
+    def subscribe_active_users(self, callback):
+        """Call callback(event, user) on every login and logout. Callback is called by the server thread"""
+        self.active_users.subscribe(callback)
+
+    def buffer_stats(self):
+        """Outbound buffers sizes of authorized clients {client_name: bytes}"""
+        return {name: writer.transport.get_write_buffer_size()
+                for name, writer in list(self.clients_names.items())}
+
+    def disconnect_user(self, name):
+        """Close connection of the user with a given name. Can be called from any thread"""
+        writer = self.clients_names.get(name)
+        if writer:
+            self.remove_client(writer)
+
+    def remove_client(self, writer):
+        """Remove client from the clients list. Can be called from any thread"""
+        self.loop.call_soon_threadsafe(self.drop_client, writer)
+
+    def notify_users_changed(self, added=(), removed=()):
+        """Send registered users list changes to the clients. Can be called from any thread"""
+        self.notifier.users_changed(added, removed)
+
+    def notify_key_changed(self, name, fingerprint, recipients):
+        """Send user public key change to the recipients. Can be called from any thread"""
+        self.notifier.key_changed(name, fingerprint, recipients)
+
+    def send_notifications(self):
+        """Send coalesced users list changes to all clients with a 205 response. Works in the loop thread"""
+        events, recipients = self.notifier.take_with_recipients()
+        if not events:
+            return
+        for name, writer in list(self.clients_names.items()):
+            events_list = client_events(events, recipients, name)
+            if not events_list:
+                continue
+            response = dict(RESPONSE_205)
+            response[EVENTS] = events_list
+            try:
+                self.send(writer, response)
+            except OSError:
+                self.drop_client(writer)
+
+    async def serve(self):
+        """Start listening and serve clients while running flag is set"""
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(
+            self.handle_client, self.listen_address or None, self.listen_port,
+            family=socket.AF_INET, reuse_address=True, backlog=ASYNC_BACKLOG)
+        server_log.info(f'Asyncio server started at {self.listen_address}:{self.listen_port}')
+
+        async with server:
+            while self.running:
+                await asyncio.sleep(SELECTOR_TIMEOUT)
+                self.send_notifications()
+
+        for writer in list(self.clients_names.values()):
+            self.drop_client(writer)
+
+    def run(self):
+        """Main Thread method. Runs the event loop until the server is stopped"""
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.db_executor.shutdown(wait=True)
@@ -0,0 +1,411 @@
+import sys
+import os
+import json
+import datetime
+import logging
+import selectors
+import socket
+import tempfile
+import threading
+import multiprocessing
+from collections import deque
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from common.variables import *
+
+from common.utils import encode_message, decode_message
+from common.decorators import Log
+from common.descriptors import CheckPort
+from server.core import MessageProcessor
+from server.db import Storage
+from server.active_users import ActiveUsers, ActiveUser, USER_ADDED, USER_REMOVED
+
+server_log = logging.getLogger('server')
+
+# -- Bus messages types -----------------------------------------
+BUS_ACTION = 'bus'
+BUS_DELIVER = 'deliver'  # Deliver a message to a user connected to the worker
+BUS_DISCONNECT = 'disconnect'  # Close connection of a user and forget its cached data
+BUS_UPDATE = 'update'  # Send users list and public keys changes to all the worker clients
+BUS_PRESENCE = 'presence'  # User logged in or out, sent by workers to the server process
+BUS_STOP = 'stop'  # Stop the worker
+BUS_EVENT = 'event'
+BUS_RECIPIENTS = 'recipients'  # Users who get public key changes {client_name: [names]}
+
+
+def cluster_supported():
+    """Check if OS supports sockets required for the cluster mode"""
+    return hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'AF_UNIX')
+
+
+def get_bus_paths(port, workers):
+    """Unix sockets paths of the workers bus"""
+    return [os.path.join(tempfile.gettempdir(), f'messenger_{port}_{worker_id}.sock')
+            for worker_id in range(workers)]
+
+
+def get_server_bus_path(port):
+    """Unix socket path of the server process, workers send users presence events to it"""
+    return os.path.join(tempfile.gettempdir(), f'messenger_{port}_server.sock')
+
+
+def send_bus_message(bus, path, message):
+    """Send a message to the worker bus socket"""
+    try:
+        bus.sendto(encode_message(message), path)
+    except OSError as err:
+        server_log.error(f'Can\'t send a message to the worker bus "{path}": {err}')
+        return False
+    return True
+
+
+# -- Server worker process. All workers listen to the same port with SO_REUSEPORT
+# -- and own their connections. Messages to users of other workers are sent
+# -- through Unix datagram sockets bus. Shared directory keeps users workers and login information.
+# -- No class docstring: ServerVerifier metaclass disassembles all class attributes
+class ClusterWorker(MessageProcessor):
+    def __init__(self, db, address, port, worker_id, bus_paths, directory):
+        super().__init__(db, address, port, 'selectors')
+
+        self.worker_id = worker_id
+        self.bus_paths = bus_paths
+        self.server_bus_path = get_server_bus_path(port)
+        self.directory = directory  # Users presence directory {client_name: (worker_id, ipaddress, port, login_time)}
+        self.bus = None
+        self.bus_queues = dict()  # Bus messages waiting while the receiver's queue is full {path: deque of data}
+
+    def init_socket(self):
+        """Init listening socket shared by all workers and worker's bus socket"""
+        server_log.info(f'Worker {self.worker_id} started at {self.listen_address}:{self.listen_port}')
+
+        transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        transport.bind((self.listen_address, self.listen_port))
+        self.sock = transport
+        self.sock.listen(ASYNC_BACKLOG)
+
+        bus_path = self.bus_paths[self.worker_id]
+        if os.path.exists(bus_path):
+            os.unlink(bus_path)
+        self.bus = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.bus.bind(bus_path)
+        self.bus.setblocking(False)
+
+    def init_selector(self):
+        """Register the bus socket in the selector too"""
+        super().init_selector()
+        self.selector.register(self.bus, selectors.EVENT_READ, self.read_bus)
+
+    def is_user_online(self, name):
+        """Check if user is connected to this or any other worker"""
+        return self.connections.get_by_name(name) is not None or name in self.directory
+
+    def claim_name(self, name, address):
+        """Reserve a user name in the presence directory. Manager's setdefault is atomic,
+        so two workers can't authorize the same user at once
+        """
+        if self.connections.get_by_name(name) is not None:
+            return False
+        entry = (self.worker_id, *address[:2], datetime.datetime.now())
+        return self.directory.setdefault(name, entry) == entry
+
+    def user_connected(self, name):
+        """Save user in the presence directory"""
+        user = self.active_users.get(name)
+        self.directory[name] = (self.worker_id, user.ipaddress, user.port, user.login_time)
+        self.send_presence(USER_ADDED, user)
+
+    def user_disconnected(self, name):
+        """Remove user from the presence directory"""
+        user = self.directory.get(name)
+        if user and user[0] == self.worker_id:
+            del self.directory[name]
+            self.send_presence(USER_REMOVED, ActiveUser(name, *user[1:]))
+
+    def send_bus(self, path, message):
+        """Send a bus message. Messages are queued while the receiver's queue is full
+        and are sent by the server cycle in the same order
+        """
+        data = encode_message(message)
+        queue = self.bus_queues.get(path)
+        if queue:
+            queue.append(data)
+            return
+        try:
+            self.bus.sendto(data, path)
+        except BlockingIOError:
+            self.bus_queues[path] = deque([data])
+        except OSError as err:
+            server_log.error(f'Can\'t send a message to the worker bus "{path}": {err}')
+
+    def flush_bus(self):
+        """Send queued bus messages until receivers' queues are full again"""
+        for path, queue in list(self.bus_queues.items()):
+            while queue:
+                try:
+                    self.bus.sendto(queue[0], path)
+                except BlockingIOError:
+                    break
+                except OSError as err:
+                    server_log.error(f'Can\'t send a message to the worker bus "{path}": {err}')
+                    queue.clear()
+                else:
+                    queue.popleft()
+            if not queue:
+                del self.bus_queues[path]
+
+    def flush_pending(self):
+        """Send queued bus messages too"""
+        self.flush_bus()
+        super().flush_pending()
+
+    def select_timeout(self):
+        """Retry queued bus messages soon"""
+        return SELECTOR_TIMEOUT / 50 if self.bus_queues else SELECTOR_TIMEOUT
+
+    def send_presence(self, event, user):
+        """Tell the server process that the user logged in or out"""
+        self.send_bus(self.server_bus_path, {
+            BUS_ACTION: BUS_PRESENCE,
+            BUS_EVENT: event,
+            USER: [user.name, user.ipaddress, user.port, user.login_time.isoformat()]
+        })
+
+    @Log
+    def process_message(self, message):
+        """Send a message to a local user or to the worker which holds the destination user"""
+        if self.connections.get_by_name(message[DESTINATION]):
+            MessageProcessor.process_message(self, message)
+            return
+
+        user = self.directory.get(message[DESTINATION])
+        if user is None:
+            # -- User has logged out after the message was received
+            self.store_message(None, message)
+            return
+
+        worker_id = user[0]
+
+        self.send_bus(self.bus_paths[worker_id], {BUS_ACTION: BUS_DELIVER, MESSAGE: message})
+        server_log.info(f'Message for a user "{message[DESTINATION]}" routed to worker {worker_id}')
+
+    def read_bus(self):
+        """Process all messages received from the bus"""
+        while True:
+            try:
+                data = self.bus.recv(MAX_FRAME_LENGTH)
+            except BlockingIOError:
+                return
+
+            try:
+                bus_message = decode_message(data)
+            except (ValueError, json.JSONDecodeError) as err:
+                server_log.error(f'Wrong bus message: {err}')
+                continue
+
+            if bus_message.get(BUS_ACTION) == BUS_DELIVER:
+                message = bus_message[MESSAGE]
+                connection = self.connections.get_by_name(message[DESTINATION])
+                if connection and not self.is_delivering_offline(message[DESTINATION]):
+                    self.send_to(connection.sock, message)
+                elif connection:
+                    # -- Stored messages are sent to the user first
+                    self.store_message(None, message)
+                else:
+                    # -- User has left this worker while the message was routed
+                    server_log.info(f'User "{message[DESTINATION]}" isn\'t connected to worker {self.worker_id}, '
+                                    f'message is saved')
+                    self.store_message(None, message)
+            elif bus_message.get(BUS_ACTION) == BUS_DISCONNECT:
+                # -- User could be removed by the server administrator
+                self.db.identities.discard(bus_message[ACCOUNT_NAME])
+                self.disconnect_user(bus_message[ACCOUNT_NAME])
+            elif bus_message.get(BUS_ACTION) == BUS_UPDATE:
+                self.notify_users_changed(bus_message.get(LIST_INFO, []), bus_message.get(REMOVED, []))
+                for name, fingerprint in bus_message.get(FINGERPRINT, {}).items():
+                    # -- Cached identity keeps the old public key
+                    self.db.identities.discard(name)
+                    self.notifier.key_changed(name, fingerprint, bus_message.get(BUS_RECIPIENTS, {}).get(name, []))
+            elif bus_message.get(BUS_ACTION) == BUS_STOP:
+                self.running = False
+
+    def notify_key_changed(self, name, fingerprint, recipients):
+        """Send user public key change to the recipients connected to all the workers.
+        Called by the database writer, bus messages are sent by the server cycle
+        """
+        bus_message = {BUS_ACTION: BUS_UPDATE, FINGERPRINT: {name: fingerprint}, BUS_RECIPIENTS: {name: recipients}}
+        for path in self.bus_paths:
+            self.call_soon(self.send_bus, path, bus_message)
+
+    def run(self):
+        """Worker cycle. Removes the bus socket file when the worker is stopped"""
+        try:
+            super().run()
+        finally:
+            if self.bus:
+                self.bus.close()
+                if os.path.exists(self.bus_paths[self.worker_id]):
+                    os.unlink(self.bus_paths[self.worker_id])
+
+
+def run_worker(worker_id, db_path, address, port, bus_paths, directory):
+    """Worker process function. Worker is stopped by a bus message"""
+    worker = ClusterWorker(Storage(db_path), address, port, worker_id, bus_paths, directory)
+    try:
+        worker.run()
+    finally:
+        worker.db.close()
+
+
+class ClusterServer:
+    """Multi-process server. Starts worker processes and gives the server window
+    the same interface MessageProcessor has
+    """
+    listen_port = CheckPort()
+
+    def __init__(self, db_path, address, port, workers):
+        self.db_path = db_path
+        self.listen_address = address
+        self.listen_port = port
+        self.workers = workers
+
+        self.bus_paths = get_bus_paths(self.listen_port, workers)
+        self.processes = []
+        self.manager = None
+        self.directory = None
+        self.stopping = False
+
+        # -- Socket to send control messages to the workers and to receive users presence events
+        self.bus = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.bus_path = get_server_bus_path(self.listen_port)
+        self.bus_reader = None
+        self.dead_workers = set()  # Ids of the crashed workers, their users are removed from the directory
+        self.active_users = ActiveUsers()  # Subscribers of the workers presence events
+
+    def start(self):
+        """Start worker processes"""
+        if os.path.exists(self.bus_path):
+            os.unlink(self.bus_path)
+        self.bus.bind(self.bus_path)
+        self.bus.settimeout(SELECTOR_TIMEOUT)
+        self.bus_reader = threading.Thread(target=self.read_bus, daemon=True)
+        self.bus_reader.start()
+
+        context = multiprocessing.get_context('spawn')
+        self.manager = context.Manager()
+        self.directory = self.manager.dict()
+
+        for worker_id in range(self.workers):
+            process = context.Process(
+                target=run_worker,
+                args=(worker_id, self.db_path, self.listen_address, self.listen_port,
+                      self.bus_paths, self.directory),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+        server_log.info(f'Cluster of {self.workers} workers started at {self.listen_address}:{self.listen_port}')
+
+    def stop(self):
+        """Stop worker processes and wait for them"""
+        # -- Bus messages are used instead of a shared event: a crashed worker could leave its lock acquired
+        self.stopping = True
+        for path in self.bus_paths:
+            send_bus_message(self.bus, path, {BUS_ACTION: BUS_STOP})
+        for process in self.processes:
+            process.join(SELECTOR_TIMEOUT * 4)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        if self.manager:
+            self.manager.shutdown()
+            self.manager = None
+        self.bus.close()
+        if os.path.exists(self.bus_path):
+            os.unlink(self.bus_path)
+
+    def read_bus(self):
+        """Bus reader thread. Passes workers presence events to the subscribers"""
+        while self.bus.fileno() != -1:
+            self.purge_dead_workers()
+            try:
+                bus_message = decode_message(self.bus.recv(MAX_FRAME_LENGTH))
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            except (ValueError, json.JSONDecodeError) as err:
+                server_log.error(f'Wrong bus message: {err}')
+                continue
+
+            if bus_message.get(BUS_ACTION) == BUS_PRESENCE:
+                name, ipaddress, port, login_time = bus_message[USER]
+                user = ActiveUser(name, ipaddress, port, datetime.datetime.fromisoformat(login_time))
+                self.active_users.notify(bus_message[BUS_EVENT], user)
+
+    def purge_dead_workers(self):
+        """Remove users of the crashed worker processes from the presence directory,
+        so they can login again
+        """
+        if self.stopping or self.directory is None:
+            return
+
+        for worker_id, process in enumerate(list(self.processes)):
+            if worker_id in self.dead_workers or process.is_alive():
+                continue
+            self.dead_workers.add(worker_id)
+            server_log.error(f'Worker {worker_id} is stopped with exit code {process.exitcode}')
+
+            for name, user in self.directory_items():
+                if user[0] == worker_id:
+                    self.directory.pop(name, None)
+                    self.active_users.notify(USER_REMOVED, ActiveUser(name, *user[1:]))
+
+    @property
+    def running(self):
+        return any(process.is_alive() for process in self.processes)
+
+    @running.setter
+    def running(self, value):
+        if not value:
+            self.stop()
+
+    @property
+    def clients_names(self):
+        """Connected users {client_name: worker_id}"""
+        return {name: user[0] for name, user in self.directory_items()}
+
+    def directory_items(self):
+        """Copy of the presence directory items"""
+        return list(dict(self.directory).items()) if self.directory is not None else []
+
+    def active_users_list(self):
+        """Logged in users list of all the workers [(name, ipaddress, port, login_time), ...]"""
+        users = [(name, *user[1:]) for name, user in self.directory_items()]
+        return sorted(users, key=lambda user: user[3])
+
+    def subscribe_active_users(self, callback):
+        """Call callback(event, user) on every login and logout. Callback is called by the bus reader thread"""
+        self.active_users.subscribe(callback)
+
+    def is_user_online(self, name):
+        """Check if user is connected to any worker"""
+        return name in self.clients_names
+
+    def disconnect_user(self, name):
+        """Ask the worker which holds a user to close its connection.
+        All the workers drop user data from their storage caches
+        """
+        for path in self.bus_paths:
+            send_bus_message(self.bus, path, {BUS_ACTION: BUS_DISCONNECT, ACCOUNT_NAME: name})
+
+    def notify_users_changed(self, added=(), removed=()):
+        """Ask all the workers to send users list changes to their clients"""
+        bus_message = {BUS_ACTION: BUS_UPDATE, LIST_INFO: list(added), REMOVED: list(removed)}
+        for path in self.bus_paths:
+            send_bus_message(self.bus, path, bus_message)
+
+    def buffer_stats(self):
+        """Outbound buffers are owned by the worker processes"""
+        return {}
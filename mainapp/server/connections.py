@@ -0,0 +1,110 @@
+import sys
+import os
+from collections import deque
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from common.utils import MessageDecoder
+
+
+class OfflineDelivery:
+    """Delivery state of the messages stored while user was offline. Stored messages are removed
+    when they are written to the socket, new messages are stored too until delivery is finished
+    """
+    __slots__ = ('active', 'last_id', 'stored', 'requested', 'marks')
+
+    def __init__(self):
+        self.active = True
+        self.last_id = 0  # Id of the last stored message put to the outbound buffer
+        self.stored = 0  # New messages stored while delivery is active
+        self.requested = 0  # Value of the stored counter when the last batch was requested
+        self.marks = deque()  # Stored messages in the outbound buffer [(stream_offset_of_its_end, message_id), ...]
+
+
+class Connection:
+    """Client connection state: socket, user name after authorization, authorization challenge,
+    incoming data decoder, outbound buffer, offline messages delivery and traffic counters
+    """
+    __slots__ = ('sock', 'fileno', 'address', 'name', 'auth', 'decoder', 'out_buffer', 'offline',
+                 'messages_in', 'messages_out', 'bytes_in', 'bytes_out')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.fileno = sock.fileno()  # Socket fileno is -1 after it's closed, so it's saved once
+        self.address = address
+        self.name = None
+        self.auth = None  # Presence message, expected digest and answer deadline while password is checked
+        self.decoder = MessageDecoder()
+        self.out_buffer = bytearray()  # Outbound data waiting to be written
+        self.offline = None  # OfflineDelivery after authorization
+
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __repr__(self):
+        return f'<Connection {self.name or "-"} {self.address}>'
+
+
+class ConnectionRegistry:
+    """Client connections indexed by socket fileno and by user name of authorized clients.
+    All lookups, authorization and removal take constant time
+    """
+    def __init__(self):
+        self.by_fileno = dict()  # All the connections {socket_fileno: Connection}
+        self.by_name = dict()  # Authorized connections {client_name: Connection}
+
+    def __len__(self):
+        return len(self.by_fileno)
+
+    def __iter__(self):
+        return iter(list(self.by_fileno.values()))
+
+    def __contains__(self, sock):
+        return self.get(sock) is not None
+
+    def add(self, sock, address):
+        """Register new client socket"""
+        connection = Connection(sock, address)
+        self.by_fileno[connection.fileno] = connection
+        return connection
+
+    def get(self, sock):
+        """Connection of the client socket or None if it's not registered"""
+        connection = self.by_fileno.get(sock.fileno())
+        if connection is None or connection.sock is not sock:
+            return None
+        return connection
+
+    def get_by_name(self, name):
+        """Connection of the authorized user or None if user isn't connected"""
+        return self.by_name.get(name)
+
+    def authorize(self, connection, name):
+        """Bind user name to the connection"""
+        if connection.name is not None and self.by_name.get(connection.name) is connection:
+            del self.by_name[connection.name]
+        connection.name = name
+        self.by_name[name] = connection
+
+    def is_authorized(self, sock, name=None):
+        """Check if socket belongs to an authorized user. If name is given it must be the user's name"""
+        connection = self.get(sock)
+        if connection is None or connection.name is None:
+            return False
+        return name is None or connection.name == name
+
+    def remove(self, sock):
+        """Remove connection of the client socket. Returns removed connection or None"""
+        connection = self.get(sock)
+        if connection is None:
+            return None
+        del self.by_fileno[connection.fileno]
+        if connection.name is not None and self.by_name.get(connection.name) is connection:
+            del self.by_name[connection.name]
+        return connection
+
+    def names(self):
+        """Names of authorized users"""
+        return list(self.by_name)
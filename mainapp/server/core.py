@@ -1,11 +1,14 @@
 import sys
 import threading
+import time
 import logging
 import select
+import selectors
 import socket
 import hmac
 import binascii
 import os
+from collections import deque
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
@@ -13,8 +16,11 @@ from common.variables import *
 
 from common.metaclass import ServerVerifier
 from common.descriptors import CheckPort
-from common.utils import send_message, get_message
+from common.utils import send_message, encode_message, key_fingerprint
 from common.decorators import login_required, Log
+from server.connections import ConnectionRegistry, OfflineDelivery
+from server.active_users import ActiveUsers
+from server.notifications import Notifier, client_events
 
 server_log = logging.getLogger('server')
 
@@ -23,15 +29,31 @@ class MessageProcessor(threading.Thread, metaclass=ServerVerifier):
     listen_port = CheckPort()
 
     """Class to work with clients messages. Client-server interface"""
-    def __init__(self, db, address, port):
+    def __init__(self, db, address, port, engine=DEFAULT_SERVER_ENGINE):
         self.listen_address = address
         self.listen_port = port
 
-        self.clients_list = []  # Client sockets list
-        self.clients_names = dict()  # Client names with sockets {client_name: client_socket}
+        if engine not in SERVER_ENGINES:
+            server_log.warning(f'Unknown server engine "{engine}", using "{DEFAULT_SERVER_ENGINE}"')
+            engine = DEFAULT_SERVER_ENGINE
+        self.engine = engine
+        self.selector = None  # Selector object for the "selectors" engine
+
+        self.connections = ConnectionRegistry()  # Client connections indexed by socket and user name
+        self.active_users = ActiveUsers()  # Logged in users information for the server window
         self.messages_list = []  # Messages from all clients
 
-        self.listen_sockets = None
+        self.pending_writes = set()  # Sockets with not empty outbound buffers
+        self.slow_clients = set()  # Sockets to be disconnected because of outbound buffer overflow
+        self.offline_pending = set()  # Sockets of clients waiting for the rest of offline messages
+        self.authorizing = set()  # Sockets of clients which haven't answered the password challenge yet
+        self.notifier = Notifier()  # Users list changes waiting to be sent to the clients
+
+        # -- Functions called by the server cycle for other threads [(func, args), ...].
+        # -- Server cycle is woken up by a byte written to the wakeup socket
+        self.callbacks = deque()
+        self.wakeup_reader = None
+        self.wakeup_writer = None
 
         self.db = db
 
@@ -45,7 +67,7 @@ class MessageProcessor(threading.Thread, metaclass=ServerVerifier):
     def process_client_message(self, message, client):
         """Client message processor. Try to send message from a sender to receiver user if it's ok.
         Processing service messages: contacts list request, client exit request, adding new contact
-        request, deleting contact request, known users request, public key request.
+        request, deleting contact request, known users request, public key request, public keys list request.
         If it's not - return "Bad request" response dict or close connection with this client
         """
 
@@ -53,201 +75,354 @@ class MessageProcessor(threading.Thread, metaclass=ServerVerifier):
 
         if ACTION in message and TIME in message and \
                 message[ACTION] in \
-                [PRESENCE, MESSAGE, EXIT, GET_CONTACTS, ADD_CONTACT, REMOVE_CONTACT, USERS_REQUEST, PUBLIC_KEY_REQUEST]:
+                [PRESENCE, MESSAGE, EXIT, GET_CONTACTS, ADD_CONTACT, REMOVE_CONTACT, USERS_REQUEST, PUBLIC_KEY_REQUEST,
+                 PUBLIC_KEYS_REQUEST]:
             if message[ACTION] in PRESENCE and USER in message and ACCOUNT_NAME in message[USER]:
                 # -- If this is a presence message authorize user ---------
                 self.authorize_user(message, client)
 
             elif DESTINATION in message and SENDER in message and MESSAGE_TEXT in message \
-                    and self.clients_names[message[SENDER]] == client:
+                    and self.connections.is_authorized(client, message[SENDER]):
                 # -- Try to send message to a destination user ------------
-                if message[DESTINATION] in self.clients_names:
+                if self.is_user_online(message[DESTINATION]) and not self.is_delivering_offline(message[DESTINATION]):
                     self.db.process_message(message[SENDER], message[DESTINATION])
                     self.process_message(self, message)
-                    try:
-                        send_message(client, RESPONSE_200)
-                    except OSError:
-                        self.remove_client(client)
+                    self.reply(client, RESPONSE_200, message)
+                # -- Save message for the registered user who is offline or is getting stored messages
                 else:
-                    response = RESPONSE_400
-                    response['ERROR'] = 'User not registered!'
-                    try:
-                        send_message(client, response)
-                    except OSError:
-                        pass
+                    self.store_message(client, message)
 
             elif message[ACTION] in EXIT and ACCOUNT_NAME in message and\
-                    self.clients_names[message[ACCOUNT_NAME]] == client:
+                    self.connections.is_authorized(client, message[ACCOUNT_NAME]):
                 # -- Close client socket if client exit the chat ---------
                 self.remove_client(client)
 
             # -- Contacts list request ----------------------------
             elif message[ACTION] == GET_CONTACTS and USER in message and \
-                    self.clients_names[message[USER]] == client:
-                response = RESPONSE_202
-                response[LIST_INFO] = self.db.get_contacts(message[USER])
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
+                    self.connections.is_authorized(client, message[USER]):
+                self.when_done(self.db.get_contacts(message[USER], wait=False), self.contacts_read, client, message)
 
             # -- New contact adding ------------------------------
             elif message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                    and self.clients_names[message[USER]] == client:
+                    and self.connections.is_authorized(client, message[USER]):
                 self.db.add_contact(message[USER], message[ACCOUNT_NAME])
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
+                self.reply(client, RESPONSE_200, message)
 
             # -- Deleting contact -------------------------------
             elif message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                    and self.clients_names[message[USER]] == client:
+                    and self.connections.is_authorized(client, message[USER]):
                 self.db.remove_contact(message[USER], message[ACCOUNT_NAME])
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
+                self.reply(client, RESPONSE_200, message)
 
             # -- Known users request ---------------------------
             elif message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message and \
-                    self.clients_names[message[ACCOUNT_NAME]] == client:
-                response = RESPONSE_202
-                response[LIST_INFO] = [user[0] for user in self.db.users_list()]
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
+                    self.connections.is_authorized(client, message[ACCOUNT_NAME]):
+                version, added, removed = self.db.users_changes(message.get(VERSION))
+                response = dict(RESPONSE_202)
+                response[LIST_INFO] = added
+                response[VERSION] = version
+                # -- Clients without version get the full list
+                if removed is not None:
+                    response[REMOVED] = removed
+                self.reply(client, response, message)
 
             # -- Public key request -----------------------------------------
             elif message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-                response = RESPONSE_511
+                response = dict(RESPONSE_511)
                 response[DATA] = self.db.get_pubkey(message[ACCOUNT_NAME])
 
                 if response[DATA]:
-                    try:
-                        send_message(client, response)
-                    except OSError:
-                        self.remove_client(client)
+                    response[FINGERPRINT] = key_fingerprint(response[DATA])
+                    self.reply(client, response, message)
                 else:
-                    response = RESPONSE_400
+                    response = dict(RESPONSE_400)
                     response[ERROR] = 'Нет публичного ключа для данного пользователя'
-                    try:
-                        send_message(client, response)
-                    except OSError:
-                        self.remove_client(client)
+                    self.reply(client, response, message)
+
+            # -- Public keys and presence of the users list -----------------
+            elif message[ACTION] == PUBLIC_KEYS_REQUEST and isinstance(message.get(LIST_INFO), list):
+                response = dict(RESPONSE_202)
+                response[LIST_INFO] = [
+                    {ACCOUNT_NAME: name, PUBLIC_KEY: pubkey, FINGERPRINT: key_fingerprint(pubkey),
+                     ONLINE: self.is_user_online(name)}
+                    for name, pubkey in self.db.get_pubkeys(message[LIST_INFO]).items()
+                ]
+                self.reply(client, response, message)
 
             # -- Else sending Bad request message -----------------------
             else:
-                response = RESPONSE_400
+                response = dict(RESPONSE_400)
                 response[ERROR] = 'Bad Request'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
+                self.reply(client, response, message)
 
     @Log
     def process_message(self, message):
         """ Function try to send a message by destinations name """
-        if message[DESTINATION] in self.clients_names and self.clients_names[message[DESTINATION]] in self.listen_sockets:
-            # -- Send message to the client with DESTINATION account name -------------------------------
-            try:
-                send_message(self.clients_names[message[DESTINATION]], message)
-            except OSError:
-                self.remove_client(message[DESTINATION])
-
+        connection = self.connections.get_by_name(message[DESTINATION])
+        if connection:
+            # -- Put message to the outbound buffer of the client with DESTINATION account name ---------
+            self.send_to(connection.sock, message)
             server_log.info(f'Message sent to a user "{message[DESTINATION]}" from user "{message[SENDER]}"')
-        elif message[DESTINATION] in self.clients_names and \
-                self.clients_names[message[DESTINATION]] not in self.listen_sockets:
-            # -- There's now socket for DESTINATION account name ----------------------------------------
-            server_log.error(
-                f'Connection with client "{message[DESTINATION]}" is lost!')
-            self.remove_client(self.clients_names[message[DESTINATION]])
         else:
             server_log.error(f'There\'s no user with "{message[DESTINATION]}" account name')
 
+    def store_message(self, client, message):
+        """Save a message for the user who is offline. Sender gets an answer when the message is saved"""
+        connection = self.connections.get_by_name(message[DESTINATION])
+        if connection is not None and connection.offline is not None:
+            connection.offline.stored += 1
+        self.when_done(self.db.store_message(message[DESTINATION], message), self.message_stored, client, message)
+
+    def message_stored(self, client, message, future):
+        """Answer to the sender of a message saved for the offline user"""
+        try:
+            stored = future.result()
+        except Exception as error:
+            server_log.error(f'Message for a user "{message[DESTINATION]}" isn\'t saved: {error}')
+            stored = False
+
+        if client is None:
+            # -- Message is routed by another worker, its sender has got the answer already
+            if not stored:
+                server_log.error(f'Message for a user "{message[DESTINATION]}" is lost')
+            return
+
+        if stored:
+            self.db.process_message(message[SENDER], message[DESTINATION])
+            self.reply(client, RESPONSE_200, message)
+        else:
+            response = dict(RESPONSE_400)
+            if self.db.check_user(message[DESTINATION]):
+                response[ERROR] = 'Очередь сообщений пользователя переполнена.'
+            else:
+                response[ERROR] = 'User not registered!'
+            self.reply(client, response, message)
+
+    def contacts_read(self, client, message, future):
+        """Answer to the contacts list request"""
+        response = dict(RESPONSE_202)
+        response[LIST_INFO] = future.result()
+        self.reply(client, response, message)
+
     def authorize_user(self, message, sock):
-        """Authorize user method"""
+        """Start user authorization: check user name and send a password challenge.
+        Client answer is processed by finish_authorization when it's received,
+        so the server cycle doesn't wait for it
+        """
 
         server_log.debug(f'Start auth process for {message[USER][ACCOUNT_NAME]}')
-        if message[USER][ACCOUNT_NAME] in self.clients_names.keys():
-            response = RESPONSE_400
-            response[ERROR] = 'Имя пользователя уже занято.'
-            try:
-                server_log.debug(f'Username busy, sending {response}')
-                send_message(sock, response)
-            except OSError:
-                server_log.debug('OS Error')
-                pass
-            self.clients_list.remove(sock)
-            sock.close()
+        if self.is_user_online(message[USER][ACCOUNT_NAME]):
+            server_log.debug('Username busy')
+            self.reject_client(sock, 'Имя пользователя уже занято.')
 
         # -- Check if client already registered at server ---------------
         elif not self.db.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_400
-            response[ERROR] = 'Пользователь не зарегистрирован.'
-            try:
-                server_log.debug(f'Unknown username, sending {response}')
-                send_message(sock, response)
-            except OSError:
-                pass
-            self.clients_list.remove(sock)
-            sock.close()
+            server_log.debug('Unknown username')
+            self.reject_client(sock, 'Пользователь не зарегистрирован.')
         else:
             server_log.debug('Correct username, starting passwd check.')
             # -- Starting authentication process -------------------------
-            message_auth = RESPONSE_511
+            message_auth = dict(RESPONSE_511)
             random_str = binascii.hexlify(os.urandom(64))
             message_auth[DATA] = random_str.decode('ascii')
 
+            # -- Confirm length-prefixed format if client supports it. The challenge itself
+            # -- is sent in an old format, all the next messages are framed
+            framed = message.get(FRAMING) == FRAMING_LENGTH
+            if framed:
+                message_auth[FRAMING] = FRAMING_LENGTH
+
             # -- Creating password and random string hash
             # -- Saving public key server version
             new_hash = hmac.new(self.db.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
             digest = new_hash.digest()
             server_log.debug(f'Auth message = {message_auth}')
+            connection = self.connections.get(sock)
+
+            # -- Challenge is encoded before the framed format is switched on
+            self.send_to(sock, message_auth)
+            connection.decoder.framed = framed
+            connection.auth = (message, digest, time.monotonic() + AUTH_TIMEOUT)
+            self.authorizing.add(sock)
+
+    def finish_authorization(self, answer, sock):
+        """Check client answer to the password challenge and finish user authorization"""
+        connection = self.connections.get(sock)
+        message, digest, _ = connection.auth
+        connection.auth = None
+        self.authorizing.discard(sock)
+
+        # -- If client answer is correct save it to a users list
+        if not (RESPONSE in answer and answer[RESPONSE] == 511 and DATA in answer and
+                hmac.compare_digest(digest, binascii.a2b_base64(answer[DATA]))):
+            self.reject_client(sock, 'Неверный пароль.')
+
+        # -- Name could be taken while waiting for the client answer
+        elif not self.claim_name(message[USER][ACCOUNT_NAME], connection.address):
+            self.reject_client(sock, 'Имя пользователя уже занято.')
+        else:
+            self.connections.authorize(connection, message[USER][ACCOUNT_NAME])
+            client_ip, client_port = connection.address[:2]
+            self.send_to(sock, RESPONSE_200)
+            self.active_users.add(message[USER][ACCOUNT_NAME], client_ip, client_port)
+            self.user_connected(message[USER][ACCOUNT_NAME])
+
+            # -- Send messages received while user was offline
+            connection.offline = OfflineDelivery()
+            self.send_offline_messages(message[USER][ACCOUNT_NAME])
+
+            # -- Save login history and public key if it's new
+            old_key = self.db.get_pubkey(message[USER][ACCOUNT_NAME])
+            self.db.user_login(
+                message[USER][ACCOUNT_NAME],
+                client_ip,
+                client_port,
+                message[USER][PUBLIC_KEY])
+            self.check_key_changed(message[USER][ACCOUNT_NAME], old_key, message[USER][PUBLIC_KEY])
+
+    def claim_name(self, name, address):
+        """Reserve a user name for the connection being authorized. Returns False if name is taken"""
+        return not self.is_user_online(name)
+
+    def reject_client(self, sock, error):
+        """Send an error to a client which isn't authorized and close its connection"""
+        response = dict(RESPONSE_400)
+        response[ERROR] = error
+        try:
+            self.send_now(sock, response)
+        except OSError:
+            pass
+        self.close_client_socket(sock)
+
+    def send_offline_messages(self, name):
+        """Send messages stored for the user while he was offline.
+        Messages are taken from db by batches in the order they were received.
+        New messages to the user are stored too until all of them are sent, so they keep the order
+        """
+        connection = self.connections.get_by_name(name)
+        if connection is None:
+            return
+
+        client = connection.sock
+        self.offline_pending.discard(client)
+        # -- Continue when client reads messages which are already in its buffer
+        if self.is_reading_paused(client):
+            self.offline_pending.add(client)
+            return
+        delivery = connection.offline
+        delivery.requested = delivery.stored
+        self.when_done(self.db.get_offline_messages(name, delivery.last_id, OFFLINE_BATCH_SIZE),
+                       self.offline_messages_read, client)
+
+    def offline_messages_read(self, client, future):
+        """Put a batch of the stored messages to the client's buffer and request the next one"""
+        connection = self.connections.get(client)
+        if connection is None:
+            return
+        delivery = connection.offline
+        messages = future.result()
+        for message_id, message in messages:
+            self.send_to(client, message)
+            # -- Message is removed from db when the buffer is written up to its end
+            delivery.marks.append((connection.bytes_out + len(connection.out_buffer), message_id))
+            delivery.last_id = message_id
+        server_log.info(f'{len(messages)} offline messages sent to a user "{connection.name}"')
+
+        # -- Messages stored after the batch was requested could be missed by it
+        if len(messages) == OFFLINE_BATCH_SIZE or delivery.stored != delivery.requested:
+            self.send_offline_messages(connection.name)
+        else:
+            delivery.active = False
+
+    def confirm_offline_messages(self, connection):
+        """Remove stored messages which are written to the client socket"""
+        marks = connection.offline.marks
+        last_id = None
+        while marks and marks[0][0] <= connection.bytes_out:
+            last_id = marks.popleft()[1]
+        if last_id is not None:
+            self.db.remove_offline_messages(connection.name, last_id)
+
+    def is_delivering_offline(self, name):
+        """Check if user is getting messages stored while he was offline"""
+        connection = self.connections.get_by_name(name)
+        return connection is not None and connection.offline is not None and connection.offline.active
+
+    def notify_users_changed(self, added=(), removed=()):
+        """Send registered users list changes to the clients. Can be called from any thread"""
+        self.notifier.users_changed(added, removed)
+
+    def call_soon(self, func, *args):
+        """Call a function in the server cycle. Can be called from any thread"""
+        self.callbacks.append((func, args))
+        if self.wakeup_writer is not None:
             try:
-                # -- Send it to a client ------------------------------
-                send_message(sock, message_auth)
-                answer = get_message(sock)
-            except OSError as err:
-                server_log.debug('Error in auth, data:', exc_info=err)
-                sock.close()
-                return
+                self.wakeup_writer.send(b'\0')
+            except OSError:
+                # -- Wakeup buffer is full or the server is stopped
+                pass
 
-            client_digest = binascii.a2b_base64(answer[DATA])
-            # -- If client answer is correct save it to a users list
-            if RESPONSE in answer and answer[RESPONSE] == 511 and \
-                    hmac.compare_digest(digest, client_digest):
-                self.clients_names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-
-                # -- Add a client to an active users list and saving public key if it's new
-                self.db.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY])
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Неверный пароль.'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients_list.remove(sock)
-                sock.close()
+    def when_done(self, future, func, *args):
+        """Call func(*args, future) in the server cycle when the database operation is done,
+        so the server never waits for the database writer
+        """
+        future.add_done_callback(lambda done: self.call_soon(func, *args, done))
 
-    def service_update_lists(self):
-        """Sends a message with status code 205 to a clients method"""
-        for client in self.clients_names:
+    def run_callbacks(self):
+        """Call functions queued by other threads"""
+        while self.callbacks:
+            func, args = self.callbacks.popleft()
             try:
-                send_message(self.clients_names[client], RESPONSE_205)
-            except OSError:
-                self.remove_client(self.clients_names[client])
+                func(*args)
+            except Exception as error:
+                server_log.error(f'Server callback error: {error}')
+
+    def init_wakeup(self):
+        """Create a socket pair used by other threads to wake up the server cycle"""
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def close_wakeup(self):
+        """Close the wakeup socket pair when the server cycle is stopped"""
+        self.wakeup_writer.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer = None
+
+    def read_wakeup(self):
+        """Skip wakeup bytes, queued functions are called by flush_pending"""
+        try:
+            while self.wakeup_reader.recv(RECEIVE_CHUNK_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+    def check_key_changed(self, name, old_key, pubkey):
+        """Tell the users who have the user in their contacts and could have saved the old public key
+        that it's changed. Contacts are read by the writer after the login with the new key is saved
+        """
+        if old_key and pubkey and old_key != pubkey:
+            fingerprint = key_fingerprint(pubkey)
+            owners = self.db.get_contact_owners(name, wait=False)
+            owners.add_done_callback(lambda done: self.notify_key_changed(name, fingerprint, done.result()))
+
+    def notify_key_changed(self, name, fingerprint, recipients):
+        """Send user public key change to the recipients. Can be called from any thread"""
+        self.notifier.key_changed(name, fingerprint, recipients)
+
+    def send_notifications(self):
+        """Send coalesced users list changes to the authorized clients with a 205 response.
+        Old clients ignore the events and request users and contacts lists
+        """
+        events, recipients = self.notifier.take_with_recipients()
+        if not events:
+            return
+        for connection in list(self.connections.by_name.values()):
+            events_list = client_events(events, recipients, connection.name)
+            if events_list:
+                response = dict(RESPONSE_205)
+                response[EVENTS] = events_list
+                self.send_to(connection.sock, response)
 
     def init_socket(self):
         """Init server socket method"""
@@ -267,53 +442,305 @@ class MessageProcessor(threading.Thread, metaclass=ServerVerifier):
 
     def remove_client(self, client):
         """Remove client from the client list and form db"""
-        server_log.info(f'Client "{client.getpeername()}" is disconnected')
-        for name in self.clients_names:
-            if self.clients_names[name] == client:
-                self.db.user_logout(name)
-                del self.clients_names[name]
-                break
-        self.clients_list.remove(client)
+        connection = self.connections.remove(client)
+        if connection:
+            server_log.info(f'Client "{connection.address}" is disconnected')
+            if connection.name is not None:
+                self.active_users.remove(connection.name)
+                self.user_disconnected(connection.name)
+        self.close_client_socket(client)
+
+    def disconnect_user(self, name):
+        """Close connection of the user with a given name. Can be called from any thread"""
+        self.call_soon(self.drop_user, name)
+
+    def drop_user(self, name):
+        """Close connection of the user with a given name in the server cycle"""
+        connection = self.connections.get_by_name(name)
+        if connection:
+            self.remove_client(connection.sock)
+
+    def is_user_online(self, name):
+        """Check if user with a given name is connected to the server"""
+        return self.connections.get_by_name(name) is not None
+
+    def active_users_list(self):
+        """Logged in users list [(name, ipaddress, port, login_time), ...]. Can be called from any thread"""
+        return self.active_users.snapshot()
+
+    def subscribe_active_users(self, callback):
+        """Call callback(event, user) on every login and logout. Callback is called by the server thread"""
+        self.active_users.subscribe(callback)
+
+    def user_connected(self, name):
+        """User authorization event handler. Used by other server modes"""
+        pass
+
+    def user_disconnected(self, name):
+        """User disconnection event handler. Used by other server modes"""
+        pass
+
+    def close_client_socket(self, client):
+        """Close client socket and stop listening to its events"""
+        if self.selector:
+            try:
+                self.selector.unregister(client)
+            except (KeyError, ValueError):
+                pass
+        self.connections.remove(client)
+        self.pending_writes.discard(client)
+        self.slow_clients.discard(client)
+        self.offline_pending.discard(client)
+        self.authorizing.discard(client)
         client.close()
 
+    def reply(self, client, response, request):
+        """Send an answer to a client request. Request id is returned to the client,
+        so it can match answers with requests sent without waiting
+        """
+        if REQUEST_ID in request:
+            response = dict(response)
+            response[REQUEST_ID] = request[REQUEST_ID]
+        self.send_to(client, response)
+
+    def send_now(self, client, message):
+        """Send a message to a client immediately. Used only before client is authorized"""
+        connection = self.connections.get(client)
+        send_message(client, message, connection.decoder.framed if connection else False)
+
+    def send_to(self, client, message):
+        """Put a message to the client's outbound buffer in the format negotiated with it.
+        Buffer is written by the server cycle when the socket is ready,
+        so one slow client never blocks the others
+        """
+        connection = self.connections.get(client)
+        if connection is None or client in self.slow_clients:
+            return
+
+        buffer = connection.out_buffer
+        buffer += encode_message(message, connection.decoder.framed)
+        connection.messages_out += 1
+        self.pending_writes.add(client)
+
+        # -- Client doesn't read its messages, it will be disconnected by the server cycle
+        if len(buffer) > OUTBOUND_BUFFER_LIMIT:
+            server_log.warning(f'Outbound buffer overflow ({len(buffer)} bytes), disconnecting slow client')
+            self.slow_clients.add(client)
+
+    def flush_client(self, client):
+        """Write as much of the outbound buffer as the socket accepts without blocking"""
+        connection = self.connections.get(client)
+        buffer = connection.out_buffer if connection else None
+        if buffer:
+            try:
+                sent = client.send(buffer)
+            except BlockingIOError:
+                sent = 0
+            except OSError as err:
+                server_log.error(f'Client send error: {err}.')
+                self.remove_client(client)
+                return
+            del buffer[:sent]
+            connection.bytes_out += sent
+            if connection.offline is not None and connection.offline.marks:
+                self.confirm_offline_messages(connection)
+
+        if not buffer:
+            self.pending_writes.discard(client)
+
+        if self.selector and buffer is not None:
+            self.update_events(client)
+
+    def flush_pending(self):
+        """Write outbound buffers, disconnect slow clients and update sockets events.
+        Called by the server cycle after incoming data is processed
+        """
+        self.run_callbacks()
+        self.send_notifications()
+
+        for client in list(self.slow_clients):
+            self.remove_client(client)
+
+        now = time.monotonic()
+        for client in list(self.authorizing):
+            connection = self.connections.get(client)
+            if connection is None or connection.auth is None:
+                self.authorizing.discard(client)
+            elif connection.auth[2] <= now:
+                server_log.info(f'Client "{connection.address}" hasn\'t answered the password challenge')
+                self.remove_client(client)
+
+        for client in list(self.pending_writes):
+            self.flush_client(client)
+
+        for client in list(self.offline_pending):
+            connection = self.connections.get(client)
+            if connection and not self.is_reading_paused(client):
+                self.send_offline_messages(connection.name)
+
+    def update_events(self, client):
+        """Set selector events for a client: wait for writing while outbound buffer isn't empty,
+        stop reading requests while client doesn't read its answers (backpressure)
+        """
+        connection = self.connections.get(client)
+        buffer = connection.out_buffer if connection else None
+        events = selectors.EVENT_READ
+        if buffer:
+            events = selectors.EVENT_WRITE
+            if len(buffer) < OUTBOUND_HIGH_WATER:
+                events |= selectors.EVENT_READ
+
+        try:
+            if self.selector.get_key(client).events != events:
+                self.selector.modify(client, events)
+        except KeyError:
+            pass
+
+    def is_reading_paused(self, client):
+        """Check if client's requests shouldn't be read until it reads its answers"""
+        connection = self.connections.get(client)
+        return connection is not None and len(connection.out_buffer) >= OUTBOUND_HIGH_WATER
+
+    def buffer_stats(self):
+        """Outbound buffers sizes of authorized clients {client_name: bytes}"""
+        return {name: len(connection.out_buffer) for name, connection in list(self.connections.by_name.items())}
+
+    def accept_client(self):
+        """Accept new client connection if there is one"""
+        try:
+            client_socket, client_address = self.sock.accept()
+        except OSError:
+            # -- Timeout or no pending connections for a non-blocking socket
+            return None
+
+        server_log.info(f'New client connected from \'{client_address}\'')
+        # -- Client sockets are non-blocking, the server never waits for a single client
+        client_socket.setblocking(False)
+        self.connections.add(client_socket, client_address)
+        return client_socket
+
+    def read_client(self, client_with_message):
+        """Receive data from a client and process all complete messages.
+        Delete client if something went wrong
+        """
+        connection = self.connections.get(client_with_message)
+        if connection is None:
+            return
+
+        try:
+            server_log.info(f'Creating server response message for client {connection.address}')
+            decoder = connection.decoder
+            try:
+                data = client_with_message.recv(RECEIVE_CHUNK_SIZE)
+            except BlockingIOError:
+                return
+            if not data:
+                raise ValueError('Connection closed by client')
+            connection.bytes_in += len(data)
+            decoder.pending.extend(decoder.feed(data))
+
+            # -- Data can contain several messages or only a part of the message
+            while decoder.pending and client_with_message in self.connections:
+                connection.messages_in += 1
+                if connection.auth is not None:
+                    self.finish_authorization(decoder.pending.popleft(), client_with_message)
+                else:
+                    self.process_client_message(decoder.pending.popleft(), client_with_message)
+        except ValueError as value_error:
+            server_log.error(f'Client response message error: {value_error}.')
+            self.remove_client(client_with_message)
+        except Exception as error:
+            server_log.error(f'Client response message error: {error}.')
+            self.remove_client(client_with_message)
+
     def run(self):
         """Main Thread cycle.
         Overriding default Thread method "run" and starting it automatically
         """
         self.init_socket()
 
-        while self.running:
-            server_log.info(f'Waiting for new client ...')
-            try:
-                client_socket, client_address = self.sock.accept()
-            except OSError as err:
-                # -- The error number returns None because it's just a timeout
-                # print(err.errno)
-                pass
-            else:
-                server_log.info(f'New client connected from \'{client_address}\'')
-                self.clients_list.append(client_socket)
-
-            recv_data_lst = []
+        if self.engine == 'selectors':
+            self.run_selectors()
+        else:
+            self.run_select()
+
+    def run_select(self):
+        """Polling server cycle: select over the listening socket, the wakeup socket and all client sockets"""
+        self.init_wakeup()
+        self.sock.setblocking(False)
+
+        server_log.info(f'Waiting for new client ...')
+        try:
+            while self.running:
+                recv_data_lst, send_data_lst = [], []
+
+                # -- Checking for new clients, queued callbacks and clients that are waiting ---
+                read_list = [self.sock, self.wakeup_reader]
+                read_list.extend(connection.sock for connection in self.connections
+                                 if not self.is_reading_paused(connection.sock))
+                try:
+                    recv_data_lst, send_data_lst, _ = select.select(read_list, list(self.pending_writes), [],
+                                                                    self.select_timeout())
+                except OSError:
+                    pass
 
-            # -- Checking for a clients that are waiting --------------------------------
-            try:
-                if self.clients_list:
-                    recv_data_lst, self.listen_sockets, _ = select.select(
-                        self.clients_list, self.clients_list, [], 0)
-            except OSError:
-                pass
+                for client in send_data_lst:
+                    self.flush_client(client)
 
-            # -- If client sends data, need to process it's messages or delete it from a clients list
-            if recv_data_lst:
+                # -- If client sends data, need to process it's messages or delete it from a clients list
                 for client_with_message in recv_data_lst:
-                    try:
-                        server_log.info(
-                            f'Creating server response message for client {client_with_message.getpeername()}')
-                        self.process_client_message(get_message(client_with_message), client_with_message)
-                    except ValueError as value_error:
-                        server_log.error(f'Client response message error: {value_error}.')
-                        self.remove_client(client_with_message)
-                    except Exception as error:
-                        server_log.error(f'Client response message error: {error}.')
-                        self.remove_client(client_with_message)
+                    if client_with_message is self.sock:
+                        self.accept_client()
+                    elif client_with_message is self.wakeup_reader:
+                        self.read_wakeup()
+                    elif client_with_message in self.connections:
+                        self.read_client(client_with_message)
+
+                # -- Write answers to the clients which are ready to receive them
+                self.flush_pending()
+        finally:
+            self.close_wakeup()
+
+    def select_timeout(self):
+        """How long the server cycle waits for events"""
+        return SELECTOR_TIMEOUT
+
+    def init_selector(self):
+        """Create a selector and register the listening socket in it"""
+        self.selector = selectors.DefaultSelector()
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+        self.init_wakeup()
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.read_wakeup)
+
+    def run_selectors(self):
+        """Event-driven server cycle. Listening socket and clients are registered
+        in a selector (epoll, kqueue, ...) once, so the thread wakes up only on real events
+        """
+        self.init_selector()
+
+        server_log.info(f'Waiting for client events with {type(self.selector).__name__}')
+        try:
+            while self.running:
+                for key, events in self.selector.select(self.select_timeout()):
+                    if key.fileobj is self.sock:
+                        client_socket = self.accept_client()
+                        if client_socket:
+                            self.selector.register(client_socket, selectors.EVENT_READ)
+                        continue
+                    if key.data:
+                        # -- Service sockets are registered with their own handlers
+                        key.data()
+                        continue
+                    if events & selectors.EVENT_WRITE:
+                        self.flush_client(key.fileobj)
+                    if events & selectors.EVENT_READ and key.fileobj in self.connections:
+                        self.read_client(key.fileobj)
+
+                # -- Write new answers and update events of the clients
+                self.flush_pending()
+        finally:
+            self.selector.close()
+            self.selector = None
+            self.close_wakeup()
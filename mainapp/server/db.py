@@ -1,17 +1,246 @@
 import datetime
+import json
+import logging
 import os
+import queue
 import sys
-
-from sqlalchemy import Column, String, Integer, DateTime, func, ForeignKey, create_engine, Text
-from sqlalchemy.orm import declarative_base, sessionmaker
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+from sqlalchemy import Column, String, Integer, DateTime, func, ForeignKey, create_engine, Text, update, Index, \
+    and_, or_, Boolean
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session
 from sqlalchemy.sql import default_comparator
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
-from common.variables import SERVER_DATABASE
+from common.variables import SERVER_DATABASE, OFFLINE_QUEUE_LIMIT, OFFLINE_MESSAGE_TTL, IDENTITY_CACHE_SIZE, \
+    STATS_FLUSH_INTERVAL, STATS_FLUSH_SIZE, DB_WRITER_BATCH_SIZE, SERVER_DATABASE_PRAGMAS, HISTORY_PAGE_SIZE
+from common.migrations import set_pragmas, migrate
+
+server_log = logging.getLogger('server')
 
 Base = declarative_base()
 
+# -- Database schema changes. Index number + 1 is a schema version (PRAGMA user_version).
+# -- Tables are created by models, indexes added to models must be created here for the existing databases
+MIGRATIONS = [
+    [
+        'CREATE INDEX IF NOT EXISTS ix_users_contacts_user_contact ON users_contacts (user, contact)',
+        'CREATE INDEX IF NOT EXISTS ix_users_history_user ON users_history (user)',
+        'CREATE INDEX IF NOT EXISTS ix_users_login_history_user ON users_login_history (user)',
+        'CREATE INDEX IF NOT EXISTS ix_offline_messages_user ON offline_messages (user)',
+    ],
+    [
+        'CREATE INDEX IF NOT EXISTS ix_users_last_login ON users (last_login)',
+        'CREATE INDEX IF NOT EXISTS ix_users_history_sent ON users_history (sent)',
+        'CREATE INDEX IF NOT EXISTS ix_users_history_accepted ON users_history (accepted)',
+    ],
+    [
+        'INSERT INTO users_changes (name, removed) SELECT name, 0 FROM users '
+        'WHERE name NOT IN (SELECT name FROM users_changes)',
+    ],
+]
+
+# -- Columns of the messages statistics page which can be used for sorting
+HISTORY_SORT_KEYS = ('name', 'last_login', 'sent', 'accepted')
+
+# -- Cached user data needed on the messages path
+UserIdentity = namedtuple('UserIdentity', ('id', 'passwd_hash', 'pubkey'))
+
+
+class IdentityCache:
+    """LRU cache of registered users identities {name: UserIdentity}.
+    The least recently used users are evicted when cache size is exceeded
+    """
+    def __init__(self, size=IDENTITY_CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        """Getting cached user identity or None"""
+        with self.lock:
+            identity = self.items.get(name)
+            if identity is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(name)
+            return identity
+
+    def put(self, name, identity):
+        """Save user identity and evict the least recently used one if cache is full"""
+        with self.lock:
+            self.items[name] = identity
+            self.items.move_to_end(name)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def discard(self, name):
+        """Remove user identity, it will be read from the database on the next request"""
+        with self.lock:
+            self.items.pop(name, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        """Cache usage statistics"""
+        return {'size': len(self.items), 'hits': self.hits, 'misses': self.misses}
+
+
+class StatsAggregator:
+    """Messages statistics deltas which are not saved to the database yet {user_id: [sent, accepted]}.
+    Deltas being written stay visible until the transaction is committed
+    """
+    def __init__(self, flush_size=STATS_FLUSH_SIZE):
+        self.flush_size = flush_size
+        self.pending = dict()
+        self.in_flight = dict()
+        self.messages = 0  # Messages counted since the last flush
+        self.lock = threading.Lock()
+
+    def add(self, sender_id, recipient_id):
+        """Count a message"""
+        with self.lock:
+            self.pending.setdefault(sender_id, [0, 0])[0] += 1
+            self.pending.setdefault(recipient_id, [0, 0])[1] += 1
+            self.messages += 1
+
+    def is_full(self):
+        """Check if deltas should be saved because too many messages were counted"""
+        return self.messages >= self.flush_size
+
+    def take(self):
+        """Getting deltas to be written"""
+        with self.lock:
+            self.in_flight, self.pending = self.pending, dict()
+            self.messages = 0
+            return self.in_flight
+
+    def done(self, success=True):
+        """Forget written deltas or return them back to pending if writing failed"""
+        with self.lock:
+            if not success:
+                for user_id, (sent, accepted) in self.in_flight.items():
+                    delta = self.pending.setdefault(user_id, [0, 0])
+                    delta[0] += sent
+                    delta[1] += accepted
+            self.in_flight = dict()
+
+    def discard(self, user_id):
+        """Forget deltas of the removed user"""
+        with self.lock:
+            self.pending.pop(user_id, None)
+            self.in_flight.pop(user_id, None)
+
+    def get(self, user_id):
+        """Not saved deltas of the user (sent, accepted)"""
+        with self.lock:
+            sent, accepted = 0, 0
+            for deltas in (self.pending, self.in_flight):
+                if user_id in deltas:
+                    sent += deltas[user_id][0]
+                    accepted += deltas[user_id][1]
+            return sent, accepted
+
+
+class DatabaseWriter(threading.Thread):
+    """Thread which applies all the Storage changes with its own session.
+    Queued operations are applied in one transaction (group commit),
+    callers get futures with the operations results
+    """
+    def __init__(self, storage, batch_size=DB_WRITER_BATCH_SIZE, interval=STATS_FLUSH_INTERVAL):
+        super().__init__(name='db_writer', daemon=True)
+        self.storage = storage
+        self.queue = queue.Queue()
+        self.batch_size = batch_size
+        self.interval = interval  # Messages statistics saving interval
+        self.session = None
+        self.last_stats_flush = time.monotonic()
+
+    def submit(self, func, *args):
+        """Put an operation to the queue. Operation is called as func(session, *args)"""
+        future = Future()
+        self.queue.put((func, args, future))
+        return future
+
+    def stop(self):
+        """Apply all the queued operations and stop the thread"""
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        self.session = self.storage.session_factory()
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = [operation for operation in batch if operation is not None]
+            self.apply([operation for operation in batch if operation[2].set_running_or_notify_cancel()],
+                       not running)
+        self.session.close()
+
+    def apply(self, batch, flush_stats=False):
+        """Apply operations and save messages statistics in one transaction.
+        If something fails, operations are applied one by one, so one wrong operation
+        doesn't fail the others
+        """
+        stats = self.storage.stats
+        if flush_stats or stats.is_full() or time.monotonic() - self.last_stats_flush >= self.interval:
+            deltas = stats.take()
+            self.last_stats_flush = time.monotonic()
+        else:
+            deltas = None
+        if not batch and not deltas:
+            return
+
+        try:
+            results = [func(self.session, *args) for func, args, future in batch]
+            if deltas:
+                self.storage.save_stats(self.session, deltas)
+            self.session.commit()
+        except Exception as error:
+            self.session.rollback()
+            server_log.error(f'Database group commit error: {error}')
+            if deltas:
+                stats.done(success=False)
+            self.apply_one_by_one(batch)
+            return
+
+        if deltas:
+            stats.done()
+        for (func, args, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def apply_one_by_one(self, batch):
+        """Apply every operation in its own transaction"""
+        for func, args, future in batch:
+            try:
+                result = func(self.session, *args)
+                self.session.commit()
+            except Exception as error:
+                self.session.rollback()
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
 
 class Storage:
     """Class to work with Server database"""
@@ -20,7 +249,7 @@ class Storage:
         __tablename__ = 'users'
         id = Column(Integer, primary_key=True)
         name = Column(String(50), unique=True)
-        last_login = Column(DateTime(timezone=True))  # , onupdate=func.now()
+        last_login = Column(DateTime(timezone=True), index=True)  # , onupdate=func.now()
         passwd_hash = Column(String(50), unique=True)
         pubkey = Column(Text, unique=True)
 
@@ -33,7 +262,7 @@ class Storage:
             return "<User('%s','%s')>" % (self.name, self.last_login)
 
     class ActiveUsers(Base):
-        """Table with user activity information"""
+        """Table with active users list saved by the server from time to time"""
         __tablename__ = 'users_activity'
         id = Column(Integer, primary_key=True)
         user = Column(ForeignKey('users.id'), unique=True)
@@ -41,10 +270,11 @@ class Storage:
         port = Column(Integer)
         login_time = Column(DateTime(timezone=True), server_default=func.now())
 
-        def __init__(self, user, ip, port):
+        def __init__(self, user, ip, port, login_time=None):
             self.user = user
             self.ipaddress = ip
             self.port = port
+            self.login_time = login_time
 
         def __repr__(self):
             return "<User('%s','%s', '%s', '%s')>" % (self.user, self.ipaddress, self.port, self.login_time)
@@ -53,7 +283,7 @@ class Storage:
         """Table with users login information"""
         __tablename__ = 'users_login_history'
         id = Column(Integer, primary_key=True)
-        user = Column(ForeignKey('users.id'))
+        user = Column(ForeignKey('users.id'), index=True)
         ipaddress = Column(String(50))
         port = Column(Integer)
         date_time = Column(DateTime(timezone=True), server_default=func.now())
@@ -69,6 +299,7 @@ class Storage:
     class UsersContacts(Base):
         """Table with users contacts"""
         __tablename__ = 'users_contacts'
+        __table_args__ = (Index('ix_users_contacts_user_contact', 'user', 'contact'), )
         id = Column(Integer, primary_key=True)
         user = Column(ForeignKey('users.id'))
         contact = Column(ForeignKey('users.id'))
@@ -84,9 +315,9 @@ class Storage:
         """Table with users messages statistics"""
         __tablename__ = 'users_history'
         id = Column(Integer, primary_key=True)
-        user = Column(ForeignKey('users.id'))
-        sent = Column(Integer)
-        accepted = Column(Integer)
+        user = Column(ForeignKey('users.id'), index=True)
+        sent = Column(Integer, index=True)
+        accepted = Column(Integer, index=True)
 
         def __init__(self, user, sent=0, accepted=0):
             self.user = user
@@ -96,29 +327,87 @@ class Storage:
         def __repr__(self):
             return "<History('%s','%s','%s')>" % (self.user, self.sent, self.accepted)
 
+    class OfflineMessages(Base):
+        """Table with messages for users who were offline"""
+        __tablename__ = 'offline_messages'
+        id = Column(Integer, primary_key=True)
+        user = Column(ForeignKey('users.id'), index=True)
+        message = Column(Text)
+        created = Column(DateTime(timezone=True))
+
+        def __init__(self, user, message):
+            self.user = user
+            self.message = message
+            self.created = datetime.datetime.now()
+
+        def __repr__(self):
+            return "<OfflineMessage('%s','%s')>" % (self.user, self.created)
+
+    class UsersChanges(Base):
+        """Table with registered users list changes. Change id is a version of the users list.
+        Only the last change of every user is kept
+        """
+        __tablename__ = 'users_changes'
+        __table_args__ = {'sqlite_autoincrement': True}  # Versions of deleted changes are never reused
+        id = Column(Integer, primary_key=True)
+        name = Column(String(50), unique=True)
+        removed = Column(Boolean, default=False)
+
+        def __init__(self, name, removed=False):
+            self.name = name
+            self.removed = removed
+
+        def __repr__(self):
+            return "<UsersChange('%s','%s','%s')>" % (self.id, self.name, self.removed)
+
     def __init__(self, db_path):
         # -- Creating server connection ------------
         self.engine = create_engine('sqlite:///' + (db_path if db_path else SERVER_DATABASE),
                                     echo=False, pool_recycle=7200, connect_args={'check_same_thread': False})
-        # -- Creating all server tables ------------
+        set_pragmas(self.engine, SERVER_DATABASE_PRAGMAS)
+        # -- Creating all server tables and upgrading existing database ------------
         Base.metadata.create_all(self.engine)
-        session = sessionmaker(bind=self.engine)
+        migrate(self.engine, MIGRATIONS)
+        self.session_factory = sessionmaker(bind=self.engine)
+
+        # -- Every thread reads data with its own session, all the changes are made by the writer thread
+        self.session = scoped_session(self.session_factory)
+
+        # -- Users identities cache, so messages processing doesn't query users table
+        self.identities = IdentityCache()
 
-        self.session = session()
+        # -- Messages statistics are counted in memory and saved by the writer thread
+        self.stats = StatsAggregator()
 
-        # -- Truncate table with active users -----
-        self.session.query(self.ActiveUsers).delete()
-        self.session.commit()
+        self.writer = DatabaseWriter(self)
+        self.writer.start()
+
+    def write(self, func, *args, invalidate=None):
+        """Queue a database change. Returns a future with the operation result.
+        User identity is removed from the cache when the change is committed
+        """
+        future = self.writer.submit(func, *args)
+        if invalidate is not None:
+            future.add_done_callback(lambda _: self.identities.discard(invalidate))
+        return future
+
+    def close(self):
+        """Apply queued changes, save messages statistics and stop the writer thread"""
+        if self.writer.is_alive():
+            self.writer.stop()
+        self.session.remove()
 
     def user_login(self, username, ipaddress, port, key):
         """Add an information about new connected user"""
+        return self.write(self.write_user_login, username, ipaddress, port, key, invalidate=username)
 
-        result = self.session.query(self.Users).filter_by(name=username)
+    def write_user_login(self, session, username, ipaddress, port, key):
+        """User login changes. Called by the writer thread"""
+        user = session.query(self.Users).filter_by(name=username).first()
 
         # -- Add a record to a Users' table about new connected user -
-        if result.count():
+        if user:
             # -- Update last login time if user is already exists -----
-            user = result.first()
             user.last_login = datetime.datetime.now()
             # -- Save public key if it was changed --------------------
             if user.pubkey != key:
@@ -126,59 +415,81 @@ class Storage:
         else:
             raise ValueError('User is not registered')
 
-        # -- Add information about new active user --------------------
-        user_activity = self.ActiveUsers(user.id, ipaddress, port)
-        self.session.add(user_activity)
-
         # -- Add new record at history table --------------------------
         login_history = self.LoginHistory(user.id, ipaddress, port)
-        self.session.add(login_history)
-
-        self.session.commit()
-
-    def user_logout(self, username):
-        """User disconnect event handler method"""
-
-        user = self.session.query(self.Users).filter_by(name=username).first()
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
-        self.session.commit()
+        session.add(login_history)
+
+    def get_identity(self, name):
+        """Getting user id, password hash and public key from the cache or from the database.
+        Returns None if user isn't registered
+        """
+        identity = self.identities.get(name)
+        if identity is None:
+            row = self.session.query(self.Users.id, self.Users.passwd_hash, self.Users.pubkey). \
+                filter_by(name=name).first()
+            if not row:
+                return None
+            identity = UserIdentity(*row)
+            self.identities.put(name, identity)
+        return identity
 
     def add_user(self, name, passwd_hash):
         """Adding new user method """
+        return self.write(self.write_add_user, name, passwd_hash, invalidate=name)
+
+    def write_add_user(self, session, name, passwd_hash):
+        """New user changes. Called by the writer thread"""
         new_user = self.Users(name, passwd_hash)
-        self.session.add(new_user)
-        self.session.commit()
+        session.add(new_user)
+        session.flush()
 
         history_row = self.UsersHistory(new_user.id)
-        self.session.add(history_row)
-        self.session.commit()
+        session.add(history_row)
+        self.write_users_change(session, name)
 
     def remove_user(self, name):
         """Removing user method"""
-        user = self.session.query(self.Users).filter_by(name=name).first()
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
-        self.session.query(self.LoginHistory).filter_by(user=user.id).delete()
-        self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
-        self.session.query(
+        return self.write(self.write_remove_user, name, invalidate=name)
+
+    def write_remove_user(self, session, name):
+        """Removing all the user data. Called by the writer thread"""
+        user = session.query(self.Users).filter_by(name=name).first()
+        session.query(self.ActiveUsers).filter_by(user=user.id).delete()
+        session.query(self.LoginHistory).filter_by(user=user.id).delete()
+        session.query(self.UsersContacts).filter_by(user=user.id).delete()
+        session.query(
             self.UsersContacts).filter_by(
             contact=user.id).delete()
-        self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
-        self.session.query(self.Users).filter_by(name=name).delete()
-        self.session.commit()
+        session.query(self.UsersHistory).filter_by(user=user.id).delete()
+        self.stats.discard(user.id)
+        session.query(self.OfflineMessages).filter_by(user=user.id).delete()
+        session.query(self.Users).filter_by(name=name).delete()
+        self.write_users_change(session, name, removed=True)
+
+    def write_users_change(self, session, name, removed=False):
+        """Save a new version of the users list. Called by the writer thread"""
+        session.query(self.UsersChanges).filter_by(name=name).delete()
+        session.add(self.UsersChanges(name, removed))
 
     def get_hash(self, name):
         """Getting user password hash method"""
-        user = self.session.query(self.Users).filter_by(name=name).first()
-        return user.passwd_hash
+        return self.get_identity(name).passwd_hash
 
     def get_pubkey(self, name):
         """Getting user public key method"""
-        user = self.session.query(self.Users).filter_by(name=name).first()
-        return user.pubkey
+        return self.get_identity(name).pubkey
+
+    def get_pubkeys(self, names):
+        """Getting public keys of the users list by one query {name: pubkey}.
+        Unknown users and users without a key are skipped
+        """
+        keys = self.session.query(self.Users.name, self.Users.pubkey). \
+            filter(self.Users.name.in_(names), self.Users.pubkey.isnot(None))
+        return dict(keys.all())
 
     def check_user(self, name):
         """Checks user exist method"""
-        if self.session.query(self.Users).filter_by(name=name).count():
+        if self.get_identity(name):
             return True
         return False
 
@@ -187,20 +498,77 @@ class Storage:
         users = self.session.query(self.Users.name, self.Users.last_login)
         return users.all()
 
-    def get_contacts(self, username):
-        """Getting users contacts list method"""
-        user = self.session.query(self.Users).filter_by(name=username).one()
+    def users_changes(self, version=None):
+        """Getting registered users list changes made after the version.
+        Returns current version, added and removed users names. If the version is unknown
+        all the users are returned as added and removed list is None
+        """
+        current = self.session.query(func.max(self.UsersChanges.id)).scalar() or 0
+        if not version or version > current:
+            return current, [user[0] for user in self.session.query(self.Users.name).all()], None
+
+        query = self.session.query(self.UsersChanges.id, self.UsersChanges.name, self.UsersChanges.removed). \
+            filter(self.UsersChanges.id > version).order_by(self.UsersChanges.id)
+        added, removed = [], []
+        for change_id, name, is_removed in query.all():
+            (removed if is_removed else added).append(name)
+            current = max(current, change_id)
+        return current, added, removed
+
+    def get_contacts(self, username, wait=True):
+        """Getting users contacts list method.
+        Contacts are read by the writer thread, so the list includes all the changes made before.
+        Returns a future with the list if wait is False
+        """
+        user = self.get_identity(username)
+        if not user:
+            raise ValueError('User is not registered')
+        future = self.write(self.read_contacts, user.id)
+        return future.result() if wait else future
 
+    def read_contacts(self, session, user_id):
+        """Getting contacts names. Called by the writer thread"""
         # -- Get users contacts list -----------------
-        query = self.session.query(self.UsersContacts, self.Users.name). \
-            filter_by(user=user.id). \
+        query = session.query(self.UsersContacts, self.Users.name). \
+            filter_by(user=user_id). \
             join(self.Users, self.UsersContacts.contact == self.Users.id)
 
         # -- Return only usernames -------------------
         return [contact[1] for contact in query.all()]
 
+    def get_contact_owners(self, username, wait=True):
+        """Getting names of the users who have the user in their contacts.
+        Read by the writer thread like contacts. Returns a future with the list if wait is False
+        """
+        user = self.get_identity(username)
+        if not user:
+            raise ValueError('User is not registered')
+        future = self.write(self.read_contact_owners, user.id)
+        return future.result() if wait else future
+
+    def read_contact_owners(self, session, user_id):
+        """Getting names of the users having the contact. Called by the writer thread"""
+        query = session.query(self.Users.name). \
+            join(self.UsersContacts, self.UsersContacts.user == self.Users.id). \
+            filter(self.UsersContacts.contact == user_id)
+        return [row[0] for row in query.all()]
+
+    def save_active_users(self, users):
+        """Replace saved active users list with the server's one [(name, ipaddress, port, login_time), ...]"""
+        return self.write(self.write_active_users, list(users))
+
+    def write_active_users(self, session, users):
+        """Saving active users list. Called by the writer thread"""
+        session.query(self.ActiveUsers).delete()
+        for name, ipaddress, port, login_time in users:
+            user = session.query(self.Users.id).filter_by(name=name).first()
+            if user:
+                session.add(self.ActiveUsers(user.id, ipaddress, port, login_time))
+
     def active_users_list(self):
-        """Getting a list of active users method"""
+        """Getting active users list saved by the server method.
+        Current list is kept by the server in memory
+        """
         users = self.session.query(
             self.Users.name,
             self.ActiveUsers.ipaddress,
@@ -225,71 +593,169 @@ class Storage:
         return query.all()
 
     def process_message(self, sender, recipient):
-        """Update user's messages statistic method"""
-        sender_id = self.session.query(self.Users).filter_by(name=sender).first().id
-        recipient_id = self.session.query(self.Users).filter_by(name=recipient).first().id
-
-        # -- Update user's messages statistics --------------------
-        sender_stat = self.session.query(self.UsersHistory).filter_by(user=sender_id).first()
-        sender_stat.sent += 1
-        recipient_stat = self.session.query(self.UsersHistory).filter_by(user=recipient_id).first()
-        recipient_stat.accepted += 1
-
-        self.session.commit()
+        """Update user's messages statistic method.
+        Statistics is counted in memory and saved to the database by the writer thread
+        """
+        sender_id = self.get_identity(sender).id
+        recipient_id = self.get_identity(recipient).id
+
+        self.stats.add(sender_id, recipient_id)
+
+    def save_stats(self, session, deltas):
+        """Save messages statistics deltas"""
+        for user_id, (sent, accepted) in deltas.items():
+            session.execute(
+                update(self.UsersHistory).where(self.UsersHistory.user == user_id).values(
+                    sent=self.UsersHistory.sent + sent,
+                    accepted=self.UsersHistory.accepted + accepted))
 
     def add_contact(self, user, contact):
         """Adding new user contact method"""
-        user = self.session.query(self.Users).filter_by(name=user).first()
-        contact = self.session.query(self.Users).filter_by(name=contact).first()
-
+        user = self.get_identity(user)
+        contact = self.get_identity(contact)
+        if not user or not contact:
+            return None
+        return self.write(self.write_add_contact, user.id, contact.id)
+
+    def write_add_contact(self, session, user_id, contact_id):
+        """New contact changes. Called by the writer thread"""
         # -- Check if this contact is already exists
-        if not contact or self.session.query(self.UsersContacts).filter_by(user=user.id, contact=contact.id).count():
+        if session.query(self.UsersContacts).filter_by(user=user_id, contact=contact_id).count():
             return False
 
         # -- Add new contact
-        new_contact = self.UsersContacts(user.id, contact.id)
-        self.session.add(new_contact)
-        self.session.commit()
+        new_contact = self.UsersContacts(user_id, contact_id)
+        session.add(new_contact)
+        return True
 
     def remove_contact(self, user, contact):
         """Removing contact from users contacts method"""
-        user = self.session.query(self.Users).filter_by(name=user).first()
-        contact = self.session.query(self.Users).filter_by(name=contact).first()
-
-        if not contact:
-            return False
-
-        self.session.query(self.UsersContacts).filter(
-            self.UsersContacts.user == user.id,
-            self.UsersContacts.contact == contact.id
+        user = self.get_identity(user)
+        contact = self.get_identity(contact)
+        if not user or not contact:
+            return None
+        return self.write(self.write_remove_contact, user.id, contact.id)
+
+    def write_remove_contact(self, session, user_id, contact_id):
+        """Removing contact changes. Called by the writer thread"""
+        session.query(self.UsersContacts).filter(
+            self.UsersContacts.user == user_id,
+            self.UsersContacts.contact == contact_id
         ).delete()
 
-        self.session.commit()
+    def store_message(self, recipient, message):
+        """Save a message for the user who is offline.
+        Future result is False if user isn't registered or his messages queue is full
+        """
+        user = self.get_identity(recipient)
+        if not user:
+            future = Future()
+            future.set_result(False)
+            return future
+        return self.write(self.write_store_message, user.id, json.dumps(message))
+
+    def write_store_message(self, session, user_id, message):
+        """Saving message to the user's queue. Called by the writer thread"""
+        self.remove_expired_messages(session, user_id)
+        if session.query(self.OfflineMessages).filter_by(user=user_id).count() >= OFFLINE_QUEUE_LIMIT:
+            return False
 
-    def message_history(self):
-        """Getting users messages statistics method"""
-        query = self.session.query(
+        session.add(self.OfflineMessages(user_id, message))
+        return True
+
+    def get_offline_messages(self, recipient, after_id, limit):
+        """Getting the oldest messages saved for the user after a given id, in the order they were received.
+        Messages are kept until remove_offline_messages is called for the delivered ones.
+        Returns a future with the list [(message_id, message), ...]
+        """
+        user = self.get_identity(recipient)
+        if not user:
+            future = Future()
+            future.set_result([])
+            return future
+        return self.write(self.write_get_offline_messages, user.id, after_id, limit)
+
+    def write_get_offline_messages(self, session, user_id, after_id, limit):
+        """Reading messages from the user's queue. Called by the writer thread,
+        so messages stored before are always read
+        """
+        self.remove_expired_messages(session, user_id)
+        rows = session.query(self.OfflineMessages.id, self.OfflineMessages.message).filter(
+            self.OfflineMessages.user == user_id,
+            self.OfflineMessages.id > after_id
+        ).order_by(self.OfflineMessages.id).limit(limit).all()
+
+        return [(row.id, json.loads(row.message)) for row in rows]
+
+    def remove_offline_messages(self, recipient, last_id):
+        """Removing messages delivered to the user, up to the given id"""
+        user = self.get_identity(recipient)
+        if not user:
+            return None
+        return self.write(self.write_remove_offline_messages, user.id, last_id)
+
+    def write_remove_offline_messages(self, session, user_id, last_id):
+        """Removing messages from the user's queue. Called by the writer thread"""
+        session.query(self.OfflineMessages).filter(
+            self.OfflineMessages.user == user_id,
+            self.OfflineMessages.id <= last_id
+        ).delete(synchronize_session=False)
+
+    def remove_expired_messages(self, session, user_id):
+        """Removing messages which were stored longer than TTL"""
+        expire_time = datetime.datetime.now() - datetime.timedelta(seconds=OFFLINE_MESSAGE_TTL)
+        session.query(self.OfflineMessages).filter(
+            self.OfflineMessages.user == user_id,
+            self.OfflineMessages.created < expire_time
+        ).delete(synchronize_session=False)
+
+    def history_query(self):
+        return self.session.query(
             self.Users.name,
             self.Users.last_login,
             self.UsersHistory.sent,
             self.UsersHistory.accepted,
+            self.Users.id,
         ).join(self.Users)
 
-        return query.all()
-
-
-# Tests
-if __name__ == '__main__':
-    test_db = Storage()
-    test_db.user_login('Clinet 1', '192.168.0.1', 8080)
-    test_db.user_login('Clinet 2', '192.168.0.2', 8081)
+    def merge_stats(self, rows):
+        """Add statistics which isn't saved yet to the statistics rows"""
+        history = []
+        for name, last_login, sent, accepted, user_id in rows:
+            sent_delta, accepted_delta = self.stats.get(user_id)
+            history.append((name, last_login, sent + sent_delta, accepted + accepted_delta))
+        return history
 
-    print(test_db.active_users_list())
-    print(test_db.login_history())
-
-    test_db.user_logout('Clinet 1')
+    def message_history(self):
+        """Getting users messages statistics method. Includes statistics which isn't saved yet"""
+        return self.merge_stats(self.history_query().all())
+
+    def message_history_page(self, after=None, limit=HISTORY_PAGE_SIZE, sort='name', descending=False,
+                             name_filter=''):
+        """Getting a page of users messages statistics sorted and filtered by the database.
+        After is a key of the last row of the previous page. Returns rows and a key of the next page
+        or None if it's the last page. Rows are sorted by saved statistics, so not saved messages
+        can change the order until the next flush
+        """
+        index = HISTORY_SORT_KEYS.index(sort)
+        column = (self.Users.name, self.Users.last_login, self.UsersHistory.sent, self.UsersHistory.accepted)[index]
+
+        query = self.history_query()
+        if name_filter:
+            query = query.filter(self.Users.name.contains(name_filter, autoescape=True))
+        if after is not None:
+            value, user_id = after
+            if descending:
+                query = query.filter(or_(column < value, and_(column == value, self.Users.id < user_id)))
+            else:
+                query = query.filter(or_(column > value, and_(column == value, self.Users.id > user_id)))
+
+        if descending:
+            query = query.order_by(column.desc(), self.Users.id.desc())
+        else:
+            query = query.order_by(column, self.Users.id)
 
-    print(test_db.active_users_list())
-    print(test_db.login_history())
+        rows = query.limit(limit).all()
+        next_key = (rows[-1][index], rows[-1][-1]) if len(rows) == limit else None
+        return self.merge_stats(rows), next_key
 
-    print(test_db.users_list())
@@ -3,7 +3,7 @@ import sys
 
 from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QLabel, QTableView
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QObject, pyqtSignal
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
@@ -11,6 +11,12 @@ from server.stat_window import StatWindow
 from server.config_window import ConfigWindow
 from server.add_user import RegisterUser
 from server.remove_user import DelUserDialog
+from server.active_users import USER_ADDED
+
+
+class ActiveUsersFeed(QObject):
+    """Passes server active users events to the window thread"""
+    changed = pyqtSignal(str, object)
 
 
 class MainWindow(QMainWindow):
@@ -69,10 +75,14 @@ class MainWindow(QMainWindow):
         self.active_clients_table.setFixedSize(780, 400)
         self.active_clients_table.move(10, 55)
 
-        # -- Create active users list update timer ---------------
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.update_active_users_list)
-        self.timer.start(1000)
+        # -- Server calls subscribers from its thread, signal passes events to the window thread.
+        # -- Active users table model is filled once and changed by these events
+        self.active_users_model = None
+        self.active_users_rows = dict()  # Table rows first items {client_name: QStandardItem}
+        self.active_users_feed = ActiveUsersFeed()
+        self.active_users_feed.changed.connect(self.apply_active_users_event)
+        self.server_thread.subscribe_active_users(self.active_users_feed.changed.emit)
+        self.update_active_users_list()
 
         # -- Bind main window menu items with functions ----------
         self.refresh_button.triggered.connect(self.update_active_users_list)
@@ -83,36 +93,59 @@ class MainWindow(QMainWindow):
 
         self.show()
 
-    def get_active_users_model(self):
-        """Creating active users list table method"""
-        users_list = self.db.active_users_list()
-        table_list = QStandardItemModel()
-        table_list.setHorizontalHeaderLabels(['Клиент', 'IP Адрес', 'Порт', 'Время подключения'])
-        for row in users_list:
-            user, ip, port, time = row
-            user = QStandardItem(user)
-            user.setEditable(False)
+    @staticmethod
+    def get_active_user_row(row, buffer_size=0):
+        """Creating active users table row items method"""
+        user, ip, port, time = row
+        buffer = QStandardItem(str(buffer_size))
+        buffer.setEditable(False)
 
-            ip = QStandardItem(ip)
-            ip.setEditable(False)
+        user = QStandardItem(user)
+        user.setEditable(False)
 
-            port = QStandardItem(str(port))
-            port.setEditable(False)
+        ip = QStandardItem(ip)
+        ip.setEditable(False)
 
-            time = QStandardItem(str(time.replace(microsecond=0)))
-            time.setEditable(False)
+        port = QStandardItem(str(port))
+        port.setEditable(False)
 
-            table_list.appendRow([user, ip, port, time])
+        time = QStandardItem(str(time.replace(microsecond=0)))
+        time.setEditable(False)
+
+        return [user, ip, port, time, buffer]
+
+    def get_active_users_model(self):
+        """Creating active users list table method"""
+        users_list = self.server_thread.active_users_list()
+        buffers = self.server_thread.buffer_stats()
+        table_list = QStandardItemModel()
+        table_list.setHorizontalHeaderLabels(['Клиент', 'IP Адрес', 'Порт', 'Время подключения', 'Исх. буфер, байт'])
+        self.active_users_rows = dict()
+        for row in users_list:
+            items = self.get_active_user_row(row, buffers.get(row[0], 0))
+            table_list.appendRow(items)
+            self.active_users_rows[row[0]] = items[0]
 
         return table_list
 
     def update_active_users_list(self):
-        """Updating active users list table if new client connected method"""
-
-        self.active_clients_table.setModel(self.get_active_users_model())
+        """Reloading active users list table method. Outbound buffers sizes are updated only here"""
+        self.active_users_model = self.get_active_users_model()
+        self.active_clients_table.setModel(self.active_users_model)
         self.active_clients_table.resizeColumnsToContents()
         self.active_clients_table.resizeRowsToContents()
 
+    def apply_active_users_event(self, event, user):
+        """Adding or removing one row of the active users table on the server event"""
+        item = self.active_users_rows.pop(user[0], None)
+        if item is not None:
+            self.active_users_model.removeRow(item.row())
+
+        if event == USER_ADDED:
+            items = self.get_active_user_row(user)
+            self.active_users_model.appendRow(items)
+            self.active_users_rows[user[0]] = items[0]
+
     def show_statistics(self):
         """Creating user statistics window method"""
         global stat_window
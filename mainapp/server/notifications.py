@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from common.variables import EVENT, ACCOUNT_NAME, EVENT_USER_ADDED, EVENT_USER_REMOVED, EVENT_KEY_CHANGED, \
+    FINGERPRINT, NOTIFY_DELAY
+
+
+def client_events(events, recipients, name):
+    """Events to be sent to a client: all users list changes
+    and public key changes of the users who are in the client's contacts
+    """
+    return [event for event in events
+            if event[EVENT] != EVENT_KEY_CHANGED or name in recipients.get(event[ACCOUNT_NAME], ())]
+
+
+class Notifier:
+    """Registered users list and public keys changes waiting to be sent to the clients.
+    Changes can be added from any thread. Bursts of changes are coalesced:
+    events are taken by the server cycle not earlier than delay after the first one,
+    so bulk operations end up in a single notification for every client
+    """
+    def __init__(self, delay=NOTIFY_DELAY):
+        self.delay = delay
+        self.events = dict()  # The last event of every user {(client_name, is_key_event): event}
+        self.recipients = dict()  # Users who get a key change, they have the user in contacts {client_name: {names}}
+        self.first_event_time = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.events)
+
+    def users_changed(self, added=(), removed=()):
+        """Save users list changes"""
+        with self.lock:
+            for name in added:
+                self.add_event(name, EVENT_USER_ADDED)
+            for name in removed:
+                self.add_event(name, EVENT_USER_REMOVED)
+
+    def key_changed(self, name, fingerprint, recipients=()):
+        """Save public key change of a user. Only recipients get it"""
+        with self.lock:
+            self.add_event(name, EVENT_KEY_CHANGED, {FINGERPRINT: fingerprint})
+            self.recipients[name] = set(recipients)
+
+    def add_event(self, name, event, data=None):
+        # -- The latest change of a user replaces the previous one. Key changes are kept apart
+        # -- from the users list changes
+        key = (name, event == EVENT_KEY_CHANGED)
+        self.events.pop(key, None)
+        self.events[key] = {EVENT: event, ACCOUNT_NAME: name, **(data or {})}
+        if self.first_event_time is None:
+            self.first_event_time = time.monotonic()
+
+    def take_with_recipients(self):
+        """Events ready to be sent and recipients of the key changes {client_name: {names}}"""
+        with self.lock:
+            if not self.events or time.monotonic() - self.first_event_time < self.delay:
+                return [], {}
+            events = list(self.events.values())
+            recipients = self.recipients
+            self.events = dict()
+            self.recipients = dict()
+            self.first_event_time = None
+        return events, recipients
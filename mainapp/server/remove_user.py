@@ -44,12 +44,9 @@ class DelUserDialog(QDialog):
 
     def remove_user(self):
         """Delete user handler method"""
-        self.db.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.clients_names:
-            sock = self.server.clients_names[self.selector.currentText()]
-            del self.server.clients_names[self.selector.currentText()]
-            self.server.remove_client(sock)
+        self.server.disconnect_user(self.selector.currentText())
+        self.db.remove_user(self.selector.currentText()).result()
 
         # -- Send signals to clients fo users list update ----------
-        self.server.service_update_lists()
+        self.server.notify_users_changed(removed=[self.selector.currentText()])
         self.close()
@@ -1,6 +1,84 @@
-from PyQt5.QtWidgets import QDialog, QPushButton, QTableView
-from PyQt5.QtGui import QStandardItemModel, QStandardItem
-from PyQt5.QtCore import Qt
+import datetime
+
+from PyQt5.QtWidgets import QDialog, QPushButton, QTableView, QLineEdit
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+
+from server.db import HISTORY_SORT_KEYS
+from common.variables import HISTORY_PAGE_SIZE
+
+
+class PagedTableModel(QAbstractTableModel):
+    """Read only table model which reads rows from the database by pages while the view is scrolled.
+    fetch_page(after=key, limit=size, **query) must return rows and a key of the next page or None.
+    Sorting and filtering are made by the database query
+    """
+
+    def __init__(self, fetch_page, headers, sort_keys=(), page_size=HISTORY_PAGE_SIZE):
+        super().__init__()
+        self.fetch_page = fetch_page
+        self.headers = headers
+        self.sort_keys = sort_keys  # Sort key of the query for every sortable column
+        self.page_size = page_size
+        self.query = dict()  # Sort and filter arguments of the page query
+
+        self.rows = []
+        self.next_key = None
+        self.exhausted = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        value = self.rows[index.row()][index.column()]
+        if isinstance(value, datetime.datetime):
+            value = value.replace(microsecond=0)
+        return str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return super().headerData(section, orientation, role)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        """Read the next page of rows"""
+        if parent.isValid() or self.exhausted:
+            return
+        rows, self.next_key = self.fetch_page(after=self.next_key, limit=self.page_size, **self.query)
+        self.exhausted = self.next_key is None
+        if not rows:
+            return
+
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if column >= len(self.sort_keys):
+            return
+        self.query['sort'] = self.sort_keys[column]
+        self.query['descending'] = order == Qt.DescendingOrder
+        self.reload()
+
+    def set_filter(self, name_filter):
+        """Show only the rows with user names containing the text"""
+        self.query['name_filter'] = name_filter
+        self.reload()
+
+    def reload(self):
+        """Drop loaded rows, the view will fetch the first page again"""
+        self.beginResetModel()
+        self.rows = []
+        self.next_key = None
+        self.exhausted = False
+        self.endResetModel()
 
 
 class StatWindow(QDialog):
@@ -23,36 +101,29 @@ class StatWindow(QDialog):
         self.close_button.move(250, 650)
         self.close_button.clicked.connect(self.close)
 
+        # -- User name filter ------------------------------
+        self.filter_edit = QLineEdit(self)
+        self.filter_edit.setPlaceholderText('Поиск клиента')
+        self.filter_edit.setFixedSize(580, 25)
+        self.filter_edit.move(10, 10)
+
         # -- Statistics list table -------------------------
         self.stat_table = QTableView(self)
-        self.stat_table.setFixedSize(580, 620)
-        self.stat_table.move(10, 10)
+        self.stat_table.setFixedSize(580, 595)
+        self.stat_table.move(10, 45)
 
         self.create_stat_model()
 
     def create_stat_model(self):
-        """Creating statistics window and fill in the user statistics table"""
-        hist_list = self.db.message_history()
-
-        table = QStandardItemModel()
-
-        table.setHorizontalHeaderLabels(['Клиент', 'Последний вход', 'Сообщений\nотправлено', 'Сообщений\nполучено'])
-        for row in hist_list:
-            user, last_seen, sent, recvd = row
-            user = QStandardItem(user)
-            user.setEditable(False)
-
-            last_seen = QStandardItem(str(last_seen.replace(microsecond=0)))
-            last_seen.setEditable(False)
-
-            sent = QStandardItem(str(sent))
-            sent.setEditable(False)
-
-            recvd = QStandardItem(str(recvd))
-            recvd.setEditable(False)
-
-            table.appendRow([user, last_seen, sent, recvd])
-
-        self.stat_table.setModel(table)
+        """Creating statistics window model. Rows are read from the database while the table is scrolled"""
+        self.stat_model = PagedTableModel(
+            self.db.message_history_page,
+            ['Клиент', 'Последний вход', 'Сообщений\nотправлено', 'Сообщений\nполучено'],
+            HISTORY_SORT_KEYS
+        )
+        self.filter_edit.textChanged.connect(self.stat_model.set_filter)
+
+        self.stat_table.setModel(self.stat_model)
+        self.stat_table.setSortingEnabled(True)
+        self.stat_table.sortByColumn(0, Qt.AscendingOrder)
         self.stat_table.resizeColumnsToContents()
-        self.stat_table.resizeRowsToContents()
@@ -0,0 +1,46 @@
+import binascii
+import hashlib
+import hmac
+import sys
+import os
+import time
+
+from socket import socket, AF_INET, SOCK_STREAM
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.variables import RESPONSE, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, PUBLIC_KEY, DATA, FRAMING, \
+    FRAMING_LENGTH, DEFAULT_IP_ADDRESS
+from common.utils import get_message, send_message, MessageDecoder
+
+
+def passwd_hash(name):
+    """Password hash the same way client makes it"""
+    return binascii.hexlify(hashlib.pbkdf2_hmac('sha512', b'123456', name.lower().encode('utf-8'), 10000))
+
+
+class ServerClient:
+    """Simple client which authorizes on the server and exchanges messages"""
+    def __init__(self, name, port, pubkey=None):
+        self.name = name
+        self.decoder = MessageDecoder()
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.settimeout(5)
+        self.sock.connect((DEFAULT_IP_ADDRESS, port))
+
+        self.send({ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: name, PUBLIC_KEY: pubkey or name},
+                   FRAMING: FRAMING_LENGTH})
+        challenge = self.get()
+        if challenge[RESPONSE] != 511:
+            self.answer = challenge
+            return
+        self.decoder.framed = challenge.get(FRAMING) == FRAMING_LENGTH
+        digest = hmac.new(passwd_hash(name), challenge[DATA].encode('utf-8'), 'MD5').digest()
+        self.send({RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')})
+        self.answer = self.get()
+
+    def send(self, message):
+        send_message(self.sock, message, self.decoder.framed)
+
+    def get(self):
+        return get_message(self.sock, self.decoder)
@@ -0,0 +1,144 @@
+import sys
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, MESSAGE, SENDER, DESTINATION, \
+    MESSAGE_TEXT, DATA, GET_CONTACTS, ADD_CONTACT, REMOVE_CONTACT, USERS_REQUEST, PUBLIC_KEY_REQUEST, LIST_INFO, \
+    VERSION, EXIT, DEFAULT_IP_ADDRESS, DEFAULT_PORT
+from server.async_core import AsyncMessageProcessor
+from server.db import Storage
+from server_client import ServerClient, passwd_hash
+
+ASYNC_PORT = DEFAULT_PORT + 300
+USERS = [f'async_{i}' for i in range(3)]
+
+
+class TestAsyncMessageProcessor(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db = Storage(os.path.join(self.db_dir.name, 'async.sqlite'))
+        for name in USERS:
+            self.db.add_user(name, passwd_hash(name)).result()
+
+        self.server = AsyncMessageProcessor(self.db, DEFAULT_IP_ADDRESS, ASYNC_PORT)
+        self.server.daemon = True
+        self.server.start()
+        self.clients = []
+
+        # -- Wait for the server to start listening
+        for _ in range(50):
+            try:
+                self.clients.append(ServerClient(USERS[0], ASYNC_PORT))
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    def tearDown(self) -> None:
+        for client in self.clients:
+            client.sock.close()
+        self.server.running = False
+        self.server.join()
+        self.db.close()
+        self.db_dir.cleanup()
+
+    def client(self, name):
+        client = ServerClient(name, ASYNC_PORT)
+        self.clients.append(client)
+        return client
+
+    def request(self, client, action, fields):
+        """Send a request and get the answer"""
+        client.send({ACTION: action, TIME: time.time(), **fields})
+        return client.get()
+
+    def test_authorization(self):
+        """ Tests that registered user is authorized once and unknown user is rejected """
+        self.assertEqual(self.clients[0].answer, {RESPONSE: 200})
+        self.assertEqual(self.client(USERS[0]).answer[ERROR], 'Имя пользователя уже занято.')
+        self.assertEqual(self.client('unknown').answer[ERROR], 'Пользователь не зарегистрирован.')
+        self.assertEqual([user[0] for user in self.server.active_users_list()], [USERS[0]])
+
+    def test_message(self):
+        """ Tests that a message is delivered to the connected user and the sender gets an answer """
+        sender, receiver = self.clients[0], self.client(USERS[1])
+        message = {ACTION: MESSAGE, TIME: time.time(), SENDER: sender.name, DESTINATION: receiver.name,
+                   MESSAGE_TEXT: 'text'}
+        sender.send(message)
+
+        self.assertEqual(sender.get(), {RESPONSE: 200})
+        self.assertEqual(receiver.get(), message)
+
+    def test_contacts(self):
+        """ Tests contacts adding, reading and removing """
+        client = self.clients[0]
+        self.assertEqual(self.request(client, ADD_CONTACT, {USER: client.name, ACCOUNT_NAME: USERS[1]}),
+                         {RESPONSE: 200})
+        self.assertEqual(self.request(client, GET_CONTACTS, {USER: client.name})[LIST_INFO], [USERS[1]])
+
+        self.assertEqual(self.request(client, REMOVE_CONTACT, {USER: client.name, ACCOUNT_NAME: USERS[1]}),
+                         {RESPONSE: 200})
+        self.assertEqual(self.request(client, GET_CONTACTS, {USER: client.name})[LIST_INFO], [])
+
+    def test_users_request(self):
+        """ Tests that the full users list is sent to a client without the list version """
+        answer = self.request(self.clients[0], USERS_REQUEST, {ACCOUNT_NAME: USERS[0]})
+        self.assertEqual((answer[RESPONSE], sorted(answer[LIST_INFO])), (202, USERS))
+        self.assertGreater(answer[VERSION], 0)
+
+    def test_pubkey_request(self):
+        """ Tests that a public key saved at login is sent to other users """
+        self.client(USERS[1])
+        for _ in range(50):
+            answer = self.request(self.clients[0], PUBLIC_KEY_REQUEST, {ACCOUNT_NAME: USERS[1]})
+            if answer[RESPONSE] == 511:
+                break
+            time.sleep(0.1)
+        self.assertEqual(answer[DATA], USERS[1])
+
+        answer = self.request(self.clients[0], PUBLIC_KEY_REQUEST, {ACCOUNT_NAME: USERS[2]})
+        self.assertEqual(answer[RESPONSE], 400)
+
+    def test_offline_message(self):
+        """ Tests that a message to a logged out user is delivered at the next login """
+        receiver = self.client(USERS[1])
+        receiver.send({ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: receiver.name})
+        for _ in range(50):
+            if USERS[1] not in self.server.clients_names:
+                break
+            time.sleep(0.1)
+        self.assertEqual(list(self.server.writers_names.values()), [USERS[0]])
+
+        message = {ACTION: MESSAGE, TIME: time.time(), SENDER: USERS[0], DESTINATION: USERS[1],
+                   MESSAGE_TEXT: 'offline'}
+        self.clients[0].send(message)
+        self.assertEqual(self.clients[0].get(), {RESPONSE: 200})
+
+        self.assertEqual(self.client(USERS[1]).get(), message)
+
+    def test_offline_messages_order(self):
+        """ Tests that stored messages are delivered by batches before new messages and removed """
+        for i in range(5):
+            self.db.store_message(USERS[1], {ACTION: MESSAGE, SENDER: USERS[0], MESSAGE_TEXT: str(i)}).result()
+
+        with mock.patch('server.async_core.OFFLINE_BATCH_SIZE', 2):
+            receiver = self.client(USERS[1])
+            self.clients[0].send({ACTION: MESSAGE, TIME: time.time(), SENDER: USERS[0], DESTINATION: USERS[1],
+                                  MESSAGE_TEXT: 'new'})
+            self.assertEqual(self.clients[0].get(), {RESPONSE: 200})
+            texts = [receiver.get()[MESSAGE_TEXT] for _ in range(6)]
+        self.assertEqual(texts, ['0', '1', '2', '3', '4', 'new'])
+
+        for _ in range(50):
+            if not self.db.get_offline_messages(USERS[1], 0, 10).result():
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.db.get_offline_messages(USERS[1], 0, 10).result(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import sqlite3
+import sys
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from client.database import ClientDatabase
+from common.migrations import add_column, migrate
+from common.variables import MESSAGE_PENDING, MESSAGE_SENT
+
+
+class TestClientHistory(unittest.TestCase):
+    def setUp(self) -> None:
+        # -- Client database file is created in the working directory
+        self.cwd = os.getcwd()
+        self.db_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.db_dir.name)
+        self.db = ClientDatabase('test')
+
+        for i in range(7):
+            self.db.save_message('contact', 'in' if i % 2 else 'out', f'message {i}')
+        self.db.save_message('other', 'in', 'other message')
+
+    def tearDown(self) -> None:
+        self.db.session.close()
+        self.db.engine.dispose()
+        os.chdir(self.cwd)
+        self.db_dir.cleanup()
+
+    def test_history_pages(self):
+        """ Tests that pages of older messages follow each other without gaps in the date order """
+        texts = []
+        history_key = None
+        for _ in range(3):
+            messages, history_key = self.db.get_history_page('contact', history_key, limit=3)
+            texts = [message[2] for message in messages] + texts
+
+        self.assertEqual(texts, [f'message {i}' for i in range(7)])
+        self.assertIsNone(history_key)
+
+    def test_history_filter(self):
+        """ Tests that messages are filtered by the contact and direction """
+        self.assertEqual(len(self.db.get_history('contact')), 7)
+        self.assertEqual(len(self.db.get_history('contact', 'in')), 3)
+
+    def test_threads(self):
+        """ Tests that the database is used by several threads at once """
+        def save(thread):
+            for i in range(20):
+                self.db.save_message(f'thread {thread}', 'in', f'message {i}')
+                self.db.get_history(f'thread {thread}')
+
+        threads = [threading.Thread(target=save, args=(i, )) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([len(self.db.get_history(f'thread {i}')) for i in range(4)], [20] * 4)
+
+    def test_contact_key_removed(self):
+        """ Tests that public key of a removed contact isn't kept, its changes aren't reported """
+        self.db.add_contact('contact')
+        self.db.save_pubkey('contact', 'key', 'fingerprint')
+        self.db.del_contact('contact')
+        self.assertIsNone(self.db.get_pubkey('contact'))
+
+
+class TestClientOutbox(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.db_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.db_dir.name)
+        self.db = ClientDatabase('test')
+
+    def tearDown(self) -> None:
+        self.db.session.close()
+        self.db.engine.dispose()
+        os.chdir(self.cwd)
+        self.db_dir.cleanup()
+
+    def test_outbox(self):
+        """ Tests that pending messages are in the outbox until they are sent """
+        first = self.db.save_message('contact', 'out', 'first', MESSAGE_PENDING, 'payload 1')
+        second = self.db.save_message('contact', 'out', 'second', MESSAGE_PENDING, 'payload 2')
+        self.db.save_message('contact', 'in', 'incoming')
+        self.assertEqual(self.db.get_outbox(), [(first, 'contact', 'payload 1'), (second, 'contact', 'payload 2')])
+
+        self.db.set_message_status(first, MESSAGE_SENT)
+        self.assertEqual(self.db.get_outbox(), [(second, 'contact', 'payload 2')])
+        self.assertEqual(self.db.get_history('contact', 'out')[0][4], MESSAGE_SENT)
+
+
+class TestClientMigrations(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.db_dir.name, 'test.sqlite')
+
+    def tearDown(self) -> None:
+        self.db_dir.cleanup()
+
+    def test_add_column(self):
+        """ Tests that a column is added once when migration is repeated """
+        connection = sqlite3.connect(self.db_path)
+        connection.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY)')
+        connection.close()
+
+        engine = create_engine('sqlite:///' + self.db_path)
+        migrations = [[add_column('messages', 'status VARCHAR(10)')]]
+        self.assertEqual(migrate(engine, migrations), 1)
+        with engine.begin() as connection:
+            connection.exec_driver_sql('PRAGMA user_version=0')
+        self.assertEqual(migrate(engine, migrations), 1)
+        engine.dispose()
+
+        connection = sqlite3.connect(self.db_path)
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(messages)')]
+        connection.close()
+        self.assertEqual(columns, ['id', 'status'])
+
+
+if __name__ == '__main__':
+    unittest.main()
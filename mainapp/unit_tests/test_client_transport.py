@@ -0,0 +1,90 @@
+import sys
+import os
+import unittest
+from unittest import mock
+
+from socket import socketpair
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from client.transport import ClientTransport
+from common.utils import get_message, send_message, MessageDecoder
+from common.variables import RESPONSE, ACTION, LIST_INFO, GET_CONTACTS, USERS_REQUEST, REQUEST_ID
+
+
+class TestClientTransport(unittest.TestCase):
+    """Transport is connected to one end of a socket pair, the test plays the server on the other end"""
+    def setUp(self) -> None:
+        self.server, client = socketpair()
+        self.server.settimeout(5)
+        self.decoder = MessageDecoder(framed=True)
+
+        def connection_init(transport):
+            client.settimeout(1)
+            transport.transport = client
+            transport.decoder.framed = True
+
+        with mock.patch.object(ClientTransport, 'connection_init', connection_init), \
+                mock.patch.object(ClientTransport, 'user_list_update'), \
+                mock.patch.object(ClientTransport, 'contacts_list_request'), \
+                mock.patch.object(ClientTransport, 'keys_request'):
+            self.transport = ClientTransport(0, '', mock.Mock(), 'test', '', None)
+
+    def tearDown(self) -> None:
+        self.transport.transport_shutdown()
+        if self.transport.is_alive():
+            self.transport.join(5)
+        self.server.close()
+
+    def requests(self, count):
+        """Send requests and read them on the server side"""
+        futures = [self.transport.request({ACTION: GET_CONTACTS}) for _ in range(count)]
+        return futures, [get_message(self.server, self.decoder) for _ in range(count)]
+
+    def answer(self, message):
+        send_message(self.server, message, True)
+
+    def test_answers_matched_by_id(self):
+        """ Tests that answers sent in another order are passed to their requests """
+        self.transport.start()
+        futures, requests = self.requests(2)
+        for request in reversed(requests):
+            self.answer({RESPONSE: 202, LIST_INFO: [request[REQUEST_ID]], REQUEST_ID: request[REQUEST_ID]})
+        self.assertEqual([future.result(5)[LIST_INFO] for future in futures],
+                         [[request[REQUEST_ID]] for request in requests])
+
+    def test_answers_without_ids(self):
+        """ Tests that answers of a server which doesn't return ids are passed to the oldest requests """
+        self.transport.start()
+        futures, _ = self.requests(2)
+        self.answer({RESPONSE: 202, LIST_INFO: ['first']})
+        self.answer({RESPONSE: 202, LIST_INFO: ['second']})
+        self.assertEqual([future.result(5)[LIST_INFO] for future in futures], [['first'], ['second']])
+
+    def test_answer_before_start(self):
+        """ Tests that an answer is read by the waiting thread until the reader thread is started """
+        future = self.transport.request({ACTION: USERS_REQUEST})
+        request = get_message(self.server, self.decoder)
+        self.answer({RESPONSE: 202, LIST_INFO: [], REQUEST_ID: request[REQUEST_ID]})
+        self.assertEqual(self.transport.wait_answer(future)[RESPONSE], 202)
+
+    def test_answer_timeout(self):
+        """ Tests that a request without an answer raises socket timeout and is forgotten """
+        self.transport.start()
+        with mock.patch('client.transport.REQUEST_TIMEOUT', 0.2):
+            with self.assertRaises(OSError):
+                self.transport.wait_answer(self.requests(1)[0][0])
+        self.assertEqual(len(self.transport.requests), 0)
+
+    def test_requests_failed_on_disconnect(self):
+        """ Tests that requests waiting for answers fail when the connection is lost """
+        self.transport.start()
+        futures, _ = self.requests(2)
+        self.server.close()
+        for future in futures:
+            self.assertIsInstance(future.exception(5), ConnectionResetError)
+        self.assertFalse(self.transport.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
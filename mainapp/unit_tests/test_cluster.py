@@ -0,0 +1,210 @@
+import sys
+import os
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.variables import RESPONSE, USER, ACCOUNT_NAME, TIME, ACTION, PUBLIC_KEY, MESSAGE, SENDER, \
+    DESTINATION, MESSAGE_TEXT, DEFAULT_IP_ADDRESS, DEFAULT_PORT, EVENTS, EVENT, EVENT_USER_ADDED, EVENT_KEY_CHANGED, \
+    FINGERPRINT, REQUEST_ID, GET_CONTACTS, LIST_INFO, PUBLIC_KEYS_REQUEST, ONLINE, ADD_CONTACT, NOTIFY_DELAY
+from common.utils import key_fingerprint
+from server.cluster import ClusterServer, cluster_supported, send_bus_message, BUS_ACTION, BUS_DELIVER
+from server.active_users import USER_ADDED, USER_REMOVED
+from server.db import Storage
+from server_client import ServerClient, passwd_hash
+
+CLUSTER_PORT = DEFAULT_PORT + 100
+USERS = [f'cluster_{i}' for i in range(10)]
+
+
+class ClusterClient(ServerClient):
+    """Client of the cluster port"""
+    def __init__(self, name, pubkey=None):
+        super().__init__(name, CLUSTER_PORT, pubkey)
+
+
+@unittest.skipUnless(cluster_supported(), 'Cluster mode requires SO_REUSEPORT and Unix sockets')
+class TestCluster(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.db_dir.name, 'cluster.sqlite')
+        db = Storage(db_path)
+        for name in USERS:
+            db.add_user(name, passwd_hash(name))
+        db.close()
+
+        self.server = ClusterServer(db_path, DEFAULT_IP_ADDRESS, CLUSTER_PORT, 2)
+        self.server.start()
+        self.clients = []
+
+        # -- Wait for workers to start listening
+        for _ in range(50):
+            try:
+                self.clients.append(ClusterClient(USERS[0]))
+                break
+            except OSError:
+                time.sleep(0.2)
+        for _ in range(50):
+            if all(os.path.exists(path) for path in self.server.bus_paths):
+                break
+            time.sleep(0.1)
+
+    def tearDown(self) -> None:
+        for client in self.clients:
+            client.sock.close()
+        self.server.stop()
+        self.db_dir.cleanup()
+
+    def test_workers_share_port(self):
+        """ Tests that clients are served by both workers """
+        self.clients += [ClusterClient(name) for name in USERS[1:]]
+
+        for client in self.clients:
+            self.assertEqual(client.answer, {RESPONSE: 200})
+        self.assertEqual(set(self.server.clients_names), set(USERS))
+        self.assertEqual(set(self.server.clients_names.values()), {0, 1})
+        self.assertEqual(sorted(user[0] for user in self.server.active_users_list()), sorted(USERS))
+
+    def test_cross_worker_delivery(self):
+        """ Tests that every user receives messages from users of any worker """
+        self.clients += [ClusterClient(name) for name in USERS[1:]]
+
+        for sender in self.clients:
+            for receiver in self.clients:
+                if sender is not receiver:
+                    sender.send({ACTION: MESSAGE, SENDER: sender.name, DESTINATION: receiver.name,
+                                 TIME: time.time(), MESSAGE_TEXT: f'{sender.name}->{receiver.name}'})
+
+        for client in self.clients:
+            received = [client.get() for _ in range(2 * (len(self.clients) - 1))]
+            texts = {message[MESSAGE_TEXT] for message in received if MESSAGE_TEXT in message}
+            answers = [message for message in received if RESPONSE in message]
+            self.assertEqual(texts, {f'{name}->{client.name}' for name in USERS if name != client.name})
+            self.assertEqual(answers, [{RESPONSE: 200}] * (len(self.clients) - 1))
+
+    def test_presence_events(self):
+        """ Tests that server process gets login and logout events of all the workers """
+        events = []
+        # -- Login event of the first user could be received after subscription
+        self.server.subscribe_active_users(
+            lambda event, user: user.name == USERS[1] and events.append((event, user.name)))
+        client = ClusterClient(USERS[1])
+        client.sock.close()
+
+        for _ in range(50):
+            if len(events) == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(events, [(USER_ADDED, USERS[1]), (USER_REMOVED, USERS[1])])
+
+    def test_users_notifications(self):
+        """ Tests that clients of all the workers get one notification for a burst of changes """
+        self.clients += [ClusterClient(name) for name in USERS[1:]]
+        self.server.notify_users_changed(added=['first'])
+        self.server.notify_users_changed(added=['second'])
+
+        for client in self.clients:
+            notification = client.get()
+            self.assertEqual(notification[RESPONSE], 205)
+            self.assertEqual([(event[EVENT], event[ACCOUNT_NAME]) for event in notification[EVENTS]],
+                             [(EVENT_USER_ADDED, 'first'), (EVENT_USER_ADDED, 'second')])
+
+    def test_key_changed_notification(self):
+        """ Tests that users of all the workers who have a user in contacts are told
+        that the user has logged in with a new public key
+        """
+        self.clients += [ClusterClient(name) for name in USERS[1:]]
+        self.clients.pop(1).sock.close()
+        watchers, others = self.clients[:3], self.clients[3:]
+        for client in watchers:
+            client.send({ACTION: ADD_CONTACT, TIME: time.time(), USER: client.name, ACCOUNT_NAME: USERS[1]})
+            self.assertEqual(client.get(), {RESPONSE: 200})
+            # -- Contacts are read after the contact is saved
+            client.send({ACTION: GET_CONTACTS, TIME: time.time(), USER: client.name})
+            self.assertEqual(client.get()[LIST_INFO], [USERS[1]])
+
+        # -- Old connection is closed by the worker asynchronously
+        for _ in range(50):
+            client = ClusterClient(USERS[1], 'new key')
+            if client.answer[RESPONSE] == 200:
+                self.clients.append(client)
+                break
+            client.sock.close()
+            time.sleep(0.1)
+
+        for client in watchers:
+            notification = client.get()
+            self.assertEqual(notification[RESPONSE], 205)
+            self.assertEqual(notification[EVENTS], [{EVENT: EVENT_KEY_CHANGED, ACCOUNT_NAME: USERS[1],
+                                                     FINGERPRINT: key_fingerprint('new key')}])
+
+        # -- Other clients get the answer without a notification before it
+        time.sleep(NOTIFY_DELAY * 2 + 0.5)
+        for client in others + [self.clients[-1]]:
+            client.send({ACTION: GET_CONTACTS, TIME: time.time(), USER: client.name})
+            self.assertEqual(client.get()[RESPONSE], 202)
+
+    def test_request_ids(self):
+        """ Tests that answers to requests sent without waiting have the ids of the requests """
+        client = self.clients[0]
+        for request_id in range(1, 6):
+            client.send({ACTION: GET_CONTACTS, TIME: time.time(), USER: USERS[0], REQUEST_ID: request_id})
+
+        answers = [client.get() for _ in range(5)]
+        self.assertEqual([answer[REQUEST_ID] for answer in answers], [1, 2, 3, 4, 5])
+        self.assertEqual([answer[LIST_INFO] for answer in answers], [[]] * 5)
+
+    def test_pubkeys_request(self):
+        """ Tests that keys and presence of users connected to any worker are sent by one answer """
+        self.clients += [ClusterClient(name) for name in USERS[1:3]]
+        client = self.clients[0]
+
+        # -- Public keys are saved after login asynchronously
+        for _ in range(50):
+            client.send({ACTION: PUBLIC_KEYS_REQUEST, TIME: time.time(), LIST_INFO: USERS[1:4] + ['unknown']})
+            answer = client.get()
+            if len(answer[LIST_INFO]) == 2:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(answer[RESPONSE], 202)
+        self.assertEqual(sorted((user[ACCOUNT_NAME], user[PUBLIC_KEY], user[ONLINE]) for user in answer[LIST_INFO]),
+                         [(USERS[1], USERS[1], True), (USERS[2], USERS[2], True)])
+
+    def test_duplicate_login_on_other_worker(self):
+        """ Tests that user connected to one worker can't login on any other worker """
+        for _ in range(4):
+            client = ClusterClient(USERS[0])
+            self.clients.append(client)
+            self.assertEqual(client.answer[RESPONSE], 400)
+
+    def test_dead_worker_users_removed(self):
+        """ Tests that users of a crashed worker are removed from the directory and can login again """
+        events = []
+        self.server.subscribe_active_users(lambda event, user: events.append((event, user.name)))
+        self.server.processes[self.server.clients_names[USERS[0]]].kill()
+
+        for _ in range(50):
+            if USERS[0] not in self.server.clients_names:
+                break
+            time.sleep(0.1)
+        # -- Login event of the first user could be received after subscription
+        self.assertEqual(events[-1], (USER_REMOVED, USERS[0]))
+        self.assertEqual(ClusterClient(USERS[0]).answer, {RESPONSE: 200})
+
+    def test_routed_message_saved(self):
+        """ Tests that a message routed to a worker the user has left is saved for the next login """
+        message = {ACTION: MESSAGE, TIME: time.time(), SENDER: USERS[0], DESTINATION: USERS[1],
+                   MESSAGE_TEXT: 'routed'}
+        send_bus_message(self.server.bus, self.server.bus_paths[0], {BUS_ACTION: BUS_DELIVER, MESSAGE: message})
+        time.sleep(1)
+
+        client = ClusterClient(USERS[1])
+        self.clients.append(client)
+        self.assertEqual(client.get(), message)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import sys
+import os
+import unittest
+
+from socket import socketpair
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from server.connections import ConnectionRegistry
+from server.active_users import ActiveUsers, USER_ADDED, USER_REMOVED
+from server.notifications import Notifier, client_events
+from common.variables import EVENT, ACCOUNT_NAME, EVENT_USER_ADDED, EVENT_USER_REMOVED, EVENT_KEY_CHANGED, FINGERPRINT
+
+
+class TestConnectionRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = ConnectionRegistry()
+        self.sockets = []
+        for _ in range(2):
+            self.sockets.extend(socketpair())
+
+    def tearDown(self) -> None:
+        for sock in self.sockets:
+            sock.close()
+
+    def test_add_and_get(self):
+        """ Tests that connection is found by its socket """
+        connection = self.registry.add(self.sockets[0], ('127.0.0.1', 1000))
+        self.assertIs(self.registry.get(self.sockets[0]), connection)
+        self.assertIsNone(self.registry.get(self.sockets[1]))
+        self.assertIn(self.sockets[0], self.registry)
+        self.assertEqual(len(self.registry), 1)
+
+    def test_authorize(self):
+        """ Tests that authorized connection is found by the user name """
+        connection = self.registry.add(self.sockets[0], ('127.0.0.1', 1000))
+        self.assertFalse(self.registry.is_authorized(self.sockets[0]))
+
+        self.registry.authorize(connection, 'Guest')
+        self.assertIs(self.registry.get_by_name('Guest'), connection)
+        self.assertTrue(self.registry.is_authorized(self.sockets[0]))
+        self.assertTrue(self.registry.is_authorized(self.sockets[0], 'Guest'))
+        self.assertFalse(self.registry.is_authorized(self.sockets[0], 'Other'))
+        self.assertEqual(self.registry.names(), ['Guest'])
+
+    def test_remove(self):
+        """ Tests that removed connection is deleted from both indexes """
+        connection = self.registry.add(self.sockets[0], ('127.0.0.1', 1000))
+        self.registry.add(self.sockets[2], ('127.0.0.1', 1001))
+        self.registry.authorize(connection, 'Guest')
+
+        self.assertIs(self.registry.remove(self.sockets[0]), connection)
+        self.assertIsNone(self.registry.remove(self.sockets[0]))
+        self.assertIsNone(self.registry.get_by_name('Guest'))
+        self.assertNotIn(self.sockets[0], self.registry)
+        self.assertEqual(len(self.registry), 1)
+
+    def test_closed_socket(self):
+        """ Tests that closed socket isn't found """
+        self.registry.add(self.sockets[0], ('127.0.0.1', 1000))
+        self.sockets[0].close()
+        self.assertIsNone(self.registry.get(self.sockets[0]))
+
+
+class TestActiveUsers(unittest.TestCase):
+    def test_snapshot(self):
+        """ Tests that snapshot is a copy ordered by login time """
+        users = ActiveUsers()
+        users.add('first', '127.0.0.1', 1000)
+        users.add('second', '127.0.0.1', 1001)
+        snapshot = users.snapshot()
+
+        users.remove('first')
+        self.assertEqual([user.name for user in snapshot], ['first', 'second'])
+        self.assertEqual([user[:3] for user in users.snapshot()], [('second', '127.0.0.1', 1001)])
+        self.assertNotIn('first', users)
+
+    def test_subscribers(self):
+        """ Tests that subscribers get every change """
+        users = ActiveUsers()
+        events = []
+        users.subscribe(lambda event, user: events.append((event, user.name)))
+        users.add('first', '127.0.0.1', 1000)
+        users.remove('first')
+        users.remove('unknown')
+        self.assertEqual(events, [(USER_ADDED, 'first'), (USER_REMOVED, 'first')])
+
+
+class TestNotifier(unittest.TestCase):
+    def test_coalescing(self):
+        """ Tests that a burst of changes is taken once with the last change of every user """
+        notifier = Notifier(delay=0)
+        notifier.users_changed(added=['first', 'second'])
+        notifier.users_changed(removed=['first'])
+
+        self.assertEqual(notifier.take_with_recipients(), ([{EVENT: EVENT_USER_ADDED, ACCOUNT_NAME: 'second'},
+                                                            {EVENT: EVENT_USER_REMOVED, ACCOUNT_NAME: 'first'}], {}))
+        self.assertEqual(notifier.take_with_recipients(), ([], {}))
+
+    def test_key_changes(self):
+        """ Tests that key change doesn't replace users list change of the same user """
+        notifier = Notifier(delay=0)
+        notifier.users_changed(added=['first'])
+        notifier.key_changed('first', 'old')
+        notifier.key_changed('first', 'new')
+
+        events, recipients = notifier.take_with_recipients()
+        self.assertEqual(events, [{EVENT: EVENT_USER_ADDED, ACCOUNT_NAME: 'first'},
+                                  {EVENT: EVENT_KEY_CHANGED, ACCOUNT_NAME: 'first', FINGERPRINT: 'new'}])
+        self.assertEqual(recipients, {'first': set()})
+
+    def test_key_change_recipients(self):
+        """ Tests that key change is sent only to its recipients and users list changes are sent to everybody """
+        notifier = Notifier(delay=0)
+        notifier.users_changed(added=['second'])
+        notifier.key_changed('first', 'new', ['contact'])
+
+        events, recipients = notifier.take_with_recipients()
+        self.assertEqual(client_events(events, recipients, 'contact'), events)
+        self.assertEqual(client_events(events, recipients, 'other'), [{EVENT: EVENT_USER_ADDED, ACCOUNT_NAME: 'second'}])
+
+    def test_delay(self):
+        """ Tests that changes aren't taken until the delay is over """
+        notifier = Notifier(delay=60)
+        notifier.users_changed(added=['first'])
+        self.assertEqual(notifier.take_with_recipients(), ([], {}))
+        self.assertEqual(len(notifier), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import sys
+import os
+import selectors
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from socket import socket, socketpair, AF_INET, SOCK_STREAM
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, PUBLIC_KEY, DATA, \
+    MESSAGE, SENDER, DESTINATION, MESSAGE_TEXT, DEFAULT_IP_ADDRESS, DEFAULT_PORT, AUTH_TIMEOUT, OUTBOUND_HIGH_WATER, \
+    OUTBOUND_BUFFER_LIMIT, GET_CONTACTS, LIST_INFO, SELECTOR_TIMEOUT
+from common.utils import get_message, send_message, MessageDecoder
+from server.core import MessageProcessor
+from server.db import Storage
+from server_client import ServerClient, passwd_hash
+
+CORE_PORT = DEFAULT_PORT + 200
+USERS = [f'core_{i}' for i in range(3)]
+
+
+class TestMessageProcessor(unittest.TestCase):
+    engine = 'selectors'
+
+    def setUp(self) -> None:
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db = Storage(os.path.join(self.db_dir.name, 'core.sqlite'))
+        for name in USERS:
+            self.db.add_user(name, passwd_hash(name)).result()
+
+        self.server = MessageProcessor(self.db, DEFAULT_IP_ADDRESS, CORE_PORT, self.engine)
+        self.server.daemon = True
+        self.server.start()
+        self.sockets = []
+
+        # -- Wait for the server to start listening
+        for _ in range(50):
+            try:
+                self.sockets.append(self.connect())
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    def tearDown(self) -> None:
+        for sock in self.sockets:
+            sock.close()
+        self.server.running = False
+        self.server.join()
+        self.server.sock.close()
+        self.db.close()
+        self.db_dir.cleanup()
+
+    def connect(self):
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.settimeout(5)
+        sock.connect((DEFAULT_IP_ADDRESS, CORE_PORT))
+        return sock
+
+    def client(self, name):
+        client = ServerClient(name, CORE_PORT)
+        self.sockets.append(client.sock)
+        return client
+
+    def start_authorization(self, name):
+        """Send presence and get the password challenge without answering it"""
+        sock = self.connect()
+        self.sockets.append(sock)
+        send_message(sock, {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: name, PUBLIC_KEY: name}})
+        self.assertEqual(get_message(sock, MessageDecoder())[RESPONSE], 511)
+        return sock
+
+    def test_stalled_authorization(self):
+        """ Tests that a client which doesn't answer the password challenge doesn't block the others """
+        self.start_authorization(USERS[0])
+
+        start = time.monotonic()
+        client = self.client(USERS[1])
+        self.assertEqual(client.answer, {RESPONSE: 200})
+        self.assertLess(time.monotonic() - start, AUTH_TIMEOUT / 2)
+
+    def test_authorization_timeout(self):
+        """ Tests that a client is disconnected if it doesn't answer the password challenge in time """
+        with mock.patch('server.core.AUTH_TIMEOUT', 0.2):
+            sock = self.start_authorization(USERS[0])
+        self.assertEqual(sock.recv(1024), b'')
+        self.assertFalse(self.server.is_user_online(USERS[0]))
+
+    def test_wrong_password(self):
+        """ Tests that a wrong answer to the password challenge is rejected """
+        sock = self.start_authorization(USERS[0])
+        send_message(sock, {RESPONSE: 511, DATA: 'd3Jvbmc=\n'})
+        answer = get_message(sock, MessageDecoder())
+        self.assertEqual((answer[RESPONSE], answer[ERROR]), (400, 'Неверный пароль.'))
+
+    def test_offline_messages(self):
+        """ Tests that stored messages are delivered at login by batches before new messages
+        and are removed when they are sent
+        """
+        for i in range(5):
+            self.db.store_message(USERS[1], {ACTION: MESSAGE, SENDER: USERS[0], MESSAGE_TEXT: str(i)}).result()
+
+        sender = self.client(USERS[2])
+        with mock.patch('server.core.OFFLINE_BATCH_SIZE', 2):
+            receiver = self.client(USERS[1])
+            sender.send({ACTION: MESSAGE, TIME: time.time(), SENDER: USERS[2], DESTINATION: USERS[1],
+                         MESSAGE_TEXT: 'new'})
+            self.assertEqual(sender.get(), {RESPONSE: 200})
+            texts = [receiver.get()[MESSAGE_TEXT] for _ in range(6)]
+        self.assertEqual(texts, ['0', '1', '2', '3', '4', 'new'])
+
+        for _ in range(50):
+            if not self.db.get_offline_messages(USERS[1], 0, 10).result():
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.db.get_offline_messages(USERS[1], 0, 10).result(), [])
+
+
+    def test_disconnect_user(self):
+        """ Tests that a user connection is closed by the server cycle when it's asked by another thread """
+        client = self.client(USERS[0])
+        self.server.disconnect_user(USERS[0])
+        self.assertEqual(client.sock.recv(1024), b'')
+        self.assertFalse(self.server.is_user_online(USERS[0]))
+
+    def test_contacts_reply(self):
+        """ Tests that an answer read by the database writer is sent without waiting for the server cycle timeout """
+        self.db.add_contact(USERS[0], USERS[1]).result()
+        client = self.client(USERS[0])
+
+        start = time.monotonic()
+        client.send({ACTION: GET_CONTACTS, TIME: time.time(), USER: USERS[0]})
+        self.assertEqual(client.get(), {RESPONSE: 202, LIST_INFO: [USERS[1]]})
+        self.assertLess(time.monotonic() - start, SELECTOR_TIMEOUT / 2)
+
+
+class TestSelectMessageProcessor(TestMessageProcessor):
+    engine = 'select'
+
+
+class TestOutboundBuffers(unittest.TestCase):
+    """Server side of a socket pair is a client connection which is never read by the other side"""
+    message = {RESPONSE: 200, MESSAGE_TEXT: 'x' * 1024}
+
+    def setUp(self) -> None:
+        self.server = MessageProcessor(None, DEFAULT_IP_ADDRESS, CORE_PORT, 'selectors')
+        self.server.selector = selectors.DefaultSelector()
+        self.reader, self.client = socketpair()
+        self.client.setblocking(False)
+        self.server.connections.add(self.client, ('127.0.0.1', CORE_PORT))
+        self.server.selector.register(self.client, selectors.EVENT_READ)
+
+    def tearDown(self) -> None:
+        self.server.selector.close()
+        self.reader.close()
+        self.client.close()
+
+    def events(self):
+        return self.server.selector.get_key(self.client).events
+
+    def test_reading_paused(self):
+        """ Tests that requests of a client aren't read while it doesn't read its answers """
+        while not self.server.is_reading_paused(self.client):
+            self.server.send_to(self.client, self.message)
+            self.server.flush_client(self.client)
+        self.assertEqual(self.events(), selectors.EVENT_WRITE)
+
+        # -- Reading is resumed when client reads its answers
+        self.reader.setblocking(False)
+        while self.server.is_reading_paused(self.client):
+            try:
+                self.reader.recv(OUTBOUND_HIGH_WATER)
+            except BlockingIOError:
+                pass
+            self.server.flush_client(self.client)
+        self.assertTrue(self.events() & selectors.EVENT_READ)
+
+    def test_slow_client_evicted(self):
+        """ Tests that a client is disconnected when its outbound buffer exceeds the limit """
+        for _ in range(OUTBOUND_BUFFER_LIMIT // len(self.message[MESSAGE_TEXT]) + 1):
+            self.server.send_to(self.client, self.message)
+            self.server.flush_client(self.client)
+        self.assertIn(self.client, self.server.slow_clients)
+
+        self.server.flush_pending()
+        self.assertIsNone(self.server.connections.get(self.client))
+        self.assertEqual(self.client.fileno(), -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import base64
+import sys
+import os
+import unittest
+
+from Cryptodome.Cipher import PKCS1_OAEP
+from Cryptodome.PublicKey import RSA
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from client.crypto import HybridCipher
+from common.variables import SESSION_KEY_MESSAGES
+
+
+class TestHybridCipher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.sender_keys = RSA.generate(1024)
+        cls.recipient_keys = RSA.generate(1024)
+        cls.pubkey = cls.recipient_keys.publickey().export_key().decode('ascii')
+
+    def setUp(self) -> None:
+        self.sender = HybridCipher(self.sender_keys, 'sender')
+        self.recipient = HybridCipher(self.recipient_keys, 'recipient')
+
+    def test_long_message(self):
+        """ Tests that message longer than RSA block is encrypted """
+        text = 'Сообщение ' * 1000
+        self.assertEqual(self.recipient.decrypt('sender', self.sender.encrypt('recipient', self.pubkey, text)), text)
+
+    def test_key_decrypted_once(self):
+        """ Tests that conversation key is reused and replaced after the messages limit """
+        payloads = [self.sender.encrypt('recipient', self.pubkey, str(i)) for i in range(SESSION_KEY_MESSAGES + 1)]
+        texts = [self.recipient.decrypt('sender', payload) for payload in payloads]
+
+        self.assertEqual(texts[-1], str(SESSION_KEY_MESSAGES))
+        self.assertEqual(len(self.recipient.received_keys), 2)
+
+    def test_wrong_sender(self):
+        """ Tests that message can't be passed as a message of another user """
+        payload = self.sender.encrypt('recipient', self.pubkey, 'text')
+        self.assertRaises(ValueError, self.recipient.decrypt, 'other', payload)
+
+    def test_legacy_message(self):
+        """ Tests that message encrypted with RSA only is decrypted """
+        payload = base64.b64encode(PKCS1_OAEP.new(self.recipient_keys.publickey()).encrypt(b'text')).decode('ascii')
+        self.assertEqual(self.recipient.decrypt('sender', payload), 'text')
+
+
+if __name__ == '__main__':
+    unittest.main()
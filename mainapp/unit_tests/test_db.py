@@ -0,0 +1,232 @@
+import datetime
+import sqlite3
+import sys
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy.exc import IntegrityError
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from server.db import Storage, IdentityCache, UserIdentity, MIGRATIONS
+
+
+class TestIdentityCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        """ Tests that the least recently used identity is evicted """
+        cache = IdentityCache(2)
+        cache.put('first', UserIdentity(1, b'1', None))
+        cache.put('second', UserIdentity(2, b'2', None))
+        cache.get('first')
+        cache.put('third', UserIdentity(3, b'3', None))
+
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.get('first').id, 1)
+        self.assertEqual(cache.get('third').id, 3)
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 3, 'misses': 1})
+
+
+class StorageTestCase(unittest.TestCase):
+    """Storage in a temporary directory, test classes add their users in setUp"""
+    def setUp(self) -> None:
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db = Storage(os.path.join(self.db_dir.name, 'test.sqlite'))
+
+    def tearDown(self) -> None:
+        self.db.close()
+        self.db.session.close()
+        self.db.engine.dispose()
+        self.db_dir.cleanup()
+
+
+class TestStorageCache(StorageTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.db.add_user('sender', b'sender_hash')
+        self.db.add_user('recipient', b'recipient_hash').result()
+
+    def test_message_path_cached(self):
+        """ Tests that users are read from the database once """
+        for _ in range(3):
+            self.db.process_message('sender', 'recipient')
+
+        self.assertEqual(self.db.identities.stats(), {'size': 2, 'hits': 4, 'misses': 2})
+        self.assertEqual([row[2:] for row in self.db.message_history()], [(3, 0), (0, 3)])
+
+    def test_stats_write_behind(self):
+        """ Tests that statistics is written by one flush and isn't lost """
+        for _ in range(3):
+            self.db.process_message('sender', 'recipient')
+
+        saved = self.db.session.query(self.db.UsersHistory.sent).order_by(self.db.UsersHistory.user).all()
+        self.assertEqual([row[0] for row in saved], [0, 0])
+
+        self.db.close()
+        self.db.session.expire_all()
+        saved = self.db.session.query(self.db.UsersHistory.sent, self.db.UsersHistory.accepted). \
+            order_by(self.db.UsersHistory.user).all()
+        self.assertEqual([tuple(row) for row in saved], [(3, 0), (0, 3)])
+        self.assertEqual([row[2:] for row in self.db.message_history()], [(3, 0), (0, 3)])
+
+    def test_wrong_operation_in_group(self):
+        """ Tests that a wrong change doesn't fail the other changes """
+        futures = [self.db.add_user('first', b'first_hash'),
+                   self.db.add_user('sender', b'other_hash'),
+                   self.db.add_user('second', b'second_hash')]
+
+        self.assertIsNone(futures[0].result())
+        self.assertRaises(IntegrityError, futures[1].result)
+        self.assertIsNone(futures[2].result())
+        self.assertEqual(sorted(user[0] for user in self.db.users_list()), ['first', 'recipient', 'second', 'sender'])
+
+    def test_save_active_users(self):
+        """ Tests that saved active users list replaces the previous one """
+        login_time = datetime.datetime(2022, 1, 1, 10, 0)
+        self.db.save_active_users([('sender', '127.0.0.1', 1000, login_time)]).result()
+        self.db.save_active_users([('recipient', '127.0.0.1', 1001, login_time),
+                                   ('unknown', '127.0.0.1', 1002, login_time)]).result()
+        self.assertEqual([tuple(user) for user in self.db.active_users_list()],
+                         [('recipient', '127.0.0.1', 1001, login_time)])
+
+    def test_login_updates_pubkey(self):
+        """ Tests that a new public key is returned after login """
+        self.assertIsNone(self.db.get_pubkey('sender'))
+        self.db.user_login('sender', '127.0.0.1', 7777, 'new_key').result()
+        self.assertEqual(self.db.get_pubkey('sender'), 'new_key')
+
+    def test_pubkeys_list(self):
+        """ Tests that keys of the users list are returned without unknown users and users without a key """
+        self.db.user_login('sender', '127.0.0.1', 7777, 'sender_key').result()
+        self.assertEqual(self.db.get_pubkeys(['sender', 'recipient', 'unknown']), {'sender': 'sender_key'})
+
+    def test_removed_user(self):
+        """ Tests that removed user isn't found in the cache """
+        self.assertTrue(self.db.check_user('recipient'))
+        self.db.remove_user('recipient').result()
+        self.assertFalse(self.db.check_user('recipient'))
+
+        self.db.add_user('recipient', b'new_hash').result()
+        self.assertEqual(self.db.get_hash('recipient'), b'new_hash')
+
+    def test_users_changes(self):
+        """ Tests that only users list changes after the version are returned """
+        version, added, removed = self.db.users_changes()
+        self.assertEqual((sorted(added), removed), (['recipient', 'sender'], None))
+
+        self.db.add_user('first', b'first_hash')
+        self.db.remove_user('recipient').result()
+        new_version, added, removed = self.db.users_changes(version)
+        self.assertEqual((added, removed), (['first'], ['recipient']))
+
+        self.db.remove_user('first').result()
+        self.assertEqual(self.db.users_changes(new_version)[1:], ([], ['first']))
+        self.assertEqual(self.db.users_changes(new_version + 100)[2], None)
+
+
+class TestOfflineMessages(StorageTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.db.add_user('recipient', b'recipient_hash').result()
+
+    def store(self, count):
+        return [self.db.store_message('recipient', {'text': i}).result() for i in range(count)]
+
+    def test_batches_order(self):
+        """ Tests that messages are read by batches in the order they were stored and kept until removed """
+        self.store(5)
+        first = self.db.get_offline_messages('recipient', 0, 3).result()
+        second = self.db.get_offline_messages('recipient', first[-1][0], 3).result()
+        self.assertEqual([message['text'] for _, message in first + second], [0, 1, 2, 3, 4])
+
+        self.db.remove_offline_messages('recipient', first[-1][0]).result()
+        rest = self.db.get_offline_messages('recipient', 0, 10).result()
+        self.assertEqual([message['text'] for _, message in rest], [3, 4])
+
+    def test_queue_limit(self):
+        """ Tests that messages aren't stored over the queue limit or for an unknown user """
+        with mock.patch('server.db.OFFLINE_QUEUE_LIMIT', 2):
+            self.assertEqual(self.store(3), [True, True, False])
+        self.assertFalse(self.db.store_message('unknown', {'text': 0}).result())
+
+    def test_expired_messages(self):
+        """ Tests that messages stored longer than TTL are removed """
+        self.store(2)
+        created = datetime.datetime.now() - datetime.timedelta(days=30)
+        self.db.write(lambda session: session.query(self.db.OfflineMessages).update(
+            {self.db.OfflineMessages.created: created})).result()
+        self.store(1)
+
+        messages = self.db.get_offline_messages('recipient', 0, 10).result()
+        self.assertEqual([message['text'] for _, message in messages], [0])
+
+
+class TestStoragePages(StorageTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        for number in range(5):
+            self.db.add_user(f'user_{number}', f'hash_{number}'.encode())
+        self.db.add_user('guest', b'guest_hash').result()
+
+    def read_pages(self, fetch_page, **query):
+        pages, key = [], None
+        while True:
+            rows, key = fetch_page(after=key, limit=2, **query)
+            pages.append(rows)
+            if key is None:
+                return pages
+
+    def test_history_pages(self):
+        """ Tests that statistics pages are sorted and don't repeat rows """
+        for number in range(5):
+            for _ in range(number % 3):
+                self.db.process_message(f'user_{number}', 'guest')
+        self.db.close()
+
+        pages = self.read_pages(self.db.message_history_page, sort='sent', descending=True, name_filter='user')
+        rows = [row for page in pages for row in page]
+        self.assertEqual(len(pages), 3)
+        self.assertEqual([(row[0], row[2]) for row in rows],
+                         [('user_2', 2), ('user_4', 1), ('user_1', 1), ('user_3', 0), ('user_0', 0)])
+
+    def test_filter_escaped(self):
+        """ Tests that filter text is matched literally """
+        rows, key = self.db.message_history_page(name_filter='_')
+        self.assertEqual(len(rows), 5)
+        self.assertIsNone(key)
+        self.assertEqual(self.db.message_history_page(name_filter='%')[0], [])
+
+
+class TestStorageMigrations(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.db_dir.name, 'test.sqlite')
+
+    def tearDown(self) -> None:
+        self.db_dir.cleanup()
+
+    def open_storage(self):
+        db = Storage(self.db_path)
+        db.close()
+        db.engine.dispose()
+
+    def test_old_database_upgraded(self):
+        """ Tests that indexes are created for a database made without migrations """
+        self.open_storage()
+        connection = sqlite3.connect(self.db_path)
+        connection.execute('DROP INDEX ix_users_contacts_user_contact')
+        connection.execute('PRAGMA user_version=0')
+        connection.close()
+
+        self.open_storage()
+        connection = sqlite3.connect(self.db_path)
+        indexes = [row[0] for row in connection.execute('SELECT name FROM sqlite_master WHERE type = "index"')]
+        self.assertIn('ix_users_contacts_user_contact', indexes)
+        self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import io
+import logging
+import queue
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from logs.log_pipeline import DroppingQueueHandler, LogWriter
+
+
+class TestLogPipeline(unittest.TestCase):
+    def setUp(self) -> None:
+        self.stream = io.StringIO()
+        self.handler = logging.StreamHandler(self.stream)
+        self.handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+
+        self.logger = logging.getLogger('test_pipeline')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self) -> None:
+        self.logger.handlers.clear()
+
+    def write_queue(self, log_queue):
+        """Write all the queued records as the writer thread does"""
+        batch = []
+        while not log_queue.empty():
+            batch.append(log_queue.get_nowait())
+        LogWriter.write(batch)
+
+    def test_batch_written(self):
+        """ Tests that queued records are written in order by the target handler """
+        log_queue = queue.Queue()
+        self.logger.addHandler(DroppingQueueHandler(log_queue, (self.handler,)))
+        for i in range(3):
+            self.logger.info('message %d', i)
+
+        self.assertEqual(self.stream.getvalue(), '')
+        self.write_queue(log_queue)
+        self.assertEqual(self.stream.getvalue(), 'INFO message 0\nINFO message 1\nINFO message 2\n')
+
+    def test_arguments_formatted_on_enqueue(self):
+        """ Tests that arguments changed after a call don't change the record """
+        log_queue = queue.Queue()
+        self.logger.addHandler(DroppingQueueHandler(log_queue, (self.handler,)))
+        data = [1]
+        self.logger.info('data %s', data)
+        data.append(2)
+
+        self.write_queue(log_queue)
+        self.assertEqual(self.stream.getvalue(), 'INFO data [1]\n')
+
+    def test_handler_level(self):
+        """ Tests that target handler level is checked by the writer """
+        log_queue = queue.Queue()
+        self.handler.setLevel(logging.ERROR)
+        self.logger.addHandler(DroppingQueueHandler(log_queue, (self.handler,)))
+        self.logger.info('info')
+        self.logger.error('error')
+
+        self.write_queue(log_queue)
+        self.assertEqual(self.stream.getvalue(), 'ERROR error\n')
+
+    def test_full_queue_dropped(self):
+        """ Tests that records are dropped and counted when the queue is full """
+        log_queue = queue.Queue(2)
+        queue_handler = DroppingQueueHandler(log_queue, (self.handler,))
+        self.logger.addHandler(queue_handler)
+        for i in range(5):
+            self.logger.info('message %d', i)
+
+        self.assertEqual(queue_handler.dropped, 3)
+        self.write_queue(log_queue)
+        self.assertEqual(self.stream.getvalue(), 'INFO message 0\nINFO message 1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
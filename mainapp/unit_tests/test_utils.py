@@ -1,4 +1,5 @@
 import json
+import logging
 import sys
 import os
 import unittest
@@ -9,7 +10,8 @@ sys.path.insert(0, os.path.join(os.getcwd(), '..'))
 
 from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, ENCODING, DEFAULT_IP_ADDRESS,\
     DEFAULT_PORT, MAX_CONNECTIONS
-from common.utils import get_message, send_message
+from common.utils import get_message, send_message, encode_message, MessageDecoder
+from common.decorators import Log
 
 
 class TestUtils(unittest.TestCase):
@@ -76,5 +78,116 @@ class TestUtils(unittest.TestCase):
         self.assertRaises(ValueError, get_message, self.server_client_socket)
 
 
+class TestMessageDecoder(unittest.TestCase):
+    def setUp(self) -> None:
+        self.message = {
+            ACTION: PRESENCE,
+            TIME: 1.1,
+            USER: {
+                ACCOUNT_NAME: 'Guest',
+            },
+        }
+
+    def test_framed_split_message(self):
+        """ Tests that framed message received by parts is decoded only when it's complete """
+        decoder = MessageDecoder(framed=True)
+        data = encode_message(self.message, framed=True)
+
+        self.assertEqual(decoder.feed(data[:3]), [])
+        self.assertEqual(decoder.feed(data[3:10]), [])
+        self.assertEqual(decoder.feed(data[10:]), [self.message])
+        self.assertFalse(decoder.buffer)
+
+    def test_framed_coalesced_messages(self):
+        """ Tests several framed messages received at once """
+        decoder = MessageDecoder(framed=True)
+        data = encode_message(self.message, framed=True) * 3
+
+        self.assertEqual(decoder.feed(data[:-1]), [self.message, self.message])
+        self.assertEqual(decoder.feed(data[-1:]), [self.message])
+
+    def test_framed_too_long_message(self):
+        """ Tests that a frame with a wrong length header raises ValueError """
+        decoder = MessageDecoder(framed=True)
+
+        self.assertRaises(ValueError, decoder.feed, b'\xff\xff\xff\xff{}')
+
+    def test_stream_coalesced_messages(self):
+        """ Tests old clients messages without a header received at once and by parts """
+        decoder = MessageDecoder()
+        data = encode_message(self.message) * 2
+        middle = len(data) // 4
+
+        self.assertEqual(decoder.feed(data[:middle]), [])
+        self.assertEqual(decoder.feed(data[middle:]), [self.message, self.message])
+
+    def test_stream_wrong_data(self):
+        """ Tests that not a dict data raises ValueError """
+        decoder = MessageDecoder()
+
+        self.assertRaises(ValueError, decoder.feed, 'String'.encode(ENCODING))
+
+
+class ReprCounter:
+    """Object which counts how many times it was formatted"""
+    calls = 0
+
+    def __repr__(self):
+        ReprCounter.calls += 1
+        return 'ReprCounter'
+
+
+@Log
+def traced_function(arg):
+    return arg
+
+
+class TestLog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.records = []
+        self.logger = logging.getLogger('test_log')
+        self.logger.propagate = False
+        self.handler = logging.Handler()
+        self.handler.emit = self.records.append
+        self.logger.addHandler(self.handler)
+        self.saved_logger, Log.logger = Log.logger, self.logger
+        ReprCounter.calls = 0
+
+    def tearDown(self) -> None:
+        Log.logger = self.saved_logger
+        self.logger.removeHandler(self.handler)
+        Log.set_tracing('traced_function')
+
+    def test_trace_written(self):
+        """ Tests that call and caller are written to a log """
+        self.logger.setLevel(logging.DEBUG)
+        self.assertEqual(traced_function(1), 1)
+        self.assertEqual(len(self.records), 2)
+        self.assertIn('test_trace_written', self.records[1].getMessage())
+
+    def test_level_disabled(self):
+        """ Tests that arguments aren't formatted if trace level is disabled """
+        self.logger.setLevel(logging.ERROR)
+        traced_function(ReprCounter())
+        self.assertEqual(self.records, [])
+        self.assertEqual(ReprCounter.calls, 0)
+
+    def test_function_disabled(self):
+        """ Tests that tracing can be switched off for one function """
+        self.logger.setLevel(logging.DEBUG)
+        self.assertTrue(Log.set_tracing('traced_function', False))
+        self.assertEqual(traced_function(2), 2)
+        self.assertEqual(self.records, [])
+        self.assertFalse(Log.set_tracing('unknown_function', False))
+
+    def test_sampling(self):
+        """ Tests that only every N-th call is written """
+        self.logger.setLevel(logging.DEBUG)
+        Log.set_tracing('traced_function', sample_rate=5)
+        for i in range(20):
+            traced_function(i)
+        self.assertEqual(len(self.records), 8)
+
+
 if __name__ == '__main__':
     unittest.main()